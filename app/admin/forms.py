@@ -1,8 +1,9 @@
 # coding:utf8
 from flask_wtf import FlaskForm
-from wtforms import StringField, PasswordField, SubmitField, FileField, TextAreaField, SelectField
+from wtforms import StringField, PasswordField, SubmitField, FileField, TextAreaField, SelectField, HiddenField
 from wtforms.validators import DataRequired, ValidationError
-from app.models import Admin, Tag
+from app.models import Tag
+from app.uploads import Upload, UploadError
 
 
 class LoginForm(FlaskForm):
@@ -38,12 +39,6 @@ class LoginForm(FlaskForm):
         }
     )
 
-    def validate_account(self, field):
-        account = field.data
-        _counter = Admin.query.filter_by(name=account).count()
-        if _counter == 0:
-            raise ValidationError("账号不存在，请输入正确的账号。")
-
 
 class TagForm(FlaskForm):
     name = StringField(
@@ -87,11 +82,14 @@ class MovieForm(FlaskForm):
     )
     movie_url = FileField(
         label="文件",
-        validators=[
-            DataRequired("请上传文件！")
-        ],
         description="电影媒体文件"
     )
+    movie_upload_id = HiddenField(
+        description="分块上传完成后的上传编号",
+        render_kw={
+            "id": "input_upload_id"
+        }
+    )
     movie_info = TextAreaField(
         label="简介",
         validators=[
@@ -128,7 +126,7 @@ class MovieForm(FlaskForm):
             DataRequired("请选择电影对应的标签！")
         ],
         coerce=int,
-        choices=[(v.id, v.name) for v in Tag.query.all()],
+        choices=[],
         description="电影标签",
         render_kw={
             "class": "form-control"
@@ -181,6 +179,24 @@ class MovieForm(FlaskForm):
         }
     )
 
+    def __init__(self, *args, **kwargs):
+        super(MovieForm, self).__init__(*args, **kwargs)
+        # 标签在创建表单时查询，导入模块时不访问数据库
+        self.movie_tag.choices = [(v.id, v.name) for v in Tag.query.all()]
+
+    def validate_movie_url(self, field):
+        if not field.data and not self.movie_upload_id.data:
+            raise ValidationError("请上传文件！")
+
+    def validate_movie_upload_id(self, field):
+        if field.data:
+            try:
+                upload = Upload.get(field.data)
+            except UploadError as e:
+                raise ValidationError(str(e))
+            if not upload.complete:
+                raise ValidationError("电影文件尚未上传完成！")
+
 
 class PreviewForm(FlaskForm):
     preview_title = StringField(
@@ -213,4 +229,8 @@ class PreviewForm(FlaskForm):
         render_kw={
             "class": "btn btn-primary"
         }
-    )
\ No newline at end of file
+    )
+
+
+class DeleteForm(FlaskForm):
+    """列表中的删除按钮，只校验 CSRF 令牌。"""
@@ -1,45 +1,64 @@
 # coding:utf8
 from . import admin
-from flask import render_template, redirect, url_for, flash, session, request
-from app.admin.forms import LoginForm, TagForm, MovieForm, PreviewForm
-from app.models import Admin, Tag, Movie, Preview
+from flask import render_template, redirect, url_for, flash, session, request, abort, jsonify, Response
+from app.admin.forms import LoginForm, TagForm, MovieForm, PreviewForm, DeleteForm
+from app.models import Admin, Tag, Movie, Preview, User, Comment, Collection, Userlog, Adminlog, Operationlog, \
+    Role, Authority
 from functools import wraps
+from sqlalchemy.orm import undefer
 from app import db, app
-from werkzeug.utils import secure_filename
+from app.search import index_movie, unindex_movie, reindex_tag
+from app.pagination import paginate_request
+from app.datatables import SOURCES, DataTableError, process
+from app.counters import view_counter
+from app.hyperloglog import unique_viewers
+from app.auditlog import log_admin_login, log_operation
+from app.rbac import current_admin_can, DELEGATED_ENDPOINTS
+from app.passwords import verify_password, PasswordPoolBusy
+from app.querying import list_query, query_budget
+from app.profiler import recent_profiles
+from app.database import worker_metrics
+from app.replicas import read_from_replica
+from app import storage, thumbnails
+from app.uploads import Upload, UploadError, TUS_VERSION, CHECKSUM_ALGORITHMS, parse_metadata, parse_checksum, \
+    expire_uploads
 import os
-import uuid
-import datetime
 
 
 # 登录装饰器
 def admin_login_require(f):
     """
-    确保所有页面都在登录后才有访问权限。
+    确保所有页面都在登录后才有访问权限，并按管理员所属角色的权限检查能否访问。
     :param f: 对应页面的函数。
-    :return: 返回一个检查是否登录的函数。登录时直接转到目标页面；
-             未登录时跳转到登录页。
+    :return: 返回一个检查是否登录的函数。登录且有权限时直接转到目标页面；
+             未登录时跳转到登录页，没有权限时返回 403。
     """
 
     @wraps(f)
     def decorated_function(*args, **kwargs):
         if "current_client" not in session:
             return redirect(url_for("admin.login", next=request.url))
+        if request.endpoint not in DELEGATED_ENDPOINTS and not current_admin_can(request.endpoint):
+            abort(403)
         return f(*args, **kwargs)
 
     return decorated_function
 
 
-# 修改文件名称
-def change_filename(filename):
-    file_info = os.path.splitext(filename)
-    filename = datetime.datetime.now().strftime("%Y%m%d%H%M%S") + "_" + str(uuid.uuid4().hex) + file_info[-1]
-    return filename
+# 保存电影文件：优先使用分块上传完成的文件，否则使用表单中上传的文件
+def save_movie_file(form):
+    if form.movie_upload_id.data:
+        upload = Upload.get(form.movie_upload_id.data)
+        path = upload.take()
+        return storage.store_file(path, upload.filename, upload.digest)
+    return storage.store(form.movie_url.data.stream, form.movie_url.data.filename)
 
 
 @admin.route("/")
 @admin_login_require
 def index():
-    return render_template("admin/index.html")
+    daily_viewers, top_movies = unique_viewers(days=7, limit=10)
+    return render_template("admin/index.html", daily_viewers=daily_viewers, top_movies=top_movies)
 
 
 # 登录
@@ -48,11 +67,24 @@ def login():
     form = LoginForm()
     if form.validate_on_submit():
         data = form.data
+        # 账号和密码哈希一次查出，哈希在线程池中校验
         current_client = Admin.query.filter_by(name=data["account"]).first()
-        if not current_client.check_password(data["password"]):
-            flash("密码错误，请重新输入！")
+        try:
+            valid, new_hash = verify_password(current_client.password if current_client else None, data["password"])
+        except PasswordPoolBusy:
+            flash("登录的人太多了，请稍后再试！")
+            return redirect(url_for("admin.login"))
+        # 账号不存在和密码错误给出同样的提示，不能据此猜出哪些账号存在
+        if current_client is None or not valid:
+            flash("账号或密码错误，请重新输入！")
             return redirect(url_for("admin.login"))
         session["current_client"] = data["account"]
+        session["admin_id"] = current_client.id
+        log_admin_login(current_client.id)
+        if new_hash is not None:
+            # 哈希参数已调整，用新参数保存
+            current_client.password = new_hash
+            db.session.commit()
         return redirect(request.args.get("next") or url_for("admin.index"))
     return render_template("admin/login.html", form=form)
 
@@ -61,6 +93,7 @@ def login():
 @admin_login_require
 def logout():
     session.pop("current_client", None)
+    session.pop("admin_id", None)
     return redirect(url_for("admin.login"))
 
 
@@ -86,20 +119,19 @@ def tag_add():
         )
         db.session.add(tag)
         db.session.commit()
+        log_operation("添加标签“%s”" % data["name"])
         flash("添加标签“%s”成功！" % (data["name"]), "OK")
         redirect(url_for('admin.tag_add'))
     return render_template("admin/tag_add.html", form=form)
 
 
 # 标签列表
-@admin.route("/tag/list/<int:current_page>/", methods=["GET"])
+@admin.route("/tag/list/", methods=["GET"])
+@read_from_replica
 @admin_login_require
-def tag_list(current_page=None):
-    if current_page is None:
-        current_page = 1
-    page_data = Tag.query.order_by(
-        Tag.add_time.desc()
-    ).paginate(page=current_page, per_page=10)
+@query_budget(3)
+def tag_list():
+    page_data = paginate_request(list_query(Tag), Tag)
     return render_template("admin/tag_list.html", page_data=page_data)
 
 
@@ -110,8 +142,9 @@ def tag_delete(tag_id=None):
     tag = Tag.query.filter_by(id=tag_id).first_or_404()
     db.session.delete(tag)
     db.session.commit()
+    log_operation("删除标签“%s”" % tag.name)
     flash("删除标签“%s”成功！" % (tag.name), "OK")
-    return redirect(url_for('admin.tag_list', current_page=1))
+    return redirect(url_for('admin.tag_list'))
 
 
 # 标签编辑
@@ -130,6 +163,8 @@ def tag_update(tag_id=None):
         old_tag_name = tag_old.name
         tag_old.name = data["name"]
         db.session.commit()
+        reindex_tag(tag_old)
+        log_operation("修改标签“%s”为“%s”" % (old_tag_name, data["name"]))
         flash("修改标签“%s”为“%s”成功！" % (old_tag_name, data["name"]), "OK")
         redirect(url_for('admin.tag_update', tag_id=tag_id))
     return render_template("admin/tag_update.html", form=form, tag_old=tag_old)
@@ -140,18 +175,17 @@ def tag_update(tag_id=None):
 @admin_login_require
 def movie_add():
     form = MovieForm()
-    form.movie_tag.choices = [(v.id, v.name) for v in Tag.query.all()]
     if form.validate_on_submit():
         data = form.data
-        movie_file_url = secure_filename(form.movie_url.data.filename)
-        cover_file_url = secure_filename(form.cover_url.data.filename)
         if not os.path.exists(app.config["UP_DIR"]):
             os.makedirs(app.config["UP_DIR"])
             os.chmod(app.config["UP_DIR"], 0o776)  # 776前面需加“0o”以十进制表示，否则默认以八进制表示
-        movie_file_url = change_filename(movie_file_url)
-        cover_file_url = change_filename(cover_file_url)
-        form.movie_url.data.save(app.config["UP_DIR"] + movie_file_url)
-        form.cover_url.data.save(app.config["UP_DIR"] + cover_file_url)
+        try:
+            movie_file_url = save_movie_file(form)
+        except UploadError as e:
+            flash(str(e), "errors")
+            return redirect(url_for('admin.movie_add'))
+        cover_file_url = storage.store(form.cover_url.data.stream, form.cover_url.data.filename)
         movie = Movie(
             title=data["movie_title"],
             url=movie_file_url,
@@ -167,23 +201,24 @@ def movie_add():
         )
         db.session.add(movie)
         db.session.commit()
+        thumbnails.schedule(movie.cover)
+        index_movie(movie)
+        log_operation("添加电影“%s”" % data["movie_title"])
         flash("电影“%s”添加成功！" % data["movie_title"], "OK")
         return redirect(url_for('admin.movie_add'))
     return render_template("admin/movie_add.html", form=form)
 
 
 # 电影列表
-@admin.route("/movie/list/<int:current_page>/", methods=["GET"])
+@admin.route("/movie/list/", methods=["GET"])
+@read_from_replica
 @admin_login_require
-def movie_list(current_page=None):
-    if current_page is None:
-        current_page = 1
-    page_data = Movie.query.join(Tag).filter(
-        Tag.id == Movie.tag_id
-    ).order_by(
-        Movie.add_time.desc()
-    ).paginate(page=current_page, per_page=10)
-    return render_template("admin/movie_list.html", page_data=page_data)
+@query_budget(3)
+def movie_list():
+    page_data = paginate_request(list_query(Movie), Movie)
+    # 合并尚未写回数据库的播放次数
+    pending_views = view_counter.pending_many([item.id for item in page_data.items])
+    return render_template("admin/movie_list.html", page_data=page_data, pending_views=pending_views)
 
 
 # 电影删除
@@ -192,10 +227,15 @@ def movie_list(current_page=None):
 def movie_delete(movie_id=None):
     movie = Movie.query.get_or_404(int(movie_id))
     db.session.delete(movie)
+    storage.release(movie.url)
+    storage.release(movie.cover)
     db.session.commit()
-    # 删除电影文件和封面文件
+    unindex_movie(movie.id)
+    log_operation("删除电影“%s”" % movie.title)
+    # 删除不再被引用的电影文件和封面文件
+    storage.collect([movie.url, movie.cover])
     flash("电影“%s”删除成功！" % movie.title, "OK")
-    return redirect(url_for('admin.movie_list', current_page=1))
+    return redirect(url_for('admin.movie_list'))
 
 
 # 电影修改
@@ -203,7 +243,7 @@ def movie_delete(movie_id=None):
 @admin_login_require
 def movie_update(movie_id=None):
     form = MovieForm()
-    movie = Movie.query.get_or_404(int(movie_id))
+    movie = Movie.query.options(undefer(Movie.info)).get_or_404(int(movie_id))
     if request.method == "GET":
         form.movie_info.data = movie.info
         form.movie_tag.data = movie.tag_id
@@ -217,16 +257,23 @@ def movie_update(movie_id=None):
         if not os.path.exists(app.config["UP_DIR"]):
             os.makedirs(app.config["UP_DIR"])
             os.chmod(app.config["UP_DIR"], 0o776)  # 776前面需加“0o”以十进制表示，否则默认以八进制表示
-        if form.movie_url.data.filename != "":
-            """更改电影视频文件名"""
-            movie_file_url = secure_filename(form.movie_url.data.filename)
-            movie.url = change_filename(movie_file_url)
-            form.movie_url.data.save(app.config["UP_DIR"] + movie.url)
+        replaced = []
+        if form.movie_upload_id.data or form.movie_url.data.filename != "":
+            """更换电影视频文件，内容相同时仍引用原文件"""
+            try:
+                url = save_movie_file(form)
+            except UploadError as e:
+                flash(str(e), "errors")
+                return redirect(url_for('admin.movie_update', movie_id=movie_id))
+            replaced.append(movie.url)
+            storage.release(movie.url)
+            movie.url = url
         if form.cover_url.data.filename != "":
-            """更改电影封面文件名"""
-            cover_file_url = secure_filename(form.cover_url.data.filename)
-            movie.cover = change_filename(cover_file_url)
-            form.cover_url.data.save(app.config["UP_DIR"] + movie.cover)
+            """更换电影封面文件"""
+            cover = storage.store(form.cover_url.data.stream, form.cover_url.data.filename)
+            replaced.append(movie.cover)
+            storage.release(movie.cover)
+            movie.cover = cover
         movie.rating = data["movie_rating"]
         movie.tag_id = data["movie_tag"]
         movie.info = data["movie_info"]
@@ -235,11 +282,99 @@ def movie_update(movie_id=None):
         movie.length = data["movie_length"]
         movie.release_time = data["movie_release_time"]
         db.session.commit()
+        storage.collect(replaced)
+        if form.cover_url.data.filename != "":
+            thumbnails.schedule(movie.cover)
+        index_movie(movie)
+        log_operation("修改电影“%s”" % data["movie_title"])
         flash("电影“%s”修改成功！" % data["movie_title"], "OK")
         return redirect(url_for('admin.movie_update', movie_id=movie_id))
     return render_template("admin/movie_update.html", form=form, movie=movie)
 
 
+# 分块上传：响应中都带上协议版本
+def tus_response(status=204, body="", **headers):
+    response = Response(body, status=status)
+    response.headers["Tus-Resumable"] = TUS_VERSION
+    response.headers["Cache-Control"] = "no-store"
+    for name, value in headers.items():
+        response.headers[name.replace("_", "-")] = str(value)
+    return response
+
+
+def check_upload_request():
+    """能添加或修改电影的管理员才能上传；要求 Tus-Resumable 头，跨站表单无法伪造该请求。"""
+    if not (current_admin_can("admin.movie_add") or current_admin_can("admin.movie_update")):
+        abort(403)
+    if request.method != "OPTIONS" and request.headers.get("Tus-Resumable") != TUS_VERSION:
+        raise UploadError("不支持的协议版本", 412)
+
+
+# 创建分块上传
+@admin.route("/uploads/", methods=["POST", "OPTIONS"])
+@admin_login_require
+def upload_create():
+    try:
+        check_upload_request()
+        if request.method == "OPTIONS":
+            return tus_response(
+                Tus_Version=TUS_VERSION,
+                Tus_Extension="creation,checksum,termination",
+                Tus_Checksum_Algorithm=",".join(CHECKSUM_ALGORITHMS),
+                Tus_Max_Size=app.config.get("UPLOAD_MAX_SIZE", 20 * 1024 ** 3)
+            )
+        try:
+            length = int(request.headers.get("Upload-Length", ""))
+        except ValueError:
+            raise UploadError("缺少 Upload-Length")
+        metadata = parse_metadata(request.headers.get("Upload-Metadata"))
+        expire_uploads()
+        upload = Upload.create(length, metadata.get("filename", ""))
+    except UploadError as e:
+        return tus_response(e.status, str(e))
+    return tus_response(201, Location=url_for("admin.upload_resource", upload_id=upload.id), Upload_Offset=0)
+
+
+# 查询进度、续传一块数据、放弃上传
+@admin.route("/uploads/<upload_id>/", methods=["HEAD", "PATCH", "DELETE"])
+@admin_login_require
+def upload_resource(upload_id=None):
+    try:
+        check_upload_request()
+        upload = Upload.get(upload_id)
+        if request.method == "HEAD":
+            return tus_response(200, Upload_Offset=upload.offset, Upload_Length=upload.length)
+        if request.method == "DELETE":
+            upload.delete()
+            return tus_response()
+        if request.mimetype != "application/offset+octet-stream":
+            raise UploadError("Content-Type 应为 application/offset+octet-stream", 415)
+        try:
+            offset = int(request.headers.get("Upload-Offset", ""))
+        except ValueError:
+            raise UploadError("缺少 Upload-Offset")
+        offset = upload.write_chunk(request.stream, offset, request.content_length,
+                                    parse_checksum(request.headers.get("Upload-Checksum")))
+    except UploadError as e:
+        return tus_response(e.status, str(e))
+    return tus_response(Upload_Offset=offset)
+
+
+# DataTables 服务器端处理接口
+@admin.route("/datatables/<source>/", methods=["GET"])
+@admin_login_require
+def datatable(source=None):
+    data_source = SOURCES.get(source)
+    if data_source is None:
+        abort(404)
+    if not current_admin_can(data_source.endpoint):
+        abort(403)
+    try:
+        return jsonify(process(data_source, request.args))
+    except DataTableError as e:
+        return jsonify({"draw": request.args.get("draw", 0, type=int), "error": str(e)})
+
+
 @admin.route("/preview/add/", methods=["GET", "POST"])
 @admin_login_require
 def preview_add():
@@ -251,15 +386,21 @@ def preview_add():
 
 
 @admin.route("/preview/list/")
+@read_from_replica
 @admin_login_require
+@query_budget(3)
 def preview_list():
-    return render_template("admin/preview_list.html")
+    page_data = paginate_request(list_query(Preview), Preview)
+    return render_template("admin/preview_list.html", page_data=page_data)
 
 
 @admin.route("/user/list/")
+@read_from_replica
 @admin_login_require
+@query_budget(3)
 def user_list():
-    return render_template("admin/user_list.html")
+    page_data = paginate_request(list_query(User), User)
+    return render_template("admin/user_list.html", page_data=page_data)
 
 
 @admin.route("/user/view/")
@@ -269,33 +410,77 @@ def user_view():
 
 
 @admin.route("/comments/list/")
+@read_from_replica
 @admin_login_require
+@query_budget(3)
 def comments_list():
-    return render_template("admin/comments_list.html")
+    page_data = paginate_request(list_query(Comment), Comment)
+    return render_template("admin/comments_list.html", page_data=page_data, form=DeleteForm())
+
+
+# 评论删除，只接受带 CSRF 令牌的 POST 请求
+@admin.route("/comments/delete/<int:comment_id>/", methods=["POST"])
+@admin_login_require
+def comment_delete(comment_id=None):
+    if not DeleteForm().validate_on_submit():
+        abort(400)
+    comment = Comment.query.get_or_404(comment_id)
+    db.session.delete(comment)
+    # 评论数量与评论在同一事务中递减
+    Movie.query.filter_by(id=comment.movie_id).update(
+        {Movie.review_num: db.case([(Movie.review_num > 0, Movie.review_num - 1)], else_=0)},
+        synchronize_session=False
+    )
+    db.session.commit()
+    log_operation("删除评论 %d" % comment.id)
+    flash("删除评论成功！", "OK")
+    return redirect(url_for('admin.comments_list'))
 
 
 @admin.route("/collection/list/")
+@read_from_replica
 @admin_login_require
+@query_budget(3)
 def collection_list():
-    return render_template("admin/collection_list.html")
+    page_data = paginate_request(list_query(Collection), Collection)
+    return render_template("admin/collection_list.html", page_data=page_data)
 
 
 @admin.route("/operations/log/list/")
+@read_from_replica
 @admin_login_require
+@query_budget(3)
 def operations_log_list():
-    return render_template("admin/operations_log_list.html")
+    page_data = paginate_request(list_query(Operationlog), Operationlog)
+    return render_template("admin/operations_log_list.html", page_data=page_data)
 
 
 @admin.route("/admin_login/log/list/")
+@read_from_replica
 @admin_login_require
+@query_budget(3)
 def admin_login_log_list():
-    return render_template("admin/admin_login_log_list.html")
+    page_data = paginate_request(list_query(Adminlog), Adminlog)
+    return render_template("admin/admin_login_log_list.html", page_data=page_data)
 
 
 @admin.route("/user_login/log/list/")
+@read_from_replica
 @admin_login_require
+@query_budget(3)
 def user_login_log_list():
-    return render_template("admin/user_login_log_list.html")
+    page_data = paginate_request(list_query(Userlog), Userlog)
+    return render_template("admin/user_login_log_list.html", page_data=page_data)
+
+
+# 最近请求的 SQL 统计
+@admin.route("/sql/profiles/")
+@admin_login_require
+def sql_profiles():
+    return render_template("admin/sql_profiles.html", profiles=recent_profiles(),
+                           enabled=app.config.get("SQL_PROFILER", False),
+                           slow_ms=app.config.get("SQL_SLOW_QUERY_MS", 200),
+                           pools=worker_metrics())
 
 
 @admin.route("/role/add/")
@@ -306,8 +491,10 @@ def role_add():
 
 @admin.route("/role/list/")
 @admin_login_require
+@query_budget(3)
 def role_list():
-    return render_template("admin/role_list.html")
+    page_data = paginate_request(list_query(Role), Role)
+    return render_template("admin/role_list.html", page_data=page_data)
 
 
 @admin.route("/authority/add/")
@@ -318,8 +505,10 @@ def authority_add():
 
 @admin.route("/authority/list/")
 @admin_login_require
+@query_budget(3)
 def authority_list():
-    return render_template("admin/authority_list.html")
+    page_data = paginate_request(list_query(Authority), Authority)
+    return render_template("admin/authority_list.html", page_data=page_data)
 
 
 @admin.route("/admin/add/")
@@ -330,5 +519,7 @@ def admin_add():
 
 @admin.route("/admin/list/")
 @admin_login_require
+@query_budget(3)
 def admin_list():
-    return render_template("admin/admin_list.html")
+    page_data = paginate_request(list_query(Admin), Admin)
+    return render_template("admin/admin_list.html", page_data=page_data)
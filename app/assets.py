@@ -0,0 +1,252 @@
+# coding:utf8
+"""
+带内容指纹、预压缩的静态文件。
+
+页面通过 url_for('static', ...) 引用 ueditor、highcharts、DataTables 等体积很大的文件，
+地址不随内容变化，浏览器只能每次重新验证，无法长期缓存。部署时运行
+    flask build-static
+把 static 下的文件复制到 STATIC_BUILD_DIR（默认 instance/static_build），文件名中加入
+内容摘要（bootstrap.min.css -> bootstrap.min.3f2a9c1d0b7e.css），文本类文件同时写出
+.gz 和 .br（需要安装 brotli）压缩版本，并生成 manifest.json。之后：
+    - url_for('static', filename=...) 自动返回带摘要的地址；
+    - 访问带摘要的地址时按 Accept-Encoding 直接返回预先压缩好的文件，
+      并设置一年的 immutable 缓存，内容变化后地址随之变化；
+    - 没有构建过或不在清单中的文件（如上传目录）照常返回。
+CSS 中以相对路径引用的字体和图片仍使用原地址，由浏览器按常规缓存规则重新验证。
+"""
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import shutil
+import threading
+import time
+import click
+from flask import request, send_file
+from app import app
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MANIFEST_NAME = "manifest.json"
+# 指纹取内容 MD5 的前 12 位
+FINGERPRINT_LENGTH = 12
+# 值得压缩的文件类型和最小尺寸
+COMPRESSIBLE = (".css", ".js", ".json", ".map", ".svg", ".txt", ".html", ".xml", ".eot", ".ttf", ".otf", ".ico")
+MIN_COMPRESS_SIZE = 1024
+# 按优先顺序排列的编码：(Content-Encoding, 文件后缀)
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+# 检查清单文件是否更新的最短间隔秒数
+_RELOAD_CHECK = 1
+
+
+def build_dir():
+    return app.config.get("STATIC_BUILD_DIR", os.path.join(app.instance_path, "static_build"))
+
+
+def _excluded_dirs():
+    """不参与构建的目录（绝对路径）：上传目录等内容会变化的文件。"""
+    return set(os.path.abspath(path).rstrip(os.sep) for path in (app.config["UP_DIR"], build_dir()))
+
+
+def source_files(root):
+    """:return: 生成器，元素为 static 下参与构建的文件的相对路径（以“/”分隔）。"""
+    excluded = _excluded_dirs()
+    for directory, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(
+            name for name in dirnames
+            if not name.startswith(".") and os.path.join(os.path.abspath(directory), name) not in excluded
+        )
+        for name in sorted(filenames):
+            if not name.startswith("."):
+                yield os.path.relpath(os.path.join(directory, name), root).replace(os.sep, "/")
+
+
+def fingerprinted_name(path, digest):
+    stem, ext = os.path.splitext(path)
+    return "%s.%s%s" % (stem, digest[:FINGERPRINT_LENGTH], ext)
+
+
+def _file_digest(path):
+    digest = hashlib.md5()
+    with open(path, "rb") as f:
+        for data in iter(lambda: f.read(64 * 1024), b""):
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def _write_atomic(path, data):
+    temp = "%s.%d.tmp" % (path, os.getpid())
+    with open(temp, "wb") as f:
+        f.write(data)
+    os.replace(temp, path)
+
+
+def _compress(target):
+    """写出 target 的压缩版本，只保留确实更小的。:return: 可用的编码列表。"""
+    with open(target, "rb") as f:
+        data = f.read()
+    available = []
+    for encoding, suffix in ENCODINGS:
+        if not os.path.exists(target + suffix):
+            if encoding == "br" and brotli is None:
+                continue
+            compressed = brotli.compress(data, quality=11) if encoding == "br" else gzip.compress(data, 9)
+            if len(compressed) >= len(data):
+                continue
+            _write_atomic(target + suffix, compressed)
+        available.append(encoding)
+    return available
+
+
+def build(root=None, prune=True, only=None):
+    """
+    构建全部静态文件，内容未变的文件不重复处理。
+    :param only: 只构建这些文件（相对路径的集合），如 static_usage 分析出的可达文件。
+    :param prune: 删除既不在新清单、也不在上一版清单中的旧文件（保留上一版，已打开的页面仍能加载）。
+    :return: 新的清单。
+    """
+    root = root or app.static_folder
+    output = build_dir()
+    previous = _read_manifest(os.path.join(output, MANIFEST_NAME)) or {}
+    files = {}
+    for path in source_files(root):
+        if only is not None and path not in only:
+            continue
+        source = os.path.join(root, path)
+        hashed = fingerprinted_name(path, _file_digest(source))
+        target = os.path.join(output, hashed)
+        if not os.path.exists(target):
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.copyfile(source, target)
+        encodings = []
+        if path.lower().endswith(COMPRESSIBLE) and os.path.getsize(target) >= MIN_COMPRESS_SIZE:
+            encodings = _compress(target)
+        files[path] = {"path": hashed, "encodings": encodings}
+    manifest = {"built": time.time(), "files": files}
+    os.makedirs(output, exist_ok=True)
+    _write_atomic(os.path.join(output, MANIFEST_NAME), json.dumps(manifest, indent=1, sort_keys=True).encode("utf8"))
+    if prune:
+        keep = set(entry["path"] for entry in files.values())
+        keep.update(entry["path"] for entry in previous.get("files", {}).values())
+        _prune(output, keep)
+    return manifest
+
+
+def _prune(output, keep):
+    for directory, _, filenames in os.walk(output):
+        for name in filenames:
+            path = os.path.relpath(os.path.join(directory, name), output).replace(os.sep, "/")
+            base = path
+            for _, suffix in ENCODINGS:
+                if base.endswith(suffix):
+                    base = base[:-len(suffix)]
+                    break
+            if path != MANIFEST_NAME and base not in keep:
+                os.remove(os.path.join(directory, name))
+
+
+def _read_manifest(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, IOError, ValueError):
+        return None
+
+
+class Manifest(object):
+    """进程内缓存的清单，清单文件更新后自动重新加载。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._checked = 0
+        self._mtime = None
+        self._files = {}
+        self._hashed = {}
+
+    def _refresh(self):
+        now = time.time()
+        if now - self._checked < _RELOAD_CHECK:
+            return
+        with self._lock:
+            self._checked = now
+            path = os.path.join(build_dir(), MANIFEST_NAME)
+            try:
+                mtime = os.path.getmtime(path)
+            except OSError:
+                mtime = None
+            if mtime == self._mtime:
+                return
+            manifest = _read_manifest(path) if mtime is not None else None
+            files = (manifest or {}).get("files", {})
+            self._files = files
+            self._hashed = dict((entry["path"], entry) for entry in files.values())
+            self._mtime = mtime
+
+    def lookup(self, filename):
+        """:return: 原文件名对应的带摘要文件名，不在清单中时为 None。"""
+        self._refresh()
+        entry = self._files.get(filename)
+        return entry["path"] if entry else None
+
+    def entry(self, hashed):
+        """:return: 带摘要文件名对应的清单项，不是构建出的文件时为 None。"""
+        self._refresh()
+        return self._hashed.get(hashed)
+
+
+manifest = Manifest()
+
+
+@app.url_defaults
+def _fingerprint_static_url(endpoint, values):
+    if endpoint == "static" and values.get("filename"):
+        hashed = manifest.lookup(values["filename"])
+        if hashed is not None:
+            values["filename"] = hashed
+
+
+def serve_static(filename):
+    """替换默认的 static 视图：带摘要的地址返回构建出的文件，其余照常。"""
+    entry = manifest.entry(filename)
+    if entry is None:
+        return app.send_static_file(filename)
+    path = os.path.join(build_dir(), filename)
+    mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    content_encoding = None
+    for encoding, suffix in ENCODINGS:
+        if encoding in entry["encodings"] and request.accept_encodings[encoding]:
+            path, content_encoding = path + suffix, encoding
+            break
+    response = send_file(path, mimetype=mimetype, conditional=True)
+    if content_encoding:
+        response.headers["Content-Encoding"] = content_encoding
+    if entry["encodings"]:
+        response.vary.add("Accept-Encoding")
+    response.headers["Cache-Control"] = "public, max-age=%d, immutable" % IMMUTABLE_MAX_AGE
+    response.expires = time.time() + IMMUTABLE_MAX_AGE
+    return response
+
+
+app.view_functions["static"] = serve_static
+
+
+@app.cli.command("build-static")
+@click.option("--no-prune", is_flag=True, help="保留所有旧版本的构建文件。")
+@click.option("--reachable-only", is_flag=True, help="只构建被模板直接或间接引用的文件。")
+def build_static_command(no_prune, reachable_only):
+    """为静态文件生成带内容摘要的文件名和预压缩版本。"""
+    only = None
+    if reachable_only:
+        from app.static_usage import analyze
+        only = analyze().reachable
+    manifest_data = build(prune=not no_prune, only=only)
+    files = manifest_data["files"]
+    click.echo("共 %d 个文件，其中 %d 个有压缩版本%s" % (
+        len(files), sum(1 for entry in files.values() if entry["encodings"]),
+        "" if brotli is not None else "（未安装 brotli，只生成 gzip）"
+    ))
@@ -0,0 +1,162 @@
+# coding:utf8
+"""
+异步批量写入的审计日志（会员登录日志、管理员登录日志、操作日志）。
+
+在登录和每个后台操作中同步 INSERT 再 COMMIT 会给每个请求多加一次数据库往返。
+这里把日志记录放进内存中的有界队列，立即返回；后台线程按 AUDIT_LOG_FLUSH_INTERVAL
+秒或累计 AUDIT_LOG_FLUSH_THRESHOLD 条时，按表分组用一条多行 INSERT 批量写入。
+进程退出时写完队列中剩余的记录。
+
+队列满（超过 AUDIT_LOG_QUEUE_SIZE 条，通常是数据库不可用）时按 AUDIT_LOG_OVERFLOW
+处理：
+    "block"       请求线程最多等待 AUDIT_LOG_BLOCK_TIMEOUT 秒，仍无空位则丢弃本条；
+    "drop_newest" 直接丢弃本条；
+    "drop_oldest" 丢弃队列中最早的一条，腾出位置。
+丢弃的条数记在 dropped 中并写入应用日志。
+"""
+import logging
+import threading
+import time
+from collections import deque, OrderedDict
+from datetime import datetime
+from flask import request, session
+from app import db, app
+from app.models import Admin, Userlog, Adminlog, Operationlog
+from app.background import BackgroundFlusher
+
+logger = logging.getLogger(__name__)
+
+# 单条 INSERT 语句最多写入的行数
+BATCH_SIZE = 500
+# AUDIT_LOG_OVERFLOW 的可选值
+OVERFLOW_POLICIES = ("block", "drop_newest", "drop_oldest")
+
+
+def configure():
+    """在 create_app() 中调用，AUDIT_LOG_OVERFLOW 写错时启动失败，而不是队列满时才发现。"""
+    policy = app.config.get("AUDIT_LOG_OVERFLOW", "block")
+    if policy not in OVERFLOW_POLICIES:
+        raise ValueError("AUDIT_LOG_OVERFLOW 不能为 %r，可选：%s" % (policy, "、".join(OVERFLOW_POLICIES)))
+
+
+class AuditLogWriter(BackgroundFlusher):
+    """
+    日志记录的有界队列，由后台线程批量写入数据库。
+    """
+    interval_key = "AUDIT_LOG_FLUSH_INTERVAL"
+
+    def __init__(self):
+        super(AuditLogWriter, self).__init__()
+        self._queue = deque()
+        self._not_full = threading.Condition(threading.Lock())
+        self.dropped = 0
+
+    def _reset(self):
+        self._queue = deque()
+        self._not_full = threading.Condition(threading.Lock())
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self._queue)
+
+    def put(self, model, **values):
+        """
+        记录一条日志，不访问数据库。
+        :param model: 日志模型，如 Userlog。
+        :param values: 列值；add_time 缺省为当前时间（而不是写入数据库的时间）。
+        :return: 是否已放入队列（队列满且被丢弃时为 False）。
+        """
+        self._ensure_flusher()
+        values.setdefault("add_time", datetime.now())
+        config = app.config
+        limit = config.get("AUDIT_LOG_QUEUE_SIZE", 10000)
+        policy = config.get("AUDIT_LOG_OVERFLOW", "block")
+        with self._not_full:
+            if len(self._queue) >= limit:
+                self._wakeup.set()
+                if policy == "block":
+                    deadline = time.time() + config.get("AUDIT_LOG_BLOCK_TIMEOUT", 0.5)
+                    while len(self._queue) >= limit:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            break
+                        self._not_full.wait(remaining)
+                if len(self._queue) >= limit:
+                    self.dropped += 1
+                    if policy != "drop_oldest":
+                        logger.warning("审计日志队列已满，丢弃一条 %s 记录", model.__tablename__)
+                        return False
+                    self._queue.popleft()
+                    logger.warning("审计日志队列已满，丢弃最早的一条记录")
+            self._queue.append((model.__table__, values))
+            size = len(self._queue)
+        if size >= config.get("AUDIT_LOG_FLUSH_THRESHOLD", 500):
+            self._wakeup.set()
+        return True
+
+    def flush(self):
+        """
+        把队列中的记录批量写入数据库。
+        :return: 写入的条数。
+        """
+        with self._flush_lock:
+            with self._not_full:
+                records = list(self._queue)
+                self._queue.clear()
+                self._not_full.notify_all()
+            if not records:
+                return 0
+            # 同一张表、同样列的记录合并为一条多行 INSERT
+            grouped = OrderedDict()
+            for table, values in records:
+                grouped.setdefault((table, tuple(sorted(values))), []).append(values)
+            try:
+                with db.engine.begin() as connection:
+                    for (table, _), rows in grouped.items():
+                        for i in range(0, len(rows), BATCH_SIZE):
+                            connection.execute(table.insert(), rows[i:i + BATCH_SIZE])
+            except Exception:
+                logger.exception("写入审计日志失败，稍后重试")
+                self._requeue(records)
+                return 0
+            return len(records)
+
+    def _requeue(self, records):
+        """写入失败时把记录放回队首；放不下时丢弃最早的记录。"""
+        limit = app.config.get("AUDIT_LOG_QUEUE_SIZE", 10000)
+        with self._not_full:
+            self._queue.extendleft(reversed(records))
+            while len(self._queue) > limit:
+                self._queue.popleft()
+                self.dropped += 1
+
+
+audit_log = AuditLogWriter()
+
+
+def log_user_login(user_id):
+    """会员登录成功后调用。"""
+    audit_log.put(Userlog, user_id=user_id, ip=request.remote_addr)
+
+
+def log_admin_login(admin_id):
+    """管理员登录成功后调用。"""
+    audit_log.put(Adminlog, admin_id=admin_id, ip=request.remote_addr)
+
+
+def current_admin_id():
+    """当前登录的管理员编号；旧会话中只有管理员账号时查询一次并补入会话。"""
+    admin_id = session.get("admin_id")
+    if admin_id is None and "current_client" in session:
+        admin = Admin.query.filter_by(name=session["current_client"]).first()
+        if admin is not None:
+            admin_id = session["admin_id"] = admin.id
+    return admin_id
+
+
+def log_operation(reason):
+    """
+    后台的增、删、改操作成功后调用。
+    :param reason: 操作说明，超过 100 个字符的部分被截断。
+    """
+    audit_log.put(Operationlog, admin_id=current_admin_id(), ip=request.remote_addr, reason=reason[:100])
@@ -0,0 +1,76 @@
+# coding:utf8
+"""
+在每个进程中用一个后台线程定期写回的缓冲区。
+
+播放次数、观众草图、操作日志等都先缓冲在内存中，由后台线程按时间间隔写回。
+gunicorn 等预先 fork 的服务器会在父进程中导入应用，子进程从父进程继承缓冲区
+和锁，却没有继承线程，所以后台线程在每个进程第一次写入时才启动。
+"""
+import abc
+import atexit
+import os
+import threading
+from app import app
+
+
+class BackgroundFlusher(abc.ABC):
+    """
+    在每个进程中用一个后台线程定期调用 flush() 的缓冲区基类。
+    子类必须实现 flush() 和 _reset()，并在写入缓冲区前调用 _ensure_flusher()；
+    子类还必须声明 interval_key，即表示写回间隔秒数的配置项名称，
+    interval_default 是未配置时的间隔。
+    """
+    interval_key = None
+    interval_default = 5
+
+    def __init__(self):
+        if self.interval_key is None:
+            raise TypeError("%s 没有声明 interval_key" % type(self).__name__)
+        self._wakeup = threading.Event()
+        self._flush_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._pid = None
+        self._thread = None
+        atexit.register(self._flush_at_exit)
+
+    @abc.abstractmethod
+    def flush(self):
+        """把缓冲区中的内容写回。"""
+
+    @abc.abstractmethod
+    def _reset(self):
+        """
+        丢弃缓冲区中的内容，fork 后在子进程中调用。
+        fork 时其他线程可能正持有缓冲区的锁，子进程中要一并重新创建。
+        """
+
+    def _ensure_flusher(self):
+        """
+        在当前进程中启动后台写回线程；fork 出的子进程会各自启动一个，
+        并丢弃从父进程继承的缓冲内容（它们由父进程负责写回）。
+        """
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._start_lock:
+            if self._pid == pid:
+                return
+            if self._pid is not None:
+                self._reset()
+                self._flush_lock = threading.Lock()
+            self._pid = pid
+            self._wakeup = threading.Event()
+            self._thread = threading.Thread(target=self._run, name="%s-flusher" % type(self).__name__)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(app.config.get(self.interval_key, self.interval_default))
+            self._wakeup.clear()
+            self.flush()
+
+    def _flush_at_exit(self):
+        # 进程正常退出（包括 gunicorn 工作进程收到 SIGTERM 后的退出）时写完剩余内容
+        if self._pid == os.getpid():
+            self.flush()
@@ -0,0 +1,111 @@
+# coding:utf8
+"""
+用户收藏集合的缓存。
+
+电影列表中的每张卡片都要显示“是否已收藏”，逐个查询 collection 表相当于每张卡片
+一次查询。这里把一个用户收藏的全部电影编号一次查出，作为集合缓存在进程内
+（LRU，按用户编号），同一页面上任意多部电影的判断只需要读一次版本号，
+缓存失效时再多一次查询。
+
+收藏或取消收藏时，在同一事务中把 cacheversion 表中“collection:<用户编号>”的版本号
+加一（见 app.versions）。每个请求读取一次这个版本号，与缓存不一致就重新加载，
+同一用户在其他设备、其他工作进程中的修改都能立即看到。
+"""
+import threading
+from collections import OrderedDict
+from flask import g, current_app
+from sqlalchemy.exc import IntegrityError
+from app import db
+from app.models import Collection
+from app.versions import read_version, bump_version
+
+_cache = OrderedDict()  # 用户编号 -> (版本号, frozenset(电影编号))
+_cache_lock = threading.Lock()
+
+
+def version_name(user_id):
+    return "collection:%d" % user_id
+
+
+def _load(user_id):
+    rows = db.session.query(Collection.movie_id).filter(Collection.user_id == user_id).all()
+    return frozenset(row[0] for row in rows)
+
+
+def collected_movie_ids(user_id):
+    """
+    :return: 用户收藏的全部电影编号（frozenset），每个请求最多查询一次数据库。
+    """
+    per_request = g.setdefault("_collected_movie_ids", {})
+    if user_id in per_request:
+        return per_request[user_id]
+    version = read_version(version_name(user_id))
+    with _cache_lock:
+        cached = _cache.get(user_id)
+        if cached is not None and cached[0] == version:
+            _cache.move_to_end(user_id)
+            per_request[user_id] = cached[1]
+            return cached[1]
+    ids = _load(user_id)
+    with _cache_lock:
+        _cache[user_id] = (version, ids)
+        _cache.move_to_end(user_id)
+        while len(_cache) > current_app.config.get("COLLECTION_CACHE_SIZE", 10000):
+            _cache.popitem(last=False)
+    per_request[user_id] = ids
+    return ids
+
+
+def is_collected(user_id, movie_id):
+    if user_id is None:
+        return False
+    return movie_id in collected_movie_ids(user_id)
+
+
+def collected_many(user_id, movie_ids):
+    """
+    批量判断收藏状态。
+    :return: {电影编号: 是否已收藏}。
+    """
+    if user_id is None:
+        return dict((movie_id, False) for movie_id in movie_ids)
+    ids = collected_movie_ids(user_id)
+    return dict((movie_id, movie_id in ids) for movie_id in movie_ids)
+
+
+def _forget(user_id):
+    """丢弃本进程和本请求中缓存的集合。"""
+    with _cache_lock:
+        _cache.pop(user_id, None)
+    g.setdefault("_collected_movie_ids", {}).pop(user_id, None)
+
+
+def add_collection(user_id, movie_id):
+    """
+    收藏电影，已收藏时不做任何事。
+    :return: 是否新增了收藏。
+    """
+    db.session.add(Collection(user_id=user_id, movie_id=movie_id))
+    try:
+        db.session.flush()
+    except IntegrityError:
+        # (user_id, movie_id) 唯一索引冲突，说明已经收藏过
+        db.session.rollback()
+        return False
+    bump_version(db.session.connection(), version_name(user_id))
+    db.session.commit()
+    _forget(user_id)
+    return True
+
+
+def remove_collection(user_id, movie_id):
+    """
+    取消收藏。
+    :return: 是否删除了收藏。
+    """
+    deleted = Collection.query.filter_by(user_id=user_id, movie_id=movie_id).delete(synchronize_session=False)
+    if deleted:
+        bump_version(db.session.connection(), version_name(user_id))
+    db.session.commit()
+    _forget(user_id)
+    return bool(deleted)
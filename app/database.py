@@ -0,0 +1,303 @@
+# coding:utf8
+"""
+数据库连接与多进程。
+
+预先 fork 的部署方式（gunicorn --preload 等）在主进程中加载应用后再 fork 出工作进程，
+如果主进程已经建立过连接，子进程会从继承来的连接池中取出同一个套接字，多个进程
+同时读写一个 MySQL 连接，结果互相错乱。这里按 SQLAlchemy 文档的做法：
+    - 每个连接建立时记录所属进程号；
+    - 从连接池取出连接时如果进程号不同，丢弃这个连接（不关闭，关闭会影响父进程），
+      连接池随后重新建立一个；
+    - 主进程在 fork 之前调用 dispose_engine() 关闭已有的连接。
+连接池对所有引擎生效，包括后台线程和命令行命令使用的连接。
+
+连接池的大小、溢出、回收、pre-ping 和等待超时由 DB_POOL_* 配置（见 app/config.py），
+每个工作进程各有一个连接池，整个服务最多占用
+    工作进程数 × (DB_POOL_SIZE + DB_POOL_MAX_OVERFLOW)
+个 MySQL 连接。各进程记录取连接的等待时间、超时次数、使用中和溢出的连接数，每隔
+DB_POOL_METRICS_INTERVAL 秒写到 DB_POOL_METRICS_DIR（默认 instance/pool_metrics）下
+以进程号命名的文件中，flask pool-stats 和后台“SQL 性能分析”页面汇总显示全部进程。
+"""
+import json
+import logging
+import os
+import threading
+import time
+import click
+from sqlalchemy import event, exc
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import Pool, QueuePool
+from app import app, db
+from app.background import BackgroundFlusher
+
+logger = logging.getLogger(__name__)
+
+
+@event.listens_for(Pool, "connect")
+def _record_pid(dbapi_connection, connection_record):
+    connection_record.info["pid"] = os.getpid()
+
+
+@event.listens_for(Pool, "checkout")
+def _check_pid(dbapi_connection, connection_record, connection_proxy):
+    pid = os.getpid()
+    if connection_record.info.get("pid", pid) != pid:
+        # 父进程的连接：不关闭，直接丢弃，让连接池重新连接
+        connection_record.connection = connection_proxy.connection = None
+        raise exc.DisconnectionError(
+            "连接属于进程 %s，当前进程 %s，重新连接" % (connection_record.info["pid"], pid)
+        )
+
+
+def engines():
+    """:return: 已经创建的引擎（Flask-SQLAlchemy 在第一次使用时才创建）。"""
+    state = app.extensions.get("sqlalchemy")
+    if state is None:
+        return []
+    return [connector._engine for connector in state.connectors.values() if connector._engine is not None]
+
+
+def dispose_engine():
+    """关闭连接池中的全部连接，在 fork 工作进程之前调用。:return: 关闭的引擎数。"""
+    disposed = engines()
+    for engine in disposed:
+        engine.dispose()
+    return len(disposed)
+
+
+def engine_options(config):
+    """:return: 按 DB_POOL_* 配置生成的 create_engine() 参数。"""
+    options = {"pool_pre_ping": config.get("DB_POOL_PRE_PING", False)}
+    if make_url(config["SQLALCHEMY_DATABASE_URI"]).get_backend_name() == "sqlite":
+        # SQLite 不使用 QueuePool，由 Flask-SQLAlchemy 选择合适的连接池
+        return options
+    options.update(
+        poolclass=MeteredQueuePool,
+        pool_size=config.get("DB_POOL_SIZE", 10),
+        max_overflow=config.get("DB_POOL_MAX_OVERFLOW", 10),
+        pool_recycle=config.get("DB_POOL_RECYCLE", 7200),
+        pool_timeout=config.get("DB_POOL_TIMEOUT", 30),
+    )
+    return options
+
+
+def configure():
+    """在 db.init_app() 之前调用；SQLALCHEMY_ENGINE_OPTIONS 中直接给出的参数优先。"""
+    options = engine_options(app.config)
+    options.update(app.config.get("SQLALCHEMY_ENGINE_OPTIONS") or {})
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = options
+
+
+class PoolStats(object):
+    """一个连接池在当前进程中的累计统计。"""
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.peak_in_use = 0
+        self.peak_overflow = 0
+
+    def record(self, elapsed, in_use, overflow):
+        with self.lock:
+            self.checkouts += 1
+            self.wait_total += elapsed
+            self.wait_max = max(self.wait_max, elapsed)
+            self.peak_in_use = max(self.peak_in_use, in_use)
+            self.peak_overflow = max(self.peak_overflow, overflow)
+
+
+class MeteredQueuePool(QueuePool):
+    """记录取连接耗时（等待空闲连接或建立新连接）的 QueuePool。"""
+
+    def __init__(self, *args, **kwargs):
+        super(MeteredQueuePool, self).__init__(*args, **kwargs)
+        self._stats = PoolStats()
+        self._local = threading.local()
+
+    @property
+    def stats(self):
+        # fork 出的子进程从零开始统计
+        if self._stats.pid != os.getpid():
+            self._stats = PoolStats()
+        return self._stats
+
+    def _do_get(self):
+        # QueuePool 在溢出名额被抢走时会递归调用 _do_get()，只统计最外层
+        if getattr(self._local, "metering", False):
+            return super(MeteredQueuePool, self)._do_get()
+        stats = self.stats
+        self._local.metering = True
+        start = time.time()
+        try:
+            record = super(MeteredQueuePool, self)._do_get()
+        except exc.TimeoutError:
+            with stats.lock:
+                stats.timeouts += 1
+            raise
+        finally:
+            self._local.metering = False
+        stats.record(time.time() - start, self.checkedout(), max(self.overflow(), 0))
+        return record
+
+
+def pool_status():
+    """:return: 当前进程各连接池的状态，元素为 dict。"""
+    result = []
+    for engine in engines():
+        pool = engine.pool
+        if not isinstance(pool, QueuePool):
+            continue
+        entry = {
+            "database": repr(engine.url),
+            "size": pool.size(),
+            "max_overflow": pool._max_overflow,
+            "in_use": pool.checkedout(),
+            "idle": pool.checkedin(),
+            "overflow": max(pool.overflow(), 0),
+        }
+        if isinstance(pool, MeteredQueuePool):
+            stats = pool.stats
+            with stats.lock:
+                entry.update(
+                    checkouts=stats.checkouts,
+                    timeouts=stats.timeouts,
+                    wait_avg_ms=stats.wait_total / stats.checkouts * 1000 if stats.checkouts else 0.0,
+                    wait_max_ms=stats.wait_max * 1000,
+                    peak_in_use=stats.peak_in_use,
+                    peak_overflow=stats.peak_overflow,
+                )
+        result.append(entry)
+    return result
+
+
+def warm_up(count=None):
+    """
+    预先建立连接放回连接池，工作进程的第一批请求不必等待连接 MySQL。
+    :param count: 连接数，默认为 DB_POOL_WARMUP（不超过 DB_POOL_SIZE）。
+    :return: 建立的连接数。
+    """
+    if count is None:
+        count = min(app.config.get("DB_POOL_WARMUP", 0), app.config.get("DB_POOL_SIZE", 10))
+    connections = []
+    try:
+        for _ in range(count):
+            connections.append(db.engine.raw_connection())
+    except Exception as e:
+        logger.warning("预先建立数据库连接失败：%s", e)
+    finally:
+        for connection in connections:
+            connection.close()
+    return len(connections)
+
+
+def metrics_dir():
+    return app.config.get("DB_POOL_METRICS_DIR", os.path.join(app.instance_path, "pool_metrics"))
+
+
+class PoolMetricsPublisher(BackgroundFlusher):
+    """定期把本进程的连接池状态写到 metrics_dir() 下，进程退出时删除。"""
+    interval_key = "DB_POOL_METRICS_INTERVAL"
+    interval_default = 10
+
+    def _reset(self):
+        pass
+
+    def ensure_started(self):
+        self._ensure_flusher()
+
+    def _path(self):
+        return os.path.join(metrics_dir(), "%d.json" % os.getpid())
+
+    def flush(self):
+        status = pool_status()
+        if not status:
+            return None
+        snapshot = {"pid": os.getpid(), "time": time.time(), "pools": status}
+        path = self._path()
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + ".tmp", "w") as f:
+                json.dump(snapshot, f)
+            os.replace(path + ".tmp", path)
+        except OSError as e:
+            logger.warning("写入连接池统计失败：%s", e)
+        return snapshot
+
+    def _flush_at_exit(self):
+        if self._pid == os.getpid():
+            try:
+                os.remove(self._path())
+            except OSError:
+                pass
+
+
+publisher = PoolMetricsPublisher()
+
+
+@app.before_request
+def _start_publisher():
+    if app.config.get("DB_POOL_METRICS_INTERVAL", 10):
+        publisher.ensure_started()
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def worker_metrics():
+    """:return: 各进程最近一次写出的连接池状态，按进程号排序；已退出进程的文件顺带删除。"""
+    directory = metrics_dir()
+    try:
+        names = sorted(os.listdir(directory))
+    except OSError:
+        return []
+    result = []
+    for name in names:
+        if not name.endswith(".json"):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            with open(path) as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if not _alive(snapshot["pid"]):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            continue
+        result.append(snapshot)
+    return sorted(result, key=lambda snapshot: snapshot["pid"])
+
+
+@app.cli.command("pool-stats")
+def pool_stats_command():
+    """显示各工作进程的数据库连接池统计。"""
+    snapshots = worker_metrics()
+    total_connections = total_limit = 0
+    for snapshot in snapshots:
+        for pool in snapshot["pools"]:
+            connections = pool["in_use"] + pool["idle"]
+            total_connections += connections
+            total_limit += pool["size"] + pool["max_overflow"]
+            click.echo(
+                "进程 %d（%d 秒前）：连接 %d/%d，使用中 %d（峰值 %d），溢出 %d（峰值 %d），"
+                "取连接 %d 次，平均等待 %.1fms，最长 %.1fms，超时 %d 次" % (
+                    snapshot["pid"], time.time() - snapshot["time"], connections,
+                    pool["size"] + pool["max_overflow"], pool["in_use"], pool.get("peak_in_use", 0),
+                    pool["overflow"], pool.get("peak_overflow", 0), pool.get("checkouts", 0),
+                    pool.get("wait_avg_ms", 0.0), pool.get("wait_max_ms", 0.0), pool.get("timeouts", 0),
+                )
+            )
+    click.echo("共 %d 个进程，占用 %d 个连接，最多 %d 个" % (len(snapshots), total_connections, total_limit))
@@ -0,0 +1,257 @@
+# coding:utf8
+"""
+DataTables 服务器端处理（server-side processing）接口。
+
+按照 DataTables 1.10 的协议解析 draw / start / length / search / order / columns 参数，
+把搜索、排序和分页全部转换为 SQL。只允许在有索引的列上排序，搜索使用前缀匹配
+（LIKE 'xxx%'），保证能走索引，浏览器不需要一次拉取整张表。
+"""
+from flask import url_for
+from markupsafe import escape
+from sqlalchemy import or_
+from app.models import User, Userlog, Tag, Movie, Preview, Comment, Collection, Authority, Role, Admin, Adminlog, \
+    Operationlog
+from app.pagination import cached_count
+from app.querying import join_eager
+from app.counters import view_counter
+
+# 每次请求最多返回的行数
+MAX_LENGTH = 100
+
+
+class DataTableError(Exception):
+    """请求参数不合法，按协议以 error 字段返回给前端。"""
+
+
+class Column(object):
+    """
+    表格中的一列。
+    :param name: 列名，对应前端 columns[i][data]。
+    :param expr: 对应的 SQL 列，用于搜索和排序。
+    :param value: 从一行记录中取值的函数。
+    :param searchable: 是否参与搜索，只应对有索引的字符串列开启。
+    :param orderable: 是否允许排序，只应对有索引的列开启。
+    """
+
+    def __init__(self, name, expr=None, value=None, searchable=False, orderable=False):
+        self.name = name
+        self.expr = expr
+        self.value = value or (lambda row: getattr(row, name))
+        self.searchable = searchable and expr is not None
+        self.orderable = orderable and expr is not None
+
+
+class DataSource(object):
+    """
+    一个可供 DataTables 查询的数据源。
+    :param model: 主模型，需有 id 和 add_time 列。
+    :param columns: Column 列表。
+    :param joins: 搜索或显示时需要连接的关联属性，连接的结果同时用于填充关联对象。
+    :param outerjoins: 同 joins，但关联可能为空（外连接）。
+    :param endpoint: 对应的后台列表页，有权访问该页的管理员才能查询此数据源。
+    """
+
+    def __init__(self, model, columns, joins=(), outerjoins=(), endpoint=None):
+        self.model = model
+        self.columns = dict((column.name, column) for column in columns)
+        self.joins = joins
+        self.outerjoins = outerjoins
+        self.endpoint = endpoint
+
+    def base_query(self):
+        query = self.model.query
+        for relationship in self.joins:
+            query = join_eager(query, relationship)
+        for relationship in self.outerjoins:
+            query = join_eager(query, relationship, outer=True)
+        return query
+
+
+def _like_prefix(value):
+    """转义 LIKE 通配符，生成前缀匹配模式。"""
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+
+def _int_arg(args, name, default):
+    try:
+        return int(args.get(name, default))
+    except (TypeError, ValueError):
+        raise DataTableError("参数 %s 不合法" % name)
+
+
+def _requested_columns(args):
+    """解析 columns[i][...] 参数，返回按下标排列的字典列表。"""
+    requested = []
+    i = 0
+    while "columns[%d][data]" % i in args:
+        prefix = "columns[%d]" % i
+        requested.append({
+            "data": args.get(prefix + "[data]"),
+            "searchable": args.get(prefix + "[searchable]", "true") == "true",
+            "orderable": args.get(prefix + "[orderable]", "true") == "true",
+            "search": args.get(prefix + "[search][value]", "").strip(),
+        })
+        i += 1
+    return requested
+
+
+def process(source, args):
+    """
+    处理一次 DataTables 请求。
+    :param source: DataSource。
+    :param args: 请求参数（request.args）。
+    :return: 可直接 jsonify 的字典。
+    """
+    draw = _int_arg(args, "draw", 0)
+    start = max(_int_arg(args, "start", 0), 0)
+    length = _int_arg(args, "length", 10)
+    if length < 0 or length > MAX_LENGTH:
+        length = MAX_LENGTH
+    requested = _requested_columns(args)
+    model = source.model
+
+    query = source.base_query()
+    records_total, _ = cached_count(query, model)
+
+    # 全局搜索：在所有可搜索列上做前缀匹配，纯数字时同时按编号精确匹配
+    value = args.get("search[value]", "").strip()
+    if value:
+        searchable = [source.columns[c["data"]] for c in requested
+                      if c["searchable"] and c["data"] in source.columns and source.columns[c["data"]].searchable]
+        clauses = [column.expr.like(_like_prefix(value), escape="\\") for column in searchable]
+        if value.isdigit():
+            clauses.append(model.id == int(value))
+        if not clauses:
+            return {"draw": draw, "recordsTotal": records_total, "recordsFiltered": 0, "data": []}
+        query = query.filter(or_(*clauses))
+    # 按列搜索
+    for c in requested:
+        column = source.columns.get(c["data"])
+        if c["search"] and column is not None and column.searchable:
+            query = query.filter(column.expr.like(_like_prefix(c["search"]), escape="\\"))
+
+    records_filtered = records_total
+    if query.whereclause is not None:
+        records_filtered, _ = cached_count(query, model)
+
+    # 排序：只接受可排序的列，最后以编号兜底保证分页稳定
+    ordering = []
+    i = 0
+    while "order[%d][column]" % i in args:
+        index = _int_arg(args, "order[%d][column]" % i, 0)
+        direction = args.get("order[%d][dir]" % i, "asc")
+        i += 1
+        if index < 0 or index >= len(requested) or not requested[index]["orderable"]:
+            raise DataTableError("第 %d 列不能排序" % index)
+        column = source.columns.get(requested[index]["data"])
+        if column is None or not column.orderable:
+            raise DataTableError("第 %d 列不能排序" % index)
+        ordering.append(column.expr.desc() if direction == "desc" else column.expr.asc())
+    if not ordering:
+        ordering = [model.add_time.desc()]
+    ordering.append(model.id.desc())
+
+    rows = query.order_by(*ordering).offset(start).limit(length).all()
+    data = []
+    for row in rows:
+        item = {}
+        for name, column in source.columns.items():
+            cell = column.value(row)
+            item[name] = "" if cell is None else (cell if isinstance(cell, (int, float)) else str(escape(cell)))
+        data.append(item)
+    return {
+        "draw": draw,
+        "recordsTotal": records_total,
+        "recordsFiltered": records_filtered,
+        "data": data,
+    }
+
+
+def _time(row):
+    return str(row.add_time)
+
+
+SOURCES = {
+    "movie": DataSource(Movie, [
+        Column("id", Movie.id, orderable=True),
+        Column("title", Movie.title, searchable=True, orderable=True),
+        Column("length"),
+        Column("tag", Tag.name, value=lambda row: row.tag.name, searchable=True),
+        Column("area"),
+        Column("rating"),
+        Column("views", value=lambda row: (row.views or 0) + view_counter.pending(row.id)),
+        Column("review_num"),
+        Column("add_time", Movie.add_time, value=_time, orderable=True),
+        Column("update_url", value=lambda row: url_for("admin.movie_update", movie_id=row.id)),
+        Column("delete_url", value=lambda row: url_for("admin.movie_delete", movie_id=row.id)),
+    ], joins=(Movie.tag,), endpoint="admin.movie_list"),
+    "tag": DataSource(Tag, [
+        Column("id", Tag.id, orderable=True),
+        Column("name", Tag.name, searchable=True, orderable=True),
+        Column("add_time", Tag.add_time, value=_time, orderable=True),
+    ], endpoint="admin.tag_list"),
+    "preview": DataSource(Preview, [
+        Column("id", Preview.id, orderable=True),
+        Column("title", Preview.title, searchable=True, orderable=True),
+        Column("cover"),
+        Column("add_time", Preview.add_time, value=_time, orderable=True),
+    ], endpoint="admin.preview_list"),
+    "user": DataSource(User, [
+        Column("id", User.id, orderable=True),
+        Column("name", User.name, searchable=True, orderable=True),
+        Column("email", User.email, searchable=True, orderable=True),
+        Column("phone", User.phone, searchable=True, orderable=True),
+        Column("avatar"),
+        Column("add_time", User.add_time, value=_time, orderable=True),
+    ], endpoint="admin.user_list"),
+    "comment": DataSource(Comment, [
+        Column("id", Comment.id, orderable=True),
+        Column("user", User.name, value=lambda row: row.user.name, searchable=True),
+        Column("movie", Movie.title, value=lambda row: row.movie.title, searchable=True),
+        Column("content"),
+        Column("add_time", Comment.add_time, value=_time, orderable=True),
+    ], joins=(Comment.user, Comment.movie), endpoint="admin.comments_list"),
+    "collection": DataSource(Collection, [
+        Column("id", Collection.id, orderable=True),
+        Column("movie", Movie.title, value=lambda row: row.movie.title, searchable=True),
+        Column("user", User.name, value=lambda row: row.user.name, searchable=True),
+        Column("add_time", Collection.add_time, value=_time, orderable=True),
+    ], joins=(Collection.user, Collection.movie), endpoint="admin.collection_list"),
+    "userlog": DataSource(Userlog, [
+        Column("id", Userlog.id, orderable=True),
+        Column("user", User.name, value=lambda row: row.user.name, searchable=True),
+        Column("add_time", Userlog.add_time, value=_time, orderable=True),
+        Column("ip"),
+    ], joins=(Userlog.user,), endpoint="admin.user_login_log_list"),
+    "adminlog": DataSource(Adminlog, [
+        Column("id", Adminlog.id, orderable=True),
+        Column("admin", Admin.name, value=lambda row: row.admin.name, searchable=True),
+        Column("add_time", Adminlog.add_time, value=_time, orderable=True),
+        Column("ip"),
+    ], joins=(Adminlog.admin,), endpoint="admin.admin_login_log_list"),
+    "operationlog": DataSource(Operationlog, [
+        Column("id", Operationlog.id, orderable=True),
+        Column("admin", Admin.name, value=lambda row: row.admin.name, searchable=True),
+        Column("add_time", Operationlog.add_time, value=_time, orderable=True),
+        Column("reason"),
+        Column("ip"),
+    ], joins=(Operationlog.admin,), endpoint="admin.operations_log_list"),
+    "role": DataSource(Role, [
+        Column("id", Role.id, orderable=True),
+        Column("name", Role.name, searchable=True, orderable=True),
+        Column("add_time", Role.add_time, value=_time, orderable=True),
+    ], endpoint="admin.role_list"),
+    "authority": DataSource(Authority, [
+        Column("id", Authority.id, orderable=True),
+        Column("name", Authority.name, searchable=True, orderable=True),
+        Column("url", Authority.url, searchable=True, orderable=True),
+        Column("add_time", Authority.add_time, value=_time, orderable=True),
+    ], endpoint="admin.authority_list"),
+    "admin": DataSource(Admin, [
+        Column("id", Admin.id, orderable=True),
+        Column("name", Admin.name, searchable=True, orderable=True),
+        Column("is_super"),
+        Column("role", value=lambda row: row.role.name if row.role else ""),
+        Column("add_time", Admin.add_time, value=_time, orderable=True),
+    ], outerjoins=(Admin.role,), endpoint="admin.admin_list"),
+}
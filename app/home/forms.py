@@ -0,0 +1,65 @@
+# coding:utf8
+from flask_wtf import FlaskForm
+from wtforms import StringField, PasswordField, SubmitField, TextAreaField
+from wtforms.validators import DataRequired, Length
+
+
+class LoginForm(FlaskForm):
+    """会员登录表单。"""
+    contact = StringField(
+        label="账号",
+        validators=[
+            DataRequired("请输入账号！")
+        ],
+        description="用户名/邮箱/手机号码",
+        render_kw={
+            "id": "input_contact",
+            "class": "form-control input-lg",
+            "placeholder": "用户名/邮箱/手机号码",
+            "autofocus": "autofocus"
+        }
+    )
+    password = PasswordField(
+        label="密码",
+        validators=[
+            DataRequired("请输入密码！")
+        ],
+        description="密码",
+        render_kw={
+            "id": "input_password",
+            "class": "form-control input-lg",
+            "placeholder": "密码"
+        }
+    )
+    submit = SubmitField(
+        '登录',
+        render_kw={
+            "class": "btn btn-lg btn-success btn-block"
+        }
+    )
+
+
+class CommentForm(FlaskForm):
+    """电影评论表单。"""
+    content = TextAreaField(
+        label="内容",
+        validators=[
+            DataRequired("评论内容不能为空！"),
+            Length(max=5000, message="评论内容过长！")
+        ],
+        description="评论内容",
+        render_kw={
+            "id": "input_content"
+        }
+    )
+    submit = SubmitField(
+        '提交评论',
+        render_kw={
+            "class": "btn btn-success",
+            "id": "btn-sub"
+        }
+    )
+
+
+class CollectionForm(FlaskForm):
+    """收藏、取消收藏，只校验 CSRF 令牌。"""
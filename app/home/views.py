@@ -5,35 +5,162 @@ from . import home
 from flask import render_template
 from flask import redirect
 from flask import url_for
+from flask import abort
+from flask import request
+from flask import session
+from flask import flash
+from werkzeug.security import safe_join
+from sqlalchemy import or_
+from sqlalchemy.orm import joinedload, undefer
+from app import app, db
+from app.models import User, Movie, Comment, Collection
+from app.home.forms import LoginForm, CommentForm, CollectionForm
+from app.pagination import paginate_request
+from app.streaming import send_video
+from app.search import search_movies
+from app.counters import view_counter
+from app.hyperloglog import viewer_sketches
+from app.auditlog import log_user_login
+from app.passwords import verify_password, PasswordPoolBusy
+from app.collection_cache import is_collected, add_collection, remove_collection
+from app.replicas import read_from_replica
+from app.page_cache import cached_page
+from urllib.parse import urlparse
+import os
+
+
+# 模板中判断当前用户是否收藏了某部电影，整页最多查询一次
+@home.app_template_global("is_collected")
+def is_collected_by_current_user(movie_id):
+    return is_collected(session.get("user_id"), movie_id)
+
+
+# 只接受本站的地址，避免登录等页面被用作跳转到外站的链接
+def _next_url():
+    target = request.args.get("next", "")
+    if not target or "\\" in target or target.startswith("//"):
+        return None
+    parts = urlparse(target)
+    if parts.scheme in ("http", "https") and parts.netloc == request.host:
+        return target
+    if not parts.scheme and not parts.netloc and target.startswith("/"):
+        return target
+    return None
 
 
 @home.route("/")
+@read_from_replica
+@cached_page("movie", "tag")
 def index():
     return render_template("home/index.html")
 
 
 @home.route("/animation/")
+@read_from_replica
+@cached_page("preview")
 def animation():
     return render_template("home/animation.html")
 
 
 @home.route("/search/")
+@read_from_replica
 def search():
-    return render_template("home/search.html")
+    key = request.args.get("key", "").strip()
+    page = request.args.get("page", 1, type=int)
+    page_data = search_movies(key, page=max(page, 1), per_page=10)
+    return render_template("home/search.html", key=key, page_data=page_data)
 
 
-@home.route("/play/")
-def play():
-    return render_template("home/play.html")
+def _count_view(movie_id=None):
+    """记一次播放，播放页命中缓存时也要调用。"""
+    # 评论翻页不计入播放
+    if movie_id is None or request.method != "GET" or request.args:
+        return
+    view_counter.incr(movie_id)
+    # 登录用户按用户编号、游客按 IP 统计独立观众
+    if "user_id" in session:
+        viewer_sketches.add(movie_id, "u:%s" % session["user_id"])
+    else:
+        viewer_sketches.add(movie_id, "ip:%s" % request.remote_addr)
 
 
-@home.route("/login/")
+@home.route("/play/")
+@home.route("/play/<int:movie_id>/", methods=["GET", "POST"])
+@read_from_replica
+@cached_page("movie:{movie_id}", "tag", on_hit=_count_view)
+def play(movie_id=None):
+    if movie_id is None:
+        return render_template("home/play.html", movie=None)
+    movie = Movie.query.options(joinedload(Movie.tag), undefer(Movie.info)).get_or_404(movie_id)
+    form = CommentForm()
+    if form.validate_on_submit():
+        if "user_id" not in session:
+            flash("请先登录，才可参与评论！", "errors")
+            return redirect(url_for("home.login", next=request.url))
+        comment = Comment(
+            content=form.data["content"],
+            movie_id=movie.id,
+            user_id=session["user_id"]
+        )
+        db.session.add(comment)
+        # 评论数量与评论在同一事务中递增，播放页不必再统计评论
+        Movie.query.filter_by(id=movie.id).update(
+            {Movie.review_num: db.func.coalesce(Movie.review_num, 0) + 1},
+            synchronize_session=False
+        )
+        db.session.commit()
+        flash("评论成功！", "OK")
+        return redirect(url_for("home.play", movie_id=movie.id))
+    _count_view(movie.id)
+    page_data = paginate_request(
+        Comment.query.options(joinedload(Comment.user)).filter_by(movie_id=movie.id),
+        Comment,
+        total=movie.review_num or 0
+    )
+    return render_template("home/play.html", movie=movie, form=form, page_data=page_data,
+                           pending_views=view_counter.pending(movie.id))
+
+
+# 视频流，支持 Range 请求以便播放器拖动进度条
+@home.route("/video/<int:movie_id>/")
+def video(movie_id=None):
+    movie = Movie.query.get_or_404(movie_id)
+    path = safe_join(app.config["UP_DIR"], movie.url or "")
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    return send_video(path)
+
+
+@home.route("/login/", methods=["GET", "POST"])
 def login():
-    return render_template("home/login.html")
+    form = LoginForm()
+    if form.validate_on_submit():
+        data = form.data
+        contact = data["contact"].strip()
+        user = User.query.filter(or_(User.name == contact, User.email == contact, User.phone == contact)).first()
+        try:
+            valid, new_hash = verify_password(user.password if user else None, data["password"])
+        except PasswordPoolBusy:
+            flash("登录的人太多了，请稍后再试！", "errors")
+            return redirect(url_for("home.login", next=_next_url()))
+        if not valid:
+            flash("账号或密码错误，请重新输入！", "errors")
+            return redirect(url_for("home.login", next=_next_url()))
+        session["user_id"] = user.id
+        session["user"] = user.name
+        log_user_login(user.id)
+        if new_hash is not None:
+            # 哈希参数已调整，用新参数保存
+            user.password = new_hash
+            db.session.commit()
+        return redirect(_next_url() or url_for("home.user"))
+    return render_template("home/login.html", form=form)
 
 
 @home.route("/logout/")
 def logout():
+    session.pop("user_id", None)
+    session.pop("user", None)
     return redirect(url_for("home.login"))
 
 
@@ -54,7 +181,15 @@ def password():
 
 @home.route("/comments/")
 def comments():
-    return render_template("home/comments.html")
+    if "user_id" not in session:
+        return redirect(url_for("home.login", next=request.url))
+    page_data = paginate_request(
+        Comment.query.options(joinedload(Comment.movie), joinedload(Comment.user)).filter_by(
+            user_id=session["user_id"]
+        ),
+        Comment
+    )
+    return render_template("home/comments.html", page_data=page_data)
 
 
 @home.route("/loginlog/")
@@ -64,5 +199,35 @@ def loginlog():
 
 @home.route("/collection/")
 def collection():
-    return render_template("home/collection.html")
+    if "user_id" not in session:
+        return redirect(url_for("home.login", next=request.url))
+    page_data = paginate_request(
+        Collection.query.options(joinedload(Collection.movie).undefer("info")).filter_by(user_id=session["user_id"]),
+        Collection
+    )
+    return render_template("home/collection.html", page_data=page_data, form=CollectionForm())
+
+
+# 收藏和取消收藏会修改数据，只接受带 CSRF 令牌的 POST 请求
+@home.route("/collection/add/<int:movie_id>/", methods=["POST"])
+def collection_add(movie_id=None):
+    if "user_id" not in session:
+        return redirect(url_for("home.login", next=url_for("home.play", movie_id=movie_id)))
+    if not CollectionForm().validate_on_submit():
+        abort(400)
+    movie = Movie.query.get_or_404(movie_id)
+    if add_collection(session["user_id"], movie.id):
+        flash("收藏成功！", "OK")
+    return redirect(_next_url() or url_for("home.play", movie_id=movie.id))
+
+
+@home.route("/collection/remove/<int:movie_id>/", methods=["POST"])
+def collection_remove(movie_id=None):
+    if "user_id" not in session:
+        return redirect(url_for("home.login", next=url_for("home.play", movie_id=movie_id)))
+    if not CollectionForm().validate_on_submit():
+        abort(400)
+    if remove_collection(session["user_id"], movie_id):
+        flash("已取消收藏！", "OK")
+    return redirect(_next_url() or url_for("home.play", movie_id=movie_id))
 
@@ -13,13 +13,14 @@ class User(db.Model):
     password = db.Column(db.String(100))  # user's password
     email = db.Column(db.String(100), unique=True)  # user's email address
     phone = db.Column(db.String(11), unique=True)  # user's mobile phone number
-    info = db.Column(db.Text)  # user's signature
+    info = db.deferred(db.Column(db.Text))  # user's signature, loaded only when accessed
     avatar = db.Column(db.String(255), unique=True)  # user's profile picture
     add_time = db.Column(db.DateTime, index=True, default=datetime.now)  # registration time
     uuid = db.Column(db.String(255), unique=True)  # user's unique identifier
-    user_logs = db.relationship('Userlog', backref='user')  # key used to associate with user log table
-    comments = db.relationship('Comment', backref='user')  # key used to associate with comment table
-    collections = db.relationship('Collection', backref='user')  # key used to associate with collection table
+    user_logs = db.relationship('Userlog', backref='user', lazy='dynamic')  # key used to associate with user log table
+    comments = db.relationship('Comment', backref='user', lazy='dynamic')  # key used to associate with comment table
+    collections = db.relationship('Collection', backref='user',
+                                  lazy='dynamic')  # key used to associate with collection table
 
     def __repr__(self):
         return "<User %r>" % self.name
@@ -63,9 +64,9 @@ class Movie(db.Model):
     # __table_args__ = {'extend_existing': True}
     id = db.Column(db.Integer, primary_key=True)  # movie number
     title = db.Column(db.String(255), unique=True)  # title of the movie
-    url = db.Column(db.String(255), unique=True)  # movie playback link
-    info = db.Column(db.Text)  # introduction of the movie
-    cover = db.Column(db.String(255), unique=True)  # cover of the movie
+    url = db.Column(db.String(255), index=True)  # movie playback link, may be shared with identical uploads
+    info = db.deferred(db.Column(db.Text))  # introduction of the movie, loaded only when accessed
+    cover = db.Column(db.String(255), index=True)  # cover of the movie, may be shared with identical uploads
     rating = db.Column(db.SmallInteger)  # rating of the movie
     views = db.Column(db.BigInteger)  # number of times played
     review_num = db.Column(db.BigInteger)  # number of reviews
@@ -74,13 +75,32 @@ class Movie(db.Model):
     release_time = db.Column(db.Date)  # movie release time
     length = db.Column(db.String(100))  # the length of the movie
     add_time = db.Column(db.DateTime, index=True, default=datetime.now)  # time when the movie added to the website
-    comments = db.relationship('Comment', backref='movie')  # key used to associate with comment table
-    collections = db.relationship('Collection', backref='movie')  # key used to associate with collection table
+    comments = db.relationship('Comment', backref='movie', lazy='dynamic')  # key used to associate with comment table
+    collections = db.relationship('Collection', backref='movie',
+                                  lazy='dynamic')  # key used to associate with collection table
+    viewer_sketches = db.relationship('Viewersketch', backref='movie',
+                                      lazy='dynamic')  # key used to associate with viewer sketch table
 
     def __repr__(self):
         return "<Movie %r>" % self.title
 
 
+class Viewersketch(db.Model):
+    """
+    HyperLogLog sketch of the distinct viewers of a movie on one day.
+    """
+    __tablename__ = "viewersketch"
+    __table_args__ = (db.UniqueConstraint('movie_id', 'day'),)
+    id = db.Column(db.Integer, primary_key=True)  # sketch number
+    movie_id = db.Column(db.Integer, db.ForeignKey('movie.id'))  # movie which is watched
+    day = db.Column(db.Date, index=True)  # the day on which the views happened
+    registers = db.Column(db.LargeBinary)  # zlib-compressed HyperLogLog registers
+    add_time = db.Column(db.DateTime, index=True, default=datetime.now)  # time when the sketch is created
+
+    def __repr__(self):
+        return "<Viewersketch %r>" % self.id
+
+
 class Preview(db.Model):
     """
     Movie preview.
@@ -102,6 +122,10 @@ class Comment(db.Model):
     """
     __tablename__ = "comment"
     # __table_args__ = {'extend_existing': True}
+    __table_args__ = (
+        db.Index('ix_comment_movie_id_add_time', 'movie_id', 'add_time', 'id'),  # comments of a movie by time
+        db.Index('ix_comment_user_id_add_time', 'user_id', 'add_time', 'id'),  # comments of a user by time
+    )
     id = db.Column(db.Integer, primary_key=True)  # comment number
     content = db.Column(db.Text)  # content of the comment
     movie_id = db.Column(db.Integer, db.ForeignKey('movie.id'))  # commented movie
@@ -117,7 +141,7 @@ class Collection(db.Model):
     Movie collection.
     """
     __tablename__ = "collection"
-    # __table_args__ = {'extend_existing': True}
+    __table_args__ = (db.UniqueConstraint('user_id', 'movie_id'),)  # a user collects a movie at most once
     id = db.Column(db.Integer, primary_key=True)  # collection number
     movie_id = db.Column(db.Integer, db.ForeignKey('movie.id'))  # movie which is collected
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))  # user who collect this movie
@@ -152,6 +176,7 @@ class Role(db.Model):
     name = db.Column(db.String(100), unique=True)  # role name
     authorities = db.Column(db.String(600))  # The authorities granted to the role
     add_time = db.Column(db.DateTime, index=True, default=datetime.now)  # time when the role is added
+    admins = db.relationship('Admin', backref='role')  # key used to associate with admin table
 
     def __repr__(self):
         return "<Role %r>" % self.name
@@ -169,17 +194,14 @@ class Admin(db.Model):
     is_super = db.Column(db.SmallInteger)  # whether it is a super administrator, 0 is super administrator
     role_id = db.Column(db.Integer, db.ForeignKey('role.id'))  # the role to which the administrator belongs
     add_time = db.Column(db.DateTime, index=True, default=datetime.now)  # time when the admin is added
-    adminlogs = db.relationship('Adminlog', backref='admin')  # key used to associate with administrator log table
-    operationlogs = db.relationship('Operationlog',
-                                    backref='admin')  # key used to associate with administrator operations log table
+    adminlogs = db.relationship('Adminlog', backref='admin',
+                                lazy='dynamic')  # key used to associate with administrator log table
+    operationlogs = db.relationship('Operationlog', backref='admin',
+                                    lazy='dynamic')  # key used to associate with administrator operations log table
 
     def __repr__(self):
         return "<Admin %r>" % self.name
 
-    def check_password(self, password):
-        from werkzeug.security import check_password_hash
-        return check_password_hash(self.password, password)
-
 
 class Adminlog(db.Model):
     """
@@ -212,6 +234,37 @@ class Operationlog(db.Model):
         return "<Operationlog %r>" % self.id
 
 
+class Cacheversion(db.Model):
+    """
+    Version counters shared by all processes, used to invalidate in-process caches.
+    """
+    __tablename__ = "cacheversion"
+    # __table_args__ = {'extend_existing': True}
+    id = db.Column(db.Integer, primary_key=True)  # version number
+    name = db.Column(db.String(100), unique=True)  # name of the cache
+    version = db.Column(db.Integer, default=0)  # incremented whenever the cached data changes
+
+    def __repr__(self):
+        return "<Cacheversion %r>" % self.name
+
+
+class Mediafile(db.Model):
+    """
+    Uploaded file stored once under UP_DIR by the SHA-256 of its content.
+    """
+    __tablename__ = "mediafile"
+    # __table_args__ = {'extend_existing': True}
+    id = db.Column(db.Integer, primary_key=True)  # file number
+    hash = db.Column(db.String(64), unique=True)  # hex SHA-256 of the file content
+    path = db.Column(db.String(255), unique=True)  # path relative to UP_DIR, e.g. "ab/cd/abcd....mp4"
+    size = db.Column(db.BigInteger)  # size of the file in bytes
+    refcount = db.Column(db.Integer, default=0)  # number of columns referring to the file
+    add_time = db.Column(db.DateTime, index=True, default=datetime.now)  # time when the file was first stored
+
+    def __repr__(self):
+        return "<Mediafile %r>" % self.path
+
+
 # if __name__ == "__main__":
 #     # 创建全部表，在创建数据库后仅能运行一次
 #     db.create_all()
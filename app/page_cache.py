@@ -0,0 +1,228 @@
+# coding:utf8
+"""
+匿名访问的公开页面的整页缓存。
+
+首页、预告动画和播放页每次访问都要查询数据库并渲染模板，而未登录用户看到的内容
+都一样。用 @cached_page("movie:{movie_id}", "tag") 标记的视图：
+    - 未登录、没有待显示的提示消息的 GET/HEAD 请求，响应按主机、路径和参数缓存在
+      本进程内（LRU，最多 PAGE_CACHE_SIZE 个页面，最长 PAGE_CACHE_TTL 秒，播放次数等
+      不触发失效的数字最多滞后这么久）；
+    - 每个页面依赖若干标记，格式字符串中的 {参数} 取视图参数的值。数据修改时在同一
+      事务中把对应标记的版本号加一（cacheversion 表中名为“page:标记”的行），
+      各进程每 PAGE_CACHE_VERSION_CHECK 秒检查一次版本号，版本变化的页面重新渲染；
+    - 响应带 ETag 和 Last-Modified，浏览器带 If-None-Match/If-Modified-Since 再次访问
+      且页面未变时返回 304，不必传输页面内容。
+标记由 ORM 的修改自动得出，视图不需要手动失效：
+    Movie    movie（电影列表）、movie:<编号>
+    Tag      tag
+    Preview  preview
+    Comment  movie:<电影编号>
+页面中的 CSRF 令牌按会话生成，缓存时替换为占位符，返回时再填入当前会话的令牌；这样的页面
+每次都完整返回，不带 ETag 和 Last-Modified，浏览器不会用 304 沿用已经过期的令牌。
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import g, make_response, request, session
+from flask_wtf.csrf import generate_csrf
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from app import app
+from app.models import Movie, Tag, Preview, Comment
+from app.versions import read_versions, bump_version
+
+VERSION_PREFIX = "page:"
+_CSRF_PLACEHOLDER = b"\x00csrf-token\x00"
+
+_cache = OrderedDict()  # 缓存键 -> _Entry
+_cache_lock = threading.Lock()
+
+
+class _Entry(object):
+    __slots__ = ("body", "mimetype", "etag", "modified", "expires", "versions", "csrf")
+
+    def __init__(self, body, mimetype, versions, csrf):
+        self.body = body
+        self.mimetype = mimetype
+        self.etag = hashlib.md5(body).hexdigest()
+        self.modified = time.time()
+        self.expires = self.modified + app.config.get("PAGE_CACHE_TTL", 300)
+        self.versions = versions
+        self.csrf = csrf
+
+
+class TagVersions(object):
+    """本进程中各标记的版本号，超过 PAGE_CACHE_VERSION_CHECK 秒重新读取。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._versions = {}  # 标记 -> (版本号, 读取时间)
+
+    def current(self, tags):
+        """:return: {标记: 版本号}，需要重新读取的标记一次查询读出。"""
+        now = time.time()
+        interval = app.config.get("PAGE_CACHE_VERSION_CHECK", 2)
+        result, stale = {}, []
+        for tag in tags:
+            cached = self._versions.get(tag)
+            if cached is not None and now - cached[1] < interval:
+                result[tag] = cached[0]
+            else:
+                stale.append(tag)
+        if stale:
+            fresh = read_versions(VERSION_PREFIX + tag for tag in stale)
+            with self._lock:
+                for tag in stale:
+                    version = fresh[VERSION_PREFIX + tag]
+                    self._versions[tag] = (version, now)
+                    result[tag] = version
+        return result
+
+    def forget(self, tags):
+        """本进程修改了数据，下次使用时重新读取这些标记的版本号。"""
+        with self._lock:
+            for tag in tags:
+                self._versions.pop(tag, None)
+
+
+tag_versions = TagVersions()
+
+
+def _cacheable_request():
+    if not app.config.get("PAGE_CACHE_TTL", 300) or request.method not in ("GET", "HEAD"):
+        return False
+    return "user_id" not in session and "_flashes" not in session
+
+
+def _cache_key():
+    return "%s%s" % (request.host, request.full_path)
+
+
+def _lookup(key, versions):
+    with _cache_lock:
+        entry = _cache.get(key)
+        if entry is None:
+            return None
+        if entry.expires <= time.time() or entry.versions != versions:
+            del _cache[key]
+            return None
+        _cache.move_to_end(key)
+        return entry
+
+
+def _store(key, entry):
+    with _cache_lock:
+        _cache[key] = entry
+        _cache.move_to_end(key)
+        while len(_cache) > app.config.get("PAGE_CACHE_SIZE", 1000):
+            _cache.popitem(last=False)
+
+
+def clear():
+    with _cache_lock:
+        _cache.clear()
+
+
+def _respond(entry):
+    body = entry.body
+    if entry.csrf:
+        body = body.replace(_CSRF_PLACEHOLDER, generate_csrf().encode("utf8"))
+    response = make_response(body)
+    response.mimetype = entry.mimetype
+    response.cache_control.no_cache = True
+    if entry.csrf:
+        # 令牌按会话生成并会过期：不允许共享缓存保存，也不给验证器，免得浏览器凭 304 一直沿用旧令牌
+        response.cache_control.private = True
+        return response
+    response.cache_control.public = True
+    response.set_etag(entry.etag)
+    response.last_modified = entry.modified
+    return response.make_conditional(request)
+
+
+def cached_page(*tags, **options):
+    """
+    缓存视图返回的页面。
+    :param tags: 页面依赖的标记，可以用 {参数名} 引用视图参数，如 "movie:{movie_id}"。
+    :param on_hit: 命中缓存时调用的函数（参数与视图相同），用于播放计数等每次访问都要做的事。
+    """
+    on_hit = options.get("on_hit")
+
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if not _cacheable_request():
+                return f(*args, **kwargs)
+            names = [tag.format(**kwargs) for tag in tags]
+            # 渲染前读取版本号，渲染期间数据被修改时缓存的页面随即失效
+            versions = tag_versions.current(names)
+            key = _cache_key()
+            entry = _lookup(key, versions)
+            if entry is not None:
+                if on_hit is not None:
+                    on_hit(*args, **kwargs)
+                return _respond(entry)
+            response = make_response(f(*args, **kwargs))
+            if response.status_code != 200 or response.direct_passthrough or "_flashes" in session:
+                return response
+            body = response.get_data()
+            token = g.get(app.config.get("WTF_CSRF_FIELD_NAME", "csrf_token"))
+            csrf = bool(token) and token.encode("utf8") in body
+            if csrf:
+                body = body.replace(token.encode("utf8"), _CSRF_PLACEHOLDER)
+            entry = _Entry(body, response.mimetype, versions, csrf)
+            _store(key, entry)
+            return _respond(entry)
+
+        return decorated_function
+
+    return decorator
+
+
+def _tags_for(obj):
+    if isinstance(obj, Movie):
+        return ["movie", "movie:%s" % obj.id]
+    if isinstance(obj, Tag):
+        return ["tag"]
+    if isinstance(obj, Preview):
+        return ["preview"]
+    if isinstance(obj, Comment):
+        return ["movie:%s" % obj.movie_id]
+    return []
+
+
+@event.listens_for(Session, "after_flush")
+def _collect_tags(session, flush_context):
+    tags = session.info.setdefault("page_cache_tags", set())
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        tags.update(_tags_for(obj))
+
+
+@event.listens_for(Session, "before_commit")
+def _bump_versions(session):
+    # 在最外层事务提交前统一加版本号，不会随保存点一起回滚；按名称顺序更新，避免死锁
+    if session.transaction is None or session.transaction.nested:
+        return
+    session.flush()
+    tags = session.info.pop("page_cache_tags", None)
+    if tags:
+        connection = session.connection()
+        for tag in sorted(tags):
+            bump_version(connection, VERSION_PREFIX + tag)
+        session.info["page_cache_bumped"] = tags
+
+
+@event.listens_for(Session, "after_commit")
+def _forget_after_commit(session):
+    tags = session.info.pop("page_cache_bumped", None)
+    if tags:
+        tag_versions.forget(tags)
+
+
+@event.listens_for(Session, "after_transaction_end")
+def _discard_tags(session, transaction):
+    if transaction.parent is None:
+        session.info.pop("page_cache_tags", None)
+        session.info.pop("page_cache_bumped", None)
@@ -0,0 +1,157 @@
+# coding:utf8
+"""
+后台列表的键集（keyset）分页。
+
+Flask-SQLAlchemy 的 paginate() 每页都要执行 COUNT(*) 和 OFFSET 扫描，越往后翻越慢。
+这里改为以 (add_time, id) 为游标：下一页只取“比上一页最后一条更早”的记录，
+可以直接利用 add_time 上的索引（InnoDB 的二级索引隐含主键 id，相当于
+(add_time, id) 的联合索引），任何一页的代价都相同。总数只用于显示，
+按 PAGINATION_COUNT_TTL 秒缓存（每个进程最多 PAGINATION_COUNT_CACHE_SIZE 个查询），MySQL 上的大表直接使用表统计信息中的估算值。
+"""
+import base64
+import math
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from flask import current_app, request
+from sqlalchemy import and_, or_, text
+from app import db
+
+_count_cache = OrderedDict()  # (SQL, 参数) -> (时间, 总数, 是否为估算值)，最近使用的在后
+_count_lock = threading.Lock()
+
+
+class KeysetPage(object):
+    """
+    一页键集分页的结果，供 ui/admin_paginator.html 中的 paginator 宏使用。
+    """
+
+    def __init__(self, items, per_page, total, approximate, has_prev, has_next, prev_cursor, next_cursor):
+        self.items = items
+        self.per_page = per_page
+        self.total = total
+        self.approximate = approximate  # total 是否为估算值
+        self.has_prev = has_prev
+        self.has_next = has_next
+        self.prev_cursor = prev_cursor
+        self.next_cursor = next_cursor
+
+    @property
+    def pages(self):
+        if not self.total:
+            return 0
+        return int(math.ceil(self.total / float(self.per_page)))
+
+
+def encode_cursor(add_time, row_id):
+    raw = "%s|%d" % (add_time.strftime("%Y-%m-%dT%H:%M:%S.%f"), row_id)
+    return base64.urlsafe_b64encode(raw.encode("ascii")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor):
+    """
+    :return: (add_time, id)；游标无法解析时返回 None。
+    """
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode((cursor + "=" * (-len(cursor) % 4)).encode("ascii")).decode("ascii")
+        add_time, row_id = raw.split("|")
+        return datetime.strptime(add_time, "%Y-%m-%dT%H:%M:%S.%f"), int(row_id)
+    except (ValueError, TypeError, UnicodeError):
+        return None
+
+
+def _estimated_rows(table_name):
+    """读取 MySQL 的表统计信息，InnoDB 下是一个近似值。"""
+    row = db.session.execute(
+        text("SELECT TABLE_ROWS FROM information_schema.TABLES "
+             "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :name"),
+        {"name": table_name}
+    ).first()
+    return row[0] if row and row[0] is not None else None
+
+
+def cached_count(query, model):
+    """
+    返回 (总数, 是否为估算值)，结果按 PAGINATION_COUNT_TTL 秒缓存。
+    """
+    config = current_app.config
+    ttl = config.get("PAGINATION_COUNT_TTL", 60)
+    compiled = query.statement.compile()
+    key = (str(compiled), tuple(sorted(compiled.params.items())))
+    now = time.time()
+    with _count_lock:
+        cached = _count_cache.get(key)
+        if cached is not None and now - cached[0] < ttl:
+            _count_cache.move_to_end(key)
+            return cached[1], cached[2]
+    total, approximate = None, False
+    if query.whereclause is None and db.session.bind.dialect.name == "mysql":
+        estimate = _estimated_rows(model.__tablename__)
+        if estimate is not None and estimate >= config.get("PAGINATION_EXACT_COUNT_LIMIT", 100000):
+            total, approximate = estimate, True
+    if total is None:
+        total = query.order_by(None).count()
+    with _count_lock:
+        _count_cache[key] = (now, total, approximate)
+        _count_cache.move_to_end(key)
+        # 每个搜索词都是一个新的键：写入时丢弃过期的和最久没用的
+        for old_key in [k for k, entry in _count_cache.items() if now - entry[0] >= ttl]:
+            del _count_cache[old_key]
+        while len(_count_cache) > config.get("PAGINATION_COUNT_CACHE_SIZE", 1000):
+            _count_cache.popitem(last=False)
+    return total, approximate
+
+
+def keyset_paginate(query, model, per_page=10, after=None, before=None, last=False, total=None):
+    """
+    按 (add_time, id) 倒序对查询结果分页。
+    :param query: 待分页的查询，不要带 order_by。
+    :param model: 提供 add_time 和 id 列的模型。
+    :param after: 游标，取该游标之后（更早）的一页。
+    :param before: 游标，取该游标之前（更新）的一页。
+    :param last: 为 True 时取最后一页。
+    :param total: 调用方已知的总数（如 Movie.review_num），给出时不再计数。
+    :return: KeysetPage。
+    """
+    add_time, row_id = model.add_time, model.id
+    if total is None:
+        total, approximate = cached_count(query, model)
+    else:
+        approximate = False
+    after, before = decode_cursor(after), decode_cursor(before)
+
+    if last or before is not None:
+        # 反向取一页，再翻转回倒序
+        if before is not None:
+            query = query.filter(or_(add_time > before[0], and_(add_time == before[0], row_id > before[1])))
+        rows = query.order_by(add_time.asc(), row_id.asc()).limit(per_page + 1).all()
+        has_prev = len(rows) > per_page
+        items = list(reversed(rows[:per_page]))
+        has_next = before is not None
+    else:
+        if after is not None:
+            query = query.filter(or_(add_time < after[0], and_(add_time == after[0], row_id < after[1])))
+        rows = query.order_by(add_time.desc(), row_id.desc()).limit(per_page + 1).all()
+        has_next = len(rows) > per_page
+        items = rows[:per_page]
+        has_prev = after is not None
+
+    prev_cursor = next_cursor = None
+    if items:
+        prev_cursor = encode_cursor(items[0].add_time, items[0].id)
+        next_cursor = encode_cursor(items[-1].add_time, items[-1].id)
+    return KeysetPage(items, per_page, total, approximate, has_prev, has_next, prev_cursor, next_cursor)
+
+
+def paginate_request(query, model, per_page=10, total=None):
+    """从请求参数 after / before / last 中读取游标并分页。"""
+    return keyset_paginate(
+        query, model, per_page=per_page,
+        after=request.args.get("after"),
+        before=request.args.get("before"),
+        last=request.args.get("last") == "1",
+        total=total
+    )
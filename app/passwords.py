@@ -0,0 +1,94 @@
+# coding:utf8
+"""
+在有界的线程池中计算密码哈希。
+
+PBKDF2 有意设计得很慢，同时登录的人一多，计算哈希会占满 CPU，拖慢其他请求。
+这里把哈希计算交给最多 PASSWORD_HASH_WORKERS 个工作线程（hashlib 计算时释放 GIL），
+排队等待的请求最多 PASSWORD_HASH_QUEUE 个，超出时立即抛出 PasswordPoolBusy，
+由调用方提示稍后再试，而不是让请求堆积。
+
+哈希参数由 PASSWORD_HASH_METHOD 配置。登录成功时如果发现保存的哈希使用的是旧参数，
+verify_password 会顺便用新参数重新计算，调用方保存即可，用户无感知。
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.security import generate_password_hash, check_password_hash
+from app import app
+
+# admin.password 和 user.password 为 String(100)，method$salt$hash 不能超过这个长度
+SALT_LENGTH = 8
+
+
+class PasswordPoolBusy(Exception):
+    """等待计算哈希的请求过多。"""
+
+
+class _HashPool(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = None
+        self._executor = None
+        self._slots = None
+
+    def _ensure(self):
+        # 线程池不能跨 fork 使用，每个进程各自创建
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    workers = app.config.get("PASSWORD_HASH_WORKERS", 2)
+                    self._executor = ThreadPoolExecutor(max_workers=workers)
+                    self._slots = threading.BoundedSemaphore(workers + app.config.get("PASSWORD_HASH_QUEUE", 8))
+                    self._pid = pid
+
+    def run(self, fn, *args):
+        self._ensure()
+        if not self._slots.acquire(timeout=app.config.get("PASSWORD_HASH_WAIT", 1)):
+            raise PasswordPoolBusy()
+        try:
+            return self._executor.submit(fn, *args).result()
+        finally:
+            self._slots.release()
+
+
+_pool = _HashPool()
+_dummy_hashes = {}
+
+
+def hash_method():
+    return app.config.get("PASSWORD_HASH_METHOD", "pbkdf2:sha256:150000")
+
+
+def needs_rehash(pwhash):
+    return pwhash.split("$", 1)[0] != hash_method()
+
+
+def hash_password(password):
+    """:return: 使用当前参数计算的哈希。"""
+    return _pool.run(generate_password_hash, password, hash_method(), SALT_LENGTH)
+
+
+def _verify(pwhash, password):
+    if not check_password_hash(pwhash, password):
+        return False, None
+    if needs_rehash(pwhash):
+        return True, generate_password_hash(password, hash_method(), SALT_LENGTH)
+    return True, None
+
+
+def verify_password(pwhash, password):
+    """
+    校验密码。
+    :param pwhash: 保存的哈希；账号不存在时传 None，仍计算一次哈希，使响应时间不暴露账号是否存在。
+    :return: (是否正确, 需要保存的新哈希或 None)。
+    :raise PasswordPoolBusy: 等待计算的请求过多。
+    """
+    if not pwhash:
+        method = hash_method()
+        dummy = _dummy_hashes.get(method)
+        if dummy is None:
+            dummy = _dummy_hashes[method] = _pool.run(generate_password_hash, "", method, SALT_LENGTH)
+        _pool.run(check_password_hash, dummy, password)
+        return False, None
+    return _pool.run(_verify, pwhash, password)
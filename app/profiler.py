@@ -0,0 +1,156 @@
+# coding:utf8
+"""
+按请求统计 SQL 的性能分析器和慢查询日志。
+
+SQL_PROFILER 为真时，在数据库引擎上记录每个请求执行的语句数、数据库总耗时和最慢的
+几条语句，最近 SQL_PROFILE_HISTORY 个请求的结果保存在本进程内，在后台
+“SQL 性能分析”页面查看。无论是否开启分析器，耗时超过 SQL_SLOW_QUERY_MS 毫秒的语句
+都会写入慢查询日志（logger "app.slowquery"），日志中的语句去掉了具体参数并合并了
+IN 列表，同一类语句只有一种写法，附带发出该语句的代码位置。
+"""
+import logging
+import os
+import re
+import threading
+import time
+import traceback
+from collections import deque
+from datetime import datetime
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from app import app
+
+slow_logger = logging.getLogger("app.slowquery")
+
+# 每个请求保留的最慢语句条数
+SLOWEST_PER_REQUEST = 5
+
+_APP_DIR = os.path.dirname(os.path.abspath(__file__))
+_SKIP_FILES = (os.path.abspath(__file__), os.path.join(_APP_DIR, "querying.py"))
+
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_RE = re.compile(r"\b\d+(?:\.\d+)?\b")
+_IN_LIST_RE = re.compile(r"\bIN \((?:\s*(?:\?|%s|%\(\w+\)s|:\w+)\s*,?)+\)", re.IGNORECASE)
+_SPACE_RE = re.compile(r"\s+")
+
+_history = deque()
+_history_lock = threading.Lock()
+
+
+def normalize(statement):
+    """去掉字面量、合并 IN 列表和空白，得到语句的“指纹”。"""
+    statement = _STRING_RE.sub("?", statement)
+    statement = _NUMBER_RE.sub("?", statement)
+    statement = _IN_LIST_RE.sub("IN (...)", statement)
+    return _SPACE_RE.sub(" ", statement).strip()
+
+
+def _format_frame(filename, lineno, name):
+    return "%s:%d %s" % (os.path.relpath(filename, os.path.dirname(_APP_DIR)), lineno, name)
+
+
+def call_site():
+    """
+    :return: 发出语句的应用代码位置“文件:行号 函数名”；语句由分页等公共模块发出时，
+             再附上调用它的视图函数的位置。找不到时为空串。
+    """
+    site = None
+    for frame in reversed(traceback.extract_stack()):
+        filename = os.path.abspath(frame[0])
+        if not filename.startswith(_APP_DIR) or filename in _SKIP_FILES:
+            continue
+        if os.path.basename(filename) == "views.py":
+            view = _format_frame(filename, frame[1], frame[2])
+            return view if site is None else "%s <- %s" % (site, view)
+        if site is None:
+            site = _format_frame(filename, frame[1], frame[2])
+    return site or ""
+
+
+class RequestProfile(object):
+    """一个请求的 SQL 统计。"""
+
+    def __init__(self):
+        self.started = time.time()
+        self.count = 0
+        self.db_time = 0.0
+        self.slowest = []  # [(耗时秒数, 规范化语句, 代码位置)]，按耗时倒序
+
+    def record(self, statement, elapsed, site):
+        self.count += 1
+        self.db_time += elapsed
+        if len(self.slowest) < SLOWEST_PER_REQUEST or elapsed > self.slowest[-1][0]:
+            self.slowest.append((elapsed, normalize(statement), site or call_site()))
+            self.slowest.sort(key=lambda item: -item[0])
+            del self.slowest[SLOWEST_PER_REQUEST:]
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("profiler_start", []).append(time.time())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get("profiler_start")
+    if not starts:
+        return
+    elapsed = time.time() - starts.pop()
+    site = None
+    if elapsed * 1000 >= app.config.get("SQL_SLOW_QUERY_MS", 200):
+        site = call_site()
+        slow_logger.warning(
+            "慢查询 %.1fms [%s] %s | %s", elapsed * 1000,
+            request.endpoint if has_request_context() else "-", site, normalize(statement)
+        )
+    if has_request_context():
+        profile = g.get("sql_profile")
+        if profile is not None:
+            profile.record(statement, elapsed, site)
+
+
+@event.listens_for(Engine, "handle_error")
+def _discard_start(context):
+    # 语句执行失败时不会触发 after_cursor_execute，丢弃对应的开始时间，以免后续语句的耗时错位
+    conn = context.connection
+    if conn is None or context.statement is None:
+        return
+    starts = conn.info.get("profiler_start")
+    if starts:
+        starts.pop()
+
+
+@app.before_request
+def _start_profile():
+    if app.config.get("SQL_PROFILER", False):
+        g.sql_profile = RequestProfile()
+
+
+@app.after_request
+def _finish_profile(response):
+    profile = g.get("sql_profile")
+    if profile is None or request.endpoint == "admin.sql_profiles":
+        return response
+    entry = {
+        "time": datetime.fromtimestamp(profile.started),
+        "method": request.method,
+        "path": request.full_path.rstrip("?"),
+        "endpoint": request.endpoint,
+        "status": response.status_code,
+        "count": profile.count,
+        "db_ms": profile.db_time * 1000,
+        "total_ms": (time.time() - profile.started) * 1000,
+        "slowest": [(elapsed * 1000, statement, site) for elapsed, statement, site in profile.slowest],
+    }
+    with _history_lock:
+        _history.append(entry)
+        while len(_history) > app.config.get("SQL_PROFILE_HISTORY", 100):
+            _history.popleft()
+    return response
+
+
+def recent_profiles():
+    """:return: 本进程最近请求的统计，最新的在前。"""
+    with _history_lock:
+        return list(reversed(_history))
@@ -0,0 +1,97 @@
+# coding:utf8
+"""
+列表页的查询整形。
+
+列表模板会访问每一行的关联对象（如 item.tag.name、item.user.name），默认的延迟加载会
+为每一行多发一次查询（N+1）。这里为每个模型登记列表中用到的关联对象及其列，
+list_query() 用 joinedload 在同一条语句中一起查出，并且只加载用到的列。
+Movie.info、User.info 等 TEXT 大字段在模型中已设为延迟加载，需要时用 undefer 显式加载。
+
+query_budget 装饰器统计一个视图（包括模板渲染）执行的 SQL 语句数，超过上限时记录警告；
+QUERY_BUDGET_STRICT 为真（默认在 TESTING 模式下）时直接抛出 QueryBudgetExceeded，
+开发和测试中一旦出现 N+1 就能立即发现。tests/test_query_counts.py 在每个后台列表中插入多行数据，
+检查页面执行的语句数不超过固定上限（python -m pytest tests）。
+"""
+import logging
+from functools import wraps
+from flask import g, has_request_context, request, current_app
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import joinedload, contains_eager, configure_mappers
+from app.models import Admin, Tag, Movie, User, Comment, Collection, Userlog, Adminlog, Operationlog
+
+logger = logging.getLogger(__name__)
+
+# 关联属性由 backref 生成，先完成映射配置才能在模块级引用
+configure_mappers()
+
+# 模型 -> ((关联属性, 需要加载的列名), ...)
+LIST_SHAPES = {
+    Movie: ((Movie.tag, ("name",)),),
+    Comment: ((Comment.user, ("name", "avatar")), (Comment.movie, ("title",))),
+    Collection: ((Collection.user, ("name",)), (Collection.movie, ("title",))),
+    Userlog: ((Userlog.user, ("name",)),),
+    Adminlog: ((Adminlog.admin, ("name",)),),
+    Operationlog: ((Operationlog.admin, ("name",)),),
+    Admin: ((Admin.role, ("name",)),),
+}
+
+
+def list_query(model):
+    """:return: 模型的列表查询，已预先加载列表中用到的关联对象。"""
+    query = model.query
+    for relationship, columns in LIST_SHAPES.get(model, ()):
+        query = query.options(joinedload(relationship).load_only(*columns))
+    return query
+
+
+def join_eager(query, relationship, columns=None, outer=False):
+    """
+    内连接关联对象并用同一次连接的结果填充它（contains_eager），
+    用于既要按关联表的列搜索或排序、又要显示关联对象的查询。
+    :param outer: 关联可能为空时用外连接，没有关联对象的行也保留。
+    """
+    option = contains_eager(relationship)
+    if columns:
+        option = option.load_only(*columns)
+    join = query.outerjoin if outer else query.join
+    return join(relationship).options(option)
+
+
+class QueryBudgetExceeded(RuntimeError):
+    """视图执行的 SQL 语句超过了 query_budget 规定的上限。"""
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _count_statement(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        g._query_count = g.get("_query_count", 0) + 1
+
+
+def query_count():
+    """:return: 当前请求到目前为止执行的 SQL 语句数。"""
+    return g.get("_query_count", 0)
+
+
+def query_budget(limit):
+    """
+    限制视图执行的 SQL 语句数。
+    :param limit: 允许的最大语句数，应与页面大小无关。
+    """
+
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            before = query_count()
+            rv = f(*args, **kwargs)
+            used = query_count() - before
+            if used > limit:
+                message = "%s 执行了 %d 条 SQL，超过上限 %d" % (request.endpoint, used, limit)
+                if current_app.config.get("QUERY_BUDGET_STRICT", current_app.testing):
+                    raise QueryBudgetExceeded(message)
+                logger.warning(message)
+            return rv
+
+        return decorated_function
+
+    return decorator
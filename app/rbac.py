@@ -0,0 +1,205 @@
+# coding:utf8
+"""
+后台基于角色的访问控制。
+
+Role.authorities 保存以逗号分隔的权限编号，每个权限（Authority）对应一个后台地址。
+逐个请求查询管理员、角色和权限并解析字符串代价太高，这里把每个角色的权限预先编译成
+允许访问的视图端点（endpoint）集合缓存在进程内，装饰器中只需一次集合查找。
+
+权限的地址可以写成端点名（admin.tag_add）、路由规则（/admin/tag/update/<int:tag_id>/）
+或具体地址（/admin/tag/list/），可以省略 /admin 前缀。
+
+管理员、角色或权限发生变化时，修改它们的事务同时更新 cacheversion 表中 "rbac" 的版本号
+（见 SQLAlchemy 会话事件）；各进程每 RBAC_VERSION_CHECK 秒比较一次版本号，版本变化后
+丢弃缓存重新编译。
+"""
+import logging
+import re
+import threading
+import time
+from urllib.parse import urlparse
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+from werkzeug.exceptions import HTTPException
+from werkzeug.routing import RequestRedirect
+from app import app
+from app.models import Admin, Role, Authority
+from app.auditlog import current_admin_id
+from app.versions import read_version, bump_version
+
+logger = logging.getLogger(__name__)
+
+VERSION_NAME = "rbac"
+# 登录后即可访问、不受权限控制的端点
+PUBLIC_ENDPOINTS = frozenset(["admin.index", "admin.logout", "admin.password"])
+# 由视图自行检查权限的端点（如 DataTables 接口按数据源对应的列表页检查，
+# 分块上传按添加、修改电影的权限检查）
+DELEGATED_ENDPOINTS = frozenset(["admin.datatable", "admin.upload_create", "admin.upload_resource"])
+
+_ID_RE = re.compile(r"\d+")
+
+
+def parse_authorities(value):
+    """把 Role.authorities 解析为权限编号集合，容忍空格、方括号等分隔符。"""
+    return frozenset(int(item) for item in _ID_RE.findall(value or ""))
+
+
+def resolve_endpoints(url):
+    """
+    :param url: 权限中登记的地址。
+    :return: 对应的端点集合，无法识别时为空集合。
+    """
+    url = (url or "").strip()
+    if not url:
+        return frozenset()
+    if url in app.view_functions:
+        return frozenset([url])
+    candidates = [url]
+    if not url.startswith("/admin/"):
+        candidates.append("/admin" + (url if url.startswith("/") else "/" + url))
+    adapter = app.url_map.bind("localhost")
+    for candidate in candidates:
+        endpoints = frozenset(rule.endpoint for rule in app.url_map.iter_rules() if rule.rule == candidate)
+        if endpoints:
+            return endpoints
+        try:
+            return frozenset([adapter.match(candidate)[0]])
+        except RequestRedirect as e:
+            # 缺少末尾斜杠等情况，按重定向后的地址再匹配一次
+            try:
+                return frozenset([adapter.match(urlparse(e.new_url).path)[0]])
+            except HTTPException:
+                pass
+        except HTTPException:
+            pass
+    logger.warning("权限地址 %s 没有对应的页面", url)
+    return frozenset()
+
+
+class AuthorizationCache(object):
+    """
+    进程内的权限缓存：角色编号 -> 允许的端点集合，管理员编号 -> (是否超级管理员, 角色编号)。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clear()
+        self._version = None
+        self._checked_at = 0
+
+    def _clear(self):
+        self._authorities = None  # 权限编号 -> 端点集合
+        self._roles = {}
+        self._admins = {}
+
+    def invalidate(self):
+        with self._lock:
+            self._clear()
+            self._checked_at = 0
+
+    def _sync(self):
+        """距上次检查超过 RBAC_VERSION_CHECK 秒时比较版本号。"""
+        now = time.time()
+        if now - self._checked_at < app.config.get("RBAC_VERSION_CHECK", 5):
+            return
+        version = read_version(VERSION_NAME)
+        with self._lock:
+            if version != self._version:
+                self._clear()
+                self._version = version
+            self._checked_at = now
+
+    def _authority_endpoints(self):
+        authorities = self._authorities
+        if authorities is None:
+            authorities = dict((authority.id, resolve_endpoints(authority.url)) for authority in Authority.query.all())
+            with self._lock:
+                self._authorities = authorities
+        return authorities
+
+    def role_endpoints(self, role_id):
+        """:return: 角色允许访问的端点集合。"""
+        endpoints = self._roles.get(role_id)
+        if endpoints is not None:
+            return endpoints
+        role = Role.query.get(role_id) if role_id is not None else None
+        endpoints = set()
+        if role is not None:
+            authorities = self._authority_endpoints()
+            for authority_id in parse_authorities(role.authorities):
+                endpoints.update(authorities.get(authority_id, ()))
+        endpoints = frozenset(endpoints)
+        with self._lock:
+            self._roles[role_id] = endpoints
+        return endpoints
+
+    def admin(self, admin_id):
+        """:return: (是否超级管理员, 角色编号)；管理员不存在时为 None。"""
+        if admin_id in self._admins:
+            return self._admins[admin_id]
+        admin = Admin.query.get(admin_id)
+        # is_super 为 0 表示超级管理员
+        info = (admin.is_super == 0, admin.role_id) if admin is not None else None
+        with self._lock:
+            self._admins[admin_id] = info
+        return info
+
+    def can_access(self, admin_id, endpoint):
+        self._sync()
+        info = self.admin(admin_id)
+        if info is None:
+            return False
+        is_super, role_id = info
+        return is_super or endpoint in self.role_endpoints(role_id)
+
+
+authorization = AuthorizationCache()
+
+
+def current_admin_can(endpoint):
+    """当前登录的管理员能否访问 endpoint。"""
+    if endpoint in PUBLIC_ENDPOINTS:
+        return True
+    admin_id = current_admin_id()
+    return admin_id is not None and authorization.can_access(admin_id, endpoint)
+
+
+# 管理员、角色、权限的任何修改都随事务更新版本号，提交后立即清空本进程的缓存
+_WATCHED = (Admin, Role, Authority)
+
+
+def _affects_authorization(obj, is_new_or_deleted):
+    if not isinstance(obj, _WATCHED):
+        return False
+    if is_new_or_deleted or not isinstance(obj, Admin):
+        return True
+    # 管理员只有角色或超级管理员标记变化时才影响权限（修改密码等不影响）
+    state = inspect(obj)
+    return any(state.attrs[name].history.has_changes() for name in ("role_id", "is_super"))
+
+
+@event.listens_for(Session, "before_flush")
+def _detect_changes(session, flush_context, instances):
+    if any(_affects_authorization(obj, True) for obj in list(session.new) + list(session.deleted)) \
+            or any(_affects_authorization(obj, False) for obj in session.dirty):
+        session.info["rbac_changed"] = True
+
+
+@event.listens_for(Session, "after_flush")
+def _bump_version(session, flush_context):
+    if session.info.get("rbac_changed") and not session.info.get("rbac_bumped"):
+        bump_version(session.connection(), VERSION_NAME)
+        session.info["rbac_bumped"] = True
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_after_commit(session):
+    if session.info.pop("rbac_changed", None):
+        session.info.pop("rbac_bumped", None)
+        authorization.invalidate()
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_changes(session):
+    session.info.pop("rbac_changed", None)
+    session.info.pop("rbac_bumped", None)
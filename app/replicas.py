@@ -0,0 +1,195 @@
+# coding:utf8
+"""
+读写分离：只读页面的查询发到 MySQL 从库。
+
+DATABASE_REPLICAS 中的每个从库注册为一个名为 replica0、replica1…… 的 bind（连接池配置
+与主库相同，连接池统计中分别列出）。用 @read_from_replica 标记的视图在 GET/HEAD 请求中
+的查询随机发到一个延迟不超过 REPLICA_MAX_LAG 秒的从库，其余一律使用主库：
+    - 写操作（flush、INSERT/UPDATE/DELETE、加锁的 SELECT、SELECT/SHOW 以外的文本 SQL）
+      发到主库，同一会话此后的查询也都使用主库；
+    - 各从库的复制延迟每 REPLICA_LAG_CHECK 秒检查一次，连接失败、复制中断或延迟过大的
+      从库暂时不用，没有可用的从库时使用主库；
+    - 写过数据的用户（请求中有写操作，或者是 POST 等非只读请求）在之后
+      REPLICA_STICKY_SECONDS 秒内的请求都使用主库，保证看得到自己刚写入的内容，
+      这个时间应大于 REPLICA_MAX_LAG。
+后台线程和命令行命令不在请求中，始终使用主库。
+
+本模块在创建 db 时导入，不能在模块顶层引用 app 包中的对象。
+"""
+import logging
+import random
+import re
+import threading
+import time
+from flask import current_app, g, has_request_context, request, session
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import orm
+from sqlalchemy.sql.dml import UpdateBase
+from sqlalchemy.sql.elements import TextClause
+
+logger = logging.getLogger(__name__)
+
+BIND_PREFIX = "replica"
+# 会话中记录写入后需要使用主库的截止时间
+STICKY_KEY = "_db_primary_until"
+READ_METHODS = ("GET", "HEAD")
+# 可以发到从库的文本 SQL，如分页读取 information_schema 中的估算行数
+_READ_ONLY_TEXT = re.compile(r"\s*(SELECT|SHOW)\b", re.IGNORECASE)
+_LOCKING_READ = re.compile(r"\bFOR\s+UPDATE\b|\bLOCK\s+IN\s+SHARE\s+MODE\b|\bFOR\s+SHARE\b", re.IGNORECASE)
+
+
+def read_from_replica(f):
+    """标记视图的只读请求可以从从库读取，放在路由装饰器之下、其他装饰器之上。"""
+    f.read_from_replica = True
+    return f
+
+
+def replica_binds(config):
+    return ["%s%d" % (BIND_PREFIX, i) for i in range(len(config.get("DATABASE_REPLICAS") or ()))]
+
+
+def configure(app):
+    """把 DATABASE_REPLICAS 注册为 SQLALCHEMY_BINDS，在 db.init_app() 之前调用。"""
+    binds = dict(app.config.get("SQLALCHEMY_BINDS") or {})
+    for key, uri in zip(replica_binds(app.config), app.config.get("DATABASE_REPLICAS") or ()):
+        binds[key] = uri
+    app.config["SQLALCHEMY_BINDS"] = binds
+    app.before_request(_choose_route)
+    app.after_request(_remember_write)
+
+
+def _is_write(clause):
+    if isinstance(clause, UpdateBase):
+        return True
+    if isinstance(clause, TextClause):
+        # 不加锁的 SELECT/SHOW 是只读的，其余文本 SQL 都按写操作处理
+        return not _READ_ONLY_TEXT.match(clause.text) or bool(_LOCKING_READ.search(clause.text))
+    return getattr(clause, "_for_update_arg", None) is not None
+
+
+def measure_lag(engine):
+    """:return: 从库的复制延迟秒数；复制中断时为 None。非 MySQL 数据库视为没有延迟。"""
+    if engine.dialect.name != "mysql":
+        return 0
+    with engine.connect() as connection:
+        for statement, column in (("SHOW REPLICA STATUS", "Seconds_Behind_Source"),
+                                  ("SHOW SLAVE STATUS", "Seconds_Behind_Master")):
+            try:
+                row = connection.execute(statement).first()
+            except Exception:
+                continue
+            if row is None:
+                # 不是从库（如读写分离代理），按没有延迟处理
+                return 0
+            return dict(row.items()).get(column)
+    return None
+
+
+class ReplicaSet(object):
+    """各从库的复制延迟，按间隔重新检查；一个从库同一时间只有一个线程在检查。"""
+
+    def __init__(self):
+        self._lags = {}  # bind -> (延迟秒数或 None, 检查时间)
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def _key_lock(self, key):
+        with self._lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def lag(self, key, db, app):
+        lag, checked = self._lags.get(key, (None, 0))
+        if time.time() - checked < app.config.get("REPLICA_LAG_CHECK", 5):
+            return lag
+        lock = self._key_lock(key)
+        if not lock.acquire(False):
+            # 其他线程正在检查，使用上一次的结果
+            return lag
+        try:
+            try:
+                lag = measure_lag(db.get_engine(app, bind=key))
+            except Exception as e:
+                logger.warning("检查从库 %s 的复制延迟失败：%s", key, e)
+                lag = None
+            if lag is None:
+                logger.warning("从库 %s 暂不可用", key)
+            self._lags[key] = (lag, time.time())
+            return lag
+        finally:
+            lock.release()
+
+    def choose(self, db, app):
+        """:return: 随机一个延迟在允许范围内的从库 bind，没有时为 None。"""
+        max_lag = app.config.get("REPLICA_MAX_LAG", 5)
+        healthy = []
+        for key in replica_binds(app.config):
+            lag = self.lag(key, db, app)
+            if lag is not None and lag <= max_lag:
+                healthy.append(key)
+        return random.choice(healthy) if healthy else None
+
+
+replica_set = ReplicaSet()
+
+
+def _choose_route():
+    """请求开始时判断能否使用从库，实际选择在第一次查询时进行。"""
+    g.db_read_replica = False
+    if not current_app.config.get("DATABASE_REPLICAS") or request.method not in READ_METHODS:
+        return
+    view = current_app.view_functions.get(request.endpoint)
+    if not getattr(view, "read_from_replica", False):
+        return
+    until = session.get(STICKY_KEY)
+    if until is not None:
+        if until > time.time():
+            return
+        session.pop(STICKY_KEY)
+    g.db_read_replica = True
+
+
+def _remember_write(response):
+    if current_app.config.get("DATABASE_REPLICAS") and (g.get("db_wrote") or request.method not in READ_METHODS):
+        session[STICKY_KEY] = time.time() + current_app.config.get("REPLICA_STICKY_SECONDS", 10)
+    return response
+
+
+class RoutingSession(SignallingSession):
+    """只读请求的查询发到从库、写操作发到主库的会话。"""
+
+    def __init__(self, db, **options):
+        super(RoutingSession, self).__init__(db, **options)
+        self.db = db
+        self._wrote = False
+
+    def _replica_engine(self):
+        if not has_request_context() or not g.get("db_read_replica"):
+            return None
+        if "db_replica" not in g:
+            g.db_replica = replica_set.choose(self.db, self.app)
+        if g.db_replica is None:
+            return None
+        return self.db.get_engine(self.app, bind=g.db_replica)
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._flushing or _is_write(clause):
+            self._wrote = True
+            if has_request_context():
+                g.db_wrote = True
+        elif not self._wrote:
+            bind_key = None
+            if mapper is not None:
+                bind_key = getattr(mapper.persist_selectable, "info", {}).get("bind_key")
+            # 指定了 __bind_key__ 的模型不参与读写分离
+            if bind_key is None:
+                engine = self._replica_engine()
+                if engine is not None:
+                    return engine
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """db.session 使用 RoutingSession 的 SQLAlchemy。"""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
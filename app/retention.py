@@ -0,0 +1,149 @@
+# coding:utf8
+"""
+登录日志和操作日志的保留策略。
+
+userlog、adminlog、operationlog 只增不减，后台日志列表又按 add_time 排序。这里按
+月把超过保留期限（LOG_RETENTION_MONTHS 个月，可按表单独设置）的记录归档到
+LOG_ARCHIVE_DIR/<表名>/<年-月>.*.jsonl.gz，每行一条 JSON 记录，然后从数据表中删除。
+
+删除按 add_time 从旧到新分块进行，每块最多 LOG_PURGE_CHUNK 行、各自提交一个短事务，
+块与块之间暂停 LOG_PURGE_PAUSE 秒，不会长时间锁住线上正在写入的表。每一块先写成
+完整的归档文件（先写临时文件，落盘后改名），再删除数据库中的记录；已有的归档文件
+不再改动。中途中断时重新执行即可，已归档但未删除的记录会再次写入新的归档文件，
+读取一个月的全部文件时按 id 去重。
+
+命令行执行：flask purge-logs（可加 --dry-run 只统计不删除），建议由 cron 每天运行。
+"""
+import gzip
+import json
+import logging
+import os
+import time
+from datetime import datetime, date
+import click
+from sqlalchemy import select
+from app import db, app
+from app.models import Userlog, Adminlog, Operationlog
+
+logger = logging.getLogger(__name__)
+
+LOG_MODELS = (Userlog, Adminlog, Operationlog)
+
+
+def months_ago(today, months):
+    """:return: today 所在月往前 months 个月的第一天。"""
+    index = today.year * 12 + today.month - 1 - months
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+def _retention_months(table_name):
+    setting = app.config.get("LOG_RETENTION_MONTHS", 6)
+    if isinstance(setting, dict):
+        return setting.get(table_name, 6)
+    return setting
+
+
+def _archive_dir():
+    return app.config.get("LOG_ARCHIVE_DIR", os.path.join(app.instance_path, "log_archive"))
+
+
+def _serialize(row):
+    record = {}
+    for key, value in row.items():
+        record[key] = value.isoformat() if isinstance(value, (datetime, date)) else value
+    return json.dumps(record, ensure_ascii=False)
+
+
+class _RunArchive(object):
+    """
+    一次清理写出的归档文件。每一块记录按月份各写一个完整的文件
+    <年-月>.<本次清理的编号>-<块序号>.jsonl.gz：先写到临时文件并落盘，再改名，
+    中途中断只会留下 .tmp 文件，不会破坏已有的归档。
+    """
+
+    def __init__(self, table_name):
+        self.directory = os.path.join(_archive_dir(), table_name)
+        self.run = "%s-%d" % (datetime.now().strftime("%Y%m%dT%H%M%S"), os.getpid())
+        self._chunks = 0
+
+    def write(self, rows):
+        """写入一块记录，返回后才能删除数据库中的这些记录。"""
+        self._chunks += 1
+        months = {}
+        for row in rows:
+            months.setdefault(row["add_time"].strftime("%Y-%m"), []).append(row)
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        for month, month_rows in sorted(months.items()):
+            path = os.path.join(self.directory, "%s.%s-%d.jsonl.gz" % (month, self.run, self._chunks))
+            with gzip.open(path + ".tmp", "wt", encoding="utf8") as f:
+                for row in month_rows:
+                    f.write(_serialize(row) + "\n")
+            with open(path + ".tmp", "rb") as f:
+                os.fsync(f.fileno())
+            os.replace(path + ".tmp", path)
+        # 改名本身也要落盘
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def purge(model, today=None, dry_run=False):
+    """
+    归档并删除一张日志表中超过保留期限的记录。
+    :param model: Userlog、Adminlog 或 Operationlog。
+    :param dry_run: 为 True 时只统计，不写归档也不删除。
+    :return: {年-月: 条数}。
+    """
+    table = model.__table__
+    cutoff = months_ago(today or date.today(), _retention_months(table.name))
+    chunk = app.config.get("LOG_PURGE_CHUNK", 1000)
+    pause = app.config.get("LOG_PURGE_PAUSE", 0.05)
+    expired = table.c.add_time < cutoff
+    counts = {}
+    if dry_run:
+        month = db.func.substr(db.cast(table.c.add_time, db.String), 1, 7)
+        rows = db.session.query(month, db.func.count(table.c.id)).filter(expired).group_by(month).all()
+        return dict((str(m), n) for m, n in rows)
+
+    archive = _RunArchive(table.name)
+    try:
+        while True:
+            # 已删除的记录不会再出现，每次都从最旧的一块开始取，利用 add_time 上的索引
+            rows = db.session.execute(
+                select([table]).where(expired).order_by(table.c.add_time, table.c.id).limit(chunk)
+            ).fetchall()
+            db.session.commit()
+            if not rows:
+                break
+            rows = [dict(row) for row in rows]
+            archive.write(rows)
+            db.session.execute(table.delete().where(table.c.id.in_([row["id"] for row in rows])))
+            db.session.commit()
+            for row in rows:
+                month = row["add_time"].strftime("%Y-%m")
+                counts[month] = counts.get(month, 0) + 1
+            if len(rows) < chunk:
+                break
+            time.sleep(pause)
+    except Exception:
+        db.session.rollback()
+        logger.exception("清理 %s 失败，已归档的记录会在下次执行时重复写入", table.name)
+        raise
+    return counts
+
+
+def purge_all(today=None, dry_run=False):
+    """:return: {表名: {年-月: 条数}}。"""
+    return dict((model.__tablename__, purge(model, today=today, dry_run=dry_run)) for model in LOG_MODELS)
+
+
+@app.cli.command("purge-logs")
+@click.option("--dry-run", is_flag=True, help="只统计将被清理的记录，不写归档也不删除。")
+def purge_logs_command(dry_run):
+    """归档并删除超过保留期限的登录日志和操作日志。"""
+    for table_name, counts in sorted(purge_all(dry_run=dry_run).items()):
+        for month, count in sorted(counts.items()):
+            click.echo("%s\t%s\t%d" % (table_name, month, count))
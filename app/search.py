@@ -0,0 +1,204 @@
+# coding:utf8
+"""
+电影全文检索。
+
+在进程内维护一个倒排索引，覆盖电影的片名、简介、地区和标签名。中文按二元组
+（bigram）切分，英文和数字按单词切分，结果按 BM25 打分排序。添加、修改、删除
+电影时增量更新索引，不需要每次重建。
+"""
+import math
+import re
+import threading
+import time
+from flask import current_app
+from flask_sqlalchemy import Pagination
+from sqlalchemy.orm import joinedload, undefer
+from app.models import Movie
+
+# 各字段的权重，片名命中比简介命中更重要
+FIELD_WEIGHTS = {
+    "title": 3.0,
+    "tag": 2.0,
+    "area": 1.5,
+    "info": 1.0,
+}
+# BM25 参数
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+_CJK = u"\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff"
+_TOKEN_RE = re.compile(u"([%s]+)|([a-z0-9]+)" % _CJK)
+
+
+def tokenize(text, for_query=False):
+    """
+    将文本切分为词项。
+    :param text: 待切分的文本。
+    :param for_query: 为 True 时用于切分查询串：连续中文只产生二元组，
+                      单个汉字才产生单字词项；否则索引时二元组和单字都产生。
+    :return: 词项列表（可能重复）。
+    """
+    if not text:
+        return []
+    tokens = []
+    for cjk, word in _TOKEN_RE.findall(text.lower()):
+        if word:
+            tokens.append(word)
+            continue
+        if len(cjk) == 1:
+            tokens.append(cjk)
+            continue
+        tokens.extend(cjk[i:i + 2] for i in range(len(cjk) - 1))
+        if not for_query:
+            # 单字也建索引，使单字查询能命中多字词中的字
+            tokens.extend(cjk)
+    return tokens
+
+
+class SearchIndex(object):
+    """
+    线程安全的倒排索引，文档以电影编号标识。
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._postings = {}  # 词项 -> {电影编号: 加权词频}
+        self._documents = {}  # 电影编号 -> {词项: 加权词频}，用于删除时定位倒排表
+        self._lengths = {}  # 电影编号 -> 加权文档长度
+        self._total_length = 0.0
+        self.built_at = None
+
+    def __len__(self):
+        return len(self._documents)
+
+    def add(self, doc_id, fields):
+        """
+        添加或替换一个文档。
+        :param doc_id: 电影编号。
+        :param fields: {字段名: 文本}，字段名见 FIELD_WEIGHTS。
+        """
+        terms = {}
+        for name, text in fields.items():
+            weight = FIELD_WEIGHTS.get(name, 1.0)
+            for token in tokenize(text):
+                terms[token] = terms.get(token, 0.0) + weight
+        length = sum(terms.values())
+        with self._lock:
+            self._discard(doc_id)
+            self._documents[doc_id] = terms
+            self._lengths[doc_id] = length
+            self._total_length += length
+            for token, tf in terms.items():
+                self._postings.setdefault(token, {})[doc_id] = tf
+
+    def remove(self, doc_id):
+        with self._lock:
+            self._discard(doc_id)
+
+    def _discard(self, doc_id):
+        terms = self._documents.pop(doc_id, None)
+        if terms is None:
+            return
+        self._total_length -= self._lengths.pop(doc_id)
+        for token in terms:
+            posting = self._postings.get(token)
+            if posting is None:
+                continue
+            posting.pop(doc_id, None)
+            if not posting:
+                del self._postings[token]
+
+    def replace_all(self, documents):
+        """
+        用 [(doc_id, fields)] 整体替换索引内容，仅用于首次构建和定期同步。
+        """
+        fresh = SearchIndex()
+        for doc_id, fields in documents:
+            fresh.add(doc_id, fields)
+        with self._lock:
+            self._postings = fresh._postings
+            self._documents = fresh._documents
+            self._lengths = fresh._lengths
+            self._total_length = fresh._total_length
+            self.built_at = time.time()
+
+    def search(self, query):
+        """
+        :param query: 查询串。
+        :return: 按得分从高到低排序的 [(电影编号, 得分)]。
+        """
+        tokens = set(tokenize(query, for_query=True))
+        if not tokens:
+            return []
+        scores = {}
+        with self._lock:
+            total = len(self._documents)
+            if total == 0:
+                return []
+            avg_length = self._total_length / total
+            for token in tokens:
+                posting = self._postings.get(token)
+                if not posting:
+                    continue
+                idf = math.log(1 + (total - len(posting) + 0.5) / (len(posting) + 0.5))
+                for doc_id, tf in posting.items():
+                    norm = BM25_K1 * (1 - BM25_B + BM25_B * self._lengths[doc_id] / avg_length)
+                    scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (BM25_K1 + 1) / (tf + norm)
+        return sorted(scores.items(), key=lambda item: (-item[1], -item[0]))
+
+
+index = SearchIndex()
+
+
+def movie_fields(movie):
+    return {
+        "title": movie.title,
+        "info": movie.info,
+        "area": movie.area,
+        "tag": movie.tag.name if movie.tag else "",
+    }
+
+
+def ensure_index():
+    """
+    首次使用时从数据库构建索引。多进程部署时其他工作进程中的修改无法直接通知到
+    本进程，因此超过 SEARCH_INDEX_REFRESH 秒后重新同步一次。
+    """
+    refresh = current_app.config.get("SEARCH_INDEX_REFRESH", 300)
+    if index.built_at is not None and (not refresh or time.time() - index.built_at < refresh):
+        return
+    movies = Movie.query.options(joinedload(Movie.tag), undefer(Movie.info)).all()
+    index.replace_all((movie.id, movie_fields(movie)) for movie in movies)
+
+
+def index_movie(movie):
+    """电影添加或修改并提交后调用。"""
+    if index.built_at is not None:
+        index.add(movie.id, movie_fields(movie))
+
+
+def unindex_movie(movie_id):
+    """电影删除并提交后调用。"""
+    index.remove(movie_id)
+
+
+def reindex_tag(tag):
+    """标签改名后，重新索引该标签下的电影。"""
+    if index.built_at is not None:
+        for movie in tag.movies:
+            index.add(movie.id, movie_fields(movie))
+
+
+def search_movies(key, page=1, per_page=10):
+    """
+    :return: flask_sqlalchemy.Pagination，items 为按相关度排序的电影。
+    """
+    ensure_index()
+    hits = index.search(key)
+    start = (page - 1) * per_page
+    ids = [doc_id for doc_id, _ in hits[start:start + per_page]]
+    items = []
+    if ids:
+        movies = dict((movie.id, movie) for movie in Movie.query.options(undefer(Movie.info)).filter(Movie.id.in_(ids)).all())
+        items = [movies[doc_id] for doc_id in ids if doc_id in movies]
+    return Pagination(None, page, per_page, len(hits), items)
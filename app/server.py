@@ -0,0 +1,314 @@
+# coding:utf8
+"""
+生产环境的多进程 WSGI 服务器。
+
+    python -m app.server --bind 0.0.0.0:5000 --workers 4 --threads 8
+
+主进程监听端口后 fork 出 --workers 个工作进程，共享同一个监听套接字；每个工作进程用
+--threads 个线程处理请求，线程都忙时不再接受新连接，连接留在内核队列中由其他进程接受。
+    --preload          主进程先加载应用再 fork，工作进程启动更快、共享只读内存；
+                       不加时每个工作进程 fork 后各自调用 create_app()
+    --max-requests N   工作进程处理约 N 个请求后退出并由主进程补上，防止内存缓慢增长，
+                       实际次数加上 0～--max-requests-jitter 的随机数，避免同时重启
+工作进程开始接受请求前先建立 DB_POOL_WARMUP 个数据库连接（见 app/database.py）。
+信号（发给主进程）：
+    HUP        平滑重启：启动一组新的工作进程，旧的处理完手上的请求后退出；
+               不使用 --preload 时新进程重新加载视图等代码（app/__init__.py 和配置档除外）
+    TERM、INT  停止接受新连接，等进行中的请求完成后退出，最长 --graceful-timeout 秒
+配置档默认为 MOVIE_CONFIG 或 production，所有选项都可以用 MOVIE_SERVER_<选项名> 环境变量指定，
+如 MOVIE_SERVER_WORKERS=8。
+"""
+import logging
+import os
+import random
+import select
+import signal
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import click
+from werkzeug.serving import BaseWSGIServer
+
+logger = logging.getLogger(__name__)
+
+# 工作进程加载应用失败时的退出码，主进程不再重启工作进程而是整体退出
+BOOT_ERROR = 3
+# 等待连接、检查退出标志的间隔秒数
+_POLL_INTERVAL = 1.0
+
+
+def load_app(profile):
+    from app import create_app
+    return create_app(profile)
+
+
+def parse_bind(bind):
+    """:return: ("0.0.0.0", 5000)；IPv6 地址写作 [::]:5000。"""
+    host, _, port = bind.rpartition(":")
+    if not host or not port.isdigit():
+        raise click.BadParameter("格式为 主机:端口，如 0.0.0.0:5000", param_hint="--bind")
+    return host.strip("[]"), int(port)
+
+
+def listen(host, port, backlog):
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    # 所有工作进程都在等待同一个套接字，没抢到连接的进程 accept 时立即返回
+    sock.setblocking(False)
+    return sock
+
+
+class WorkerServer(BaseWSGIServer):
+    """工作进程中的服务器：在共享的监听套接字上接受连接，交给固定大小的线程池处理。"""
+    multithread = True
+    multiprocess = True
+    timeout = _POLL_INTERVAL
+
+    def __init__(self, listener, app, threads, max_requests=0):
+        # werkzeug 通过 fd 参数复用已经监听的套接字（会先绑定一个临时端口再换掉）
+        super(WorkerServer, self).__init__(listener.getsockname()[0], 0, app, fd=listener.fileno())
+        self.alive = True
+        self.handled = 0
+        self.max_requests = max_requests
+        self._slots = threading.BoundedSemaphore(threads)
+        self._pool = ThreadPoolExecutor(max_workers=threads)
+
+    def get_request(self):
+        connection, address = self.socket.accept()
+        connection.setblocking(True)
+        return connection, address
+
+    def process_request(self, request, client_address):
+        self.handled += 1
+        self._pool.submit(self._process, request, client_address)
+
+    def _process(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self._slots.release()
+
+    def stop(self, *args):
+        self.alive = False
+
+    def serve(self):
+        """处理请求直到 stop() 或达到 max_requests，然后等待进行中的请求完成。"""
+        while self.alive and not (self.max_requests and self.handled >= self.max_requests):
+            # 先占一个线程，线程都忙时不去抢新连接
+            if not self._slots.acquire(timeout=_POLL_INTERVAL):
+                continue
+            handled = self.handled
+            self.handle_request()
+            if self.handled == handled:
+                self._slots.release()
+        self.socket.close()
+        self._pool.shutdown(wait=True)
+
+
+class Arbiter(object):
+    """主进程：维持工作进程数量，处理信号。"""
+
+    def __init__(self, bind, workers, threads, profile, preload=False, max_requests=0,
+                 max_requests_jitter=0, graceful_timeout=30, backlog=2048):
+        self.address = parse_bind(bind)
+        self.num_workers = workers
+        self.threads = threads
+        self.profile = profile
+        self.preload = preload
+        self.max_requests = max_requests
+        self.max_requests_jitter = max_requests_jitter
+        self.graceful_timeout = graceful_timeout
+        self.backlog = backlog
+        self.app = None
+        self.listener = None
+        self.pid = os.getpid()
+        self.generation = 0
+        self.workers = {}  # pid -> 代数
+        self.stopping = {}  # 收到 TERM 的旧工作进程 pid -> 强制结束的时间
+        self._signals = []
+        self._wakeup = None
+        self._wakeup_write = None
+
+    def run(self):
+        if self.preload:
+            self.app = load_app(self.profile)
+        self.listener = listen(self.address[0], self.address[1], self.backlog)
+        self._install_signals()
+        logger.info("监听 %s:%d，%d 个工作进程，每个 %d 个线程%s", self.address[0], self.address[1],
+                    self.num_workers, self.threads, "，已预加载应用" if self.preload else "")
+        try:
+            self._loop()
+        finally:
+            # fork 出的工作进程也会经过这里
+            if os.getpid() == self.pid:
+                self.listener.close()
+
+    def _install_signals(self):
+        read_fd, write_fd = os.pipe()
+        os.set_blocking(read_fd, False)
+        os.set_blocking(write_fd, False)
+        self._wakeup = read_fd
+        self._wakeup_write = write_fd
+        signal.set_wakeup_fd(write_fd)
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT, signal.SIGCHLD):
+            signal.signal(signum, self._on_signal)
+
+    def _on_signal(self, signum, frame):
+        self._signals.append(signum)
+
+    def _loop(self):
+        while True:
+            self._spawn_missing()
+            select.select([self._wakeup], [], [], _POLL_INTERVAL)
+            try:
+                while os.read(self._wakeup, 512):
+                    pass
+            except BlockingIOError:
+                pass
+            while self._signals:
+                signum = self._signals.pop(0)
+                if signum == signal.SIGHUP:
+                    self.reload()
+                elif signum in (signal.SIGTERM, signal.SIGINT):
+                    self.stop()
+                    return
+            if not self._reap():
+                self.stop()
+                sys.exit(BOOT_ERROR)
+            self._kill_overdue()
+
+    def _spawn_missing(self):
+        current = sum(1 for generation in self.workers.values() if generation == self.generation)
+        for _ in range(self.num_workers - current):
+            self._spawn()
+
+    def _spawn(self):
+        if self.preload:
+            # 不把主进程中的数据库连接带进子进程
+            from app.database import dispose_engine
+            dispose_engine()
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = self.generation
+            return
+        self._run_worker()
+
+    def _run_worker(self):
+        """在 fork 出的子进程中运行，不返回。"""
+        status = 0
+        # 主进程的信号处理和唤醒管道不属于工作进程：启动期间收到 TERM 直接退出，
+        # 服务开始前再换成 server.stop
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT, signal.SIGCHLD):
+            signal.signal(signum, signal.SIG_DFL)
+        signal.set_wakeup_fd(-1)
+        os.close(self._wakeup)
+        os.close(self._wakeup_write)
+        self._wakeup = self._wakeup_write = None
+        self._signals = []
+        try:
+            app = self.app or load_app(self.profile)
+            from app.database import warm_up
+            warm_up()
+            max_requests = self.max_requests
+            if max_requests:
+                max_requests += random.randint(0, self.max_requests_jitter)
+            server = WorkerServer(self.listener, app, self.threads, max_requests)
+            signal.signal(signal.SIGTERM, server.stop)
+            signal.signal(signal.SIGINT, server.stop)
+        except Exception:
+            logger.exception("工作进程 %d 启动失败", os.getpid())
+            status = BOOT_ERROR
+        else:
+            logger.info("工作进程 %d 已启动", os.getpid())
+            try:
+                server.serve()
+            except Exception:
+                logger.exception("工作进程 %d 异常退出", os.getpid())
+                status = 1
+        # 正常退出，让计数器等后台线程在 atexit 中写完缓冲的数据
+        sys.exit(status)
+
+    def _reap(self):
+        """回收退出的工作进程。:return: 是否可以继续运行（工作进程没有启动失败）。"""
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return True
+            if not pid:
+                return True
+            self.workers.pop(pid, None)
+            self.stopping.pop(pid, None)
+            if os.WIFEXITED(status) and os.WEXITSTATUS(status) == BOOT_ERROR:
+                logger.error("工作进程 %d 无法加载应用，停止服务", pid)
+                return False
+            logger.info("工作进程 %d 已退出（状态 %d）", pid, status)
+
+    def _terminate(self, pids):
+        deadline = time.time() + self.graceful_timeout
+        for pid in pids:
+            self.stopping.setdefault(pid, deadline)
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def _kill_overdue(self):
+        now = time.time()
+        for pid, deadline in list(self.stopping.items()):
+            if now >= deadline:
+                logger.warning("工作进程 %d 没有在 %d 秒内退出，强制结束", pid, self.graceful_timeout)
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+                self.stopping[pid] = now + self.graceful_timeout
+
+    def reload(self):
+        """启动新一代工作进程，旧的在处理完请求后退出。"""
+        old = [pid for pid, generation in self.workers.items() if generation == self.generation]
+        self.generation += 1
+        logger.info("平滑重启，替换 %d 个工作进程", len(old))
+        self._spawn_missing()
+        self._terminate(old)
+
+    def stop(self):
+        """通知全部工作进程退出，等待它们处理完进行中的请求。"""
+        logger.info("正在停止，等待 %d 个工作进程", len(self.workers))
+        self.listener.close()
+        self._terminate(list(self.workers))
+        while self.workers:
+            self._reap()
+            self._kill_overdue()
+            time.sleep(0.1)
+
+
+@click.command()
+@click.option("--bind", default="0.0.0.0:5000", show_default=True, help="监听地址。")
+@click.option("--workers", default=os.cpu_count() or 1, show_default="CPU 核数", help="工作进程数。")
+@click.option("--threads", default=4, show_default=True, help="每个工作进程的线程数。")
+@click.option("--config", "profile", default=lambda: os.environ.get("MOVIE_CONFIG", "production"),
+              help="配置档，默认为 MOVIE_CONFIG 或 production。")
+@click.option("--preload", is_flag=True, help="在主进程中加载应用后再 fork 工作进程。")
+@click.option("--max-requests", default=0, help="工作进程处理这么多请求后重启，0 为不重启。")
+@click.option("--max-requests-jitter", default=0, help="--max-requests 加上的随机数上限。")
+@click.option("--graceful-timeout", default=30, show_default=True, help="停止或重启时等待请求完成的秒数。")
+@click.option("--backlog", default=2048, show_default=True, help="监听队列长度。")
+def serve_command(bind, workers, threads, profile, preload, max_requests, max_requests_jitter,
+                  graceful_timeout, backlog):
+    """以多进程方式运行应用。"""
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(process)d] %(levelname)s %(message)s")
+    Arbiter(bind, workers, threads, profile, preload, max_requests, max_requests_jitter,
+            graceful_timeout, backlog).run()
+
+
+if __name__ == "__main__":
+    serve_command(auto_envvar_prefix="MOVIE_SERVER")
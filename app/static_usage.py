@@ -0,0 +1,285 @@
+# coding:utf8
+"""
+分析哪些静态文件真正被页面用到，生成裁剪后的部署包。
+
+static 下的 AdminLTE、ueditor 等都是整包放进来的（fullcalendar、flot、sparkline、
+webuploader 的各种版本、ionicons 的构建工具、ueditor 的 PHP 后端……），绝大部分
+没有被任何页面引用，却随每次部署复制、同步。这里从模板出发计算可达的文件：
+    - 模板和 Python 代码中的 url_for('static', filename='...')，以及 "/static/..." 字面量；
+      filename='前缀' + 变量 形式的动态引用保留整个前缀目录；
+    - CSS 中的 url(...) 和 @import；
+    - HTML（如 ueditor 的对话框页面）中的 src、href；
+    - JS 中看起来像相对路径的字符串字面量（a/b.js、themes/、~/dialogs/x.html），
+      脚本通常相对于自身所在目录或插件根目录加载资源，所以依次相对脚本目录及其
+      上级目录查找；以“/”结尾的目录引用保留整个目录。
+JS 的分析是启发式的：找不到的引用不会出错，只是多保留文件；由字符串拼接生成、
+无法分析的路径可以在 STATIC_BUNDLE_KEEP 中列出（文件或目录前缀）。
+    flask static-usage [--unused]    查看统计、未使用或引用了但不存在的文件
+    flask bundle-static 输出目录      复制可达的文件，作为部署用的 static 目录（不含 UP_DIR
+                                     中上传的文件，UP_DIR 在 static 下时需加 --without-uploads）
+    flask build-static --reachable-only   只为可达的文件生成带摘要的版本
+"""
+import os
+import re
+import shutil
+from collections import deque
+import click
+from app import app
+
+TEMPLATE_RE = re.compile(r"""url_for\(\s*['"]static['"]\s*,\s*filename\s*=\s*(['"])([^'"]*)\1(\s*\+)?""")
+LITERAL_RE = re.compile(r"""['"(]/static/([^'"()?#\s]+)""")
+CSS_RE = re.compile(r"""url\(\s*['"]?([^'")]+?)['"]?\s*\)|@import\s+['"]([^'"]+)['"]""")
+HTML_RE = re.compile(r"""\b(?:src|href)\s*=\s*['"]([^'"]+)['"]""")
+JS_RE = re.compile(r"""['"]((?:~/|\./|\.\./)*[\w@.-]+(?:/[\w@.-]+)*(?:\.[A-Za-z0-9]{2,5}|/))['"]""")
+
+# 不是文件路径的引用
+_SKIP_PREFIXES = ("data:", "http:", "https:", "//", "javascript:", "mailto:", "about:", "#")
+# 超过这个大小的文本文件不分析引用（压缩过的大库中不会有有意义的相对路径）
+MAX_PARSE_SIZE = 4 * 1024 * 1024
+
+
+def _relative(path):
+    return path.replace(os.sep, "/")
+
+
+def _read_text(path):
+    if os.path.getsize(path) > MAX_PARSE_SIZE:
+        return ""
+    with open(path, "rb") as f:
+        return f.read().decode("utf8", "ignore")
+
+
+class AssetGraph(object):
+    """
+    静态文件的引用关系。
+    :param root: static 目录。
+    :param excluded: 不参与分析的目录前缀（相对 root），如上传目录。
+    """
+
+    def __init__(self, root, excluded=()):
+        self.root = root
+        self.excluded = tuple(prefix.rstrip("/") + "/" for prefix in excluded if prefix)
+        self.reachable = set()
+        self.missing = {}  # 引用了但不存在的路径 -> 引用它的文件
+
+    def _is_excluded(self, path):
+        return (path + "/").startswith(self.excluded) if self.excluded else False
+
+    def kind(self, path):
+        """:return: "file"、"dir"，不存在时为 None。"""
+        full = os.path.join(self.root, path)
+        if os.path.isfile(full):
+            return "file"
+        if os.path.isdir(full):
+            return "dir"
+        return None
+
+    def files_under(self, prefix):
+        """:return: 前缀目录下的全部文件。"""
+        base = os.path.join(self.root, prefix)
+        for directory, dirnames, filenames in os.walk(base):
+            dirnames.sort()
+            for name in sorted(filenames):
+                path = _relative(os.path.relpath(os.path.join(directory, name), self.root))
+                if not self._is_excluded(path):
+                    yield path
+
+    def resolve(self, ref, base_dir, search_ancestors=False):
+        """
+        把引用解析为 root 下的相对路径。
+        :param base_dir: 引用所在文件的目录（相对 root）。
+        :param search_ancestors: 依次相对 base_dir 的各级上级目录查找（用于 JS）。
+        :return: (类型 "file"/"dir", 相对路径)，找不到时为 (None, 按 base_dir 解析的路径)。
+        """
+        ref = ref.strip().split("#", 1)[0].split("?", 1)[0]
+        if not ref or ref.startswith(_SKIP_PREFIXES) or "{{" in ref or "{%" in ref:
+            return None, None
+        if ref.startswith("/static/"):
+            candidates = [ref[len("/static/"):]]
+        else:
+            if ref.startswith("~/"):
+                ref, search_ancestors = ref[2:], True
+            elif ref.startswith("/"):
+                if not search_ancestors:
+                    return None, None
+                ref = ref.lstrip("/")
+            bases = [base_dir]
+            while search_ancestors and bases[-1]:
+                bases.append(os.path.dirname(bases[-1]))
+            candidates = [os.path.normpath(os.path.join(base, ref)) for base in bases]
+        first = None
+        for candidate in candidates:
+            candidate = _relative(candidate)
+            if candidate.startswith("../") or candidate == "..":
+                continue
+            first = first or candidate
+            kind = self.kind(candidate)
+            if kind == "file":
+                return kind, candidate
+            # 目录引用只接受引用者所在目录的子目录，"./"、"../" 之类不会拉进整个插件
+            if kind == "dir" and ref.endswith("/") and candidate.startswith(base_dir + "/" if base_dir else ""):
+                if candidate != base_dir and candidate != ".":
+                    return kind, candidate
+        return None, first
+
+    def references(self, path):
+        """:return: 文件中的引用，元素为 (引用字符串, 是否相对上级目录查找)。"""
+        ext = os.path.splitext(path)[1].lower()
+        if ext not in (".css", ".html", ".htm", ".js"):
+            return []
+        text = _read_text(os.path.join(self.root, path))
+        if ext == ".css":
+            return [(a or b, False) for a, b in CSS_RE.findall(text)]
+        if ext in (".html", ".htm"):
+            return [(ref, False) for ref in HTML_RE.findall(text)]
+        return [(ref, True) for ref in JS_RE.findall(text)]
+
+    def walk(self, roots):
+        """
+        从根引用出发计算可达的文件。
+        :param roots: [(类型 "file"/"dir", 相对路径)]
+        """
+        queue = deque()
+
+        def add(kind, path, referrer):
+            if kind is None:
+                if path and not self._is_excluded(path):
+                    self.missing.setdefault(path, referrer)
+                return
+            if self._is_excluded(path):
+                return
+            paths = self.files_under(path) if kind == "dir" else [path]
+            for item in paths:
+                if item not in self.reachable:
+                    self.reachable.add(item)
+                    queue.append(item)
+
+        for kind, path, referrer in roots:
+            add(kind, path, referrer)
+        while queue:
+            path = queue.popleft()
+            base_dir = _relative(os.path.dirname(path))
+            for ref, search_ancestors in self.references(path):
+                kind, target = self.resolve(ref, base_dir, search_ancestors)
+                # JS 中的字符串大多不是路径，找不到时不算缺失
+                if kind or not search_ancestors:
+                    add(kind, target, path)
+        return self.reachable
+
+
+def _source_files():
+    """:return: 可能引用静态文件的模板和 Python 源文件。"""
+    for directory, dirnames, filenames in os.walk(app.root_path):
+        dirnames[:] = sorted(
+            name for name in dirnames
+            if not name.startswith(".") and name != "__pycache__" and
+            os.path.join(directory, name) != app.static_folder
+        )
+        for name in sorted(filenames):
+            path = os.path.join(directory, name)
+            # 本模块文档中的示例不是引用
+            if name.endswith((".html", ".py")) and path != os.path.abspath(__file__):
+                yield path
+
+
+def template_roots(graph):
+    """:return: 模板和代码中直接引用的静态文件，[(类型, 相对路径, 引用它的源文件)]。"""
+    roots = []
+    for source in _source_files():
+        with open(source, "rb") as f:
+            text = f.read().decode("utf8", "ignore")
+        referrer = os.path.relpath(source, app.root_path)
+        for _, filename, concatenated in TEMPLATE_RE.findall(text):
+            if not filename.rstrip("/"):
+                continue
+            if concatenated:
+                # 'upload/' + 变量：保留整个前缀目录
+                if graph.kind(filename.rstrip("/")) == "dir":
+                    roots.append(("dir", filename.rstrip("/"), referrer))
+                continue
+            roots.append((graph.kind(filename), filename, referrer))
+        for filename in LITERAL_RE.findall(text):
+            roots.append((graph.kind(filename), filename, referrer))
+    for path in app.config.get("STATIC_BUNDLE_KEEP", ()):
+        roots.append((graph.kind(path.rstrip("/")), path.rstrip("/"), "STATIC_BUNDLE_KEEP"))
+    return roots
+
+
+def upload_prefix():
+    """:return: UP_DIR 在 static 目录下时相对 static 的路径，否则为 None。"""
+    root = os.path.abspath(app.static_folder)
+    upload = os.path.abspath(app.config["UP_DIR"])
+    if upload.startswith(root + os.sep):
+        return _relative(os.path.relpath(upload, root))
+    return None
+
+
+def analyze():
+    """:return: 计算好可达文件的 AssetGraph，上传目录不在其中。"""
+    root = app.static_folder
+    excluded = []
+    if upload_prefix():
+        excluded.append(upload_prefix())
+    graph = AssetGraph(root, excluded)
+    graph.walk(template_roots(graph))
+    return graph
+
+
+def bundle(output, graph=None):
+    """
+    把可达的文件复制到 output，保持原来的目录结构。
+    :return: (文件数, 总字节数)
+    """
+    graph = graph or analyze()
+    count = size = 0
+    for path in sorted(graph.reachable):
+        target = os.path.join(output, path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.copy2(os.path.join(graph.root, path), target)
+        count += 1
+        size += os.path.getsize(target)
+    return count, size
+
+
+def _megabytes(size):
+    return "%.1fMB" % (size / 1024.0 / 1024.0)
+
+
+@app.cli.command("static-usage")
+@click.option("--unused", is_flag=True, help="列出没有被引用的文件。")
+def static_usage_command(unused):
+    """统计静态文件的使用情况。"""
+    graph = analyze()
+    all_files = list(graph.files_under(""))
+    used = sum(os.path.getsize(os.path.join(graph.root, path)) for path in graph.reachable)
+    total = sum(os.path.getsize(os.path.join(graph.root, path)) for path in all_files)
+    click.echo("被引用 %d / %d 个文件，%s / %s" % (len(graph.reachable), len(all_files), _megabytes(used), _megabytes(total)))
+    for path, referrer in sorted(graph.missing.items()):
+        click.echo("不存在：%s（%s）" % (path, referrer))
+    if unused:
+        for path in all_files:
+            if path not in graph.reachable:
+                click.echo(path)
+
+
+@app.cli.command("bundle-static")
+@click.argument("output", type=click.Path(file_okay=False))
+@click.option("--without-uploads", is_flag=True, help="确认 UP_DIR 在 static 下时不复制上传的文件。")
+def bundle_static_command(output, without_uploads):
+    """
+    把被引用的静态文件复制到 OUTPUT，作为部署用的 static 目录。
+
+    OUTPUT 中不包含上传的电影、封面和头像（UP_DIR）。UP_DIR 在 static 下（默认的
+    static/upload/）时直接用 OUTPUT 替换 static 会丢失全部上传的文件，
+    此时必须加 --without-uploads 确认，并在部署时另外保留上传目录。
+    """
+    if os.path.exists(output) and os.listdir(output):
+        raise click.ClickException("%s 不是空目录" % output)
+    upload = upload_prefix()
+    if upload and not without_uploads:
+        raise click.ClickException(
+            "上传目录 static/%s 不会复制到 %s，用它替换 static 会丢失上传的文件；"
+            "请把 UP_DIR 移到 static 之外，或加 --without-uploads 确认另外保留上传目录" % (upload, output)
+        )
+    count, size = bundle(output)
+    click.echo("复制 %d 个文件，%s" % (count, _megabytes(size)))
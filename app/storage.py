@@ -0,0 +1,205 @@
+# coding:utf8
+"""
+按内容寻址的上传文件存储。
+
+以前每次上传都用时间戳和 uuid 命名，同一个视频或封面在修改电影时重新上传一次，
+就在 UP_DIR 中多一份完整的拷贝。现在文件按内容的 SHA-256 存放：
+    UP_DIR/ab/cd/abcd…（64 位十六进制）.mp4
+摘要在把请求体写入临时文件的同时计算，写完后如果同样内容的文件已经存在，
+就丢弃临时文件、直接引用已有文件。mediafile 表记录每个文件被多少个字段引用，
+按摘要查找文件只需一次唯一索引查询；引用数降为 0 的文件在提交修改后删除。
+
+引用数在调用方的事务中增减，随电影等记录一起提交。collect() 删除文件时持有
+mediafile 行的锁，与同时上传同样内容的请求互斥，不会删掉刚被重新引用的文件。
+"""
+import hashlib
+import os
+import re
+import tempfile
+import click
+from sqlalchemy.exc import IntegrityError
+from app import app, db
+from app.models import Mediafile
+from app.uploads import upload_dir, READ_SIZE, HASH_ALGORITHM
+
+_EXTENSION_RE = re.compile(r"^\.[0-9a-z]{1,10}$")
+_PATH_RE = re.compile(r"^[0-9a-f]{2}/[0-9a-f]{2}/([0-9a-f]{64})(\.[0-9a-z]{1,10})?$")
+
+
+def extension(filename):
+    """:return: 规范化的扩展名（小写，带点）；不合法时为空串。"""
+    ext = os.path.splitext(filename or "")[1].lower()
+    return ext if _EXTENSION_RE.match(ext) else ""
+
+
+def media_path(digest, ext=""):
+    """:return: 摘要对应的相对路径，前两级目录取摘要的前 4 位，每级最多 256 个子目录。"""
+    return "%s/%s/%s%s" % (digest[:2], digest[2:4], digest, ext)
+
+
+def is_media_path(path):
+    """:return: path 是否为按内容寻址存放的文件路径（而不是旧的时间戳文件名）。"""
+    return bool(_PATH_RE.match(path or ""))
+
+
+def absolute_path(path):
+    return os.path.join(app.config["UP_DIR"], path)
+
+
+def find(digest):
+    """:return: 摘要对应的 Mediafile，不存在时为 None。"""
+    return Mediafile.query.filter_by(hash=digest).first()
+
+
+def _copy_hashing(stream, target):
+    """把 stream 写入 target，同时计算摘要。:return: (十六进制摘要, 字节数)"""
+    digest = hashlib.new(HASH_ALGORITHM)
+    size = 0
+    while True:
+        data = stream.read(READ_SIZE)
+        if not data:
+            break
+        target.write(data)
+        digest.update(data)
+        size += len(data)
+    return digest.hexdigest(), size
+
+
+def _hash_file(path):
+    digest = hashlib.new(HASH_ALGORITHM)
+    with open(path, "rb") as f:
+        for data in iter(lambda: f.read(READ_SIZE), b""):
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def _add_reference(digest, size, ext):
+    """引用数加一，没有记录时插入。:return: 文件的相对路径。"""
+    table = Mediafile.__table__
+    for _ in range(2):
+        result = db.session.execute(
+            table.update().where(table.c.hash == digest).values(refcount=table.c.refcount + 1)
+        )
+        if result.rowcount:
+            return db.session.query(Mediafile.path).filter_by(hash=digest).scalar()
+        path = media_path(digest, ext)
+        try:
+            with db.session.begin_nested():
+                db.session.execute(table.insert().values(hash=digest, path=path, size=size, refcount=1))
+            return path
+        except IntegrityError:
+            # 另一个请求刚插入了同样内容的文件，重新加一次引用
+            continue
+    raise RuntimeError("无法登记文件 %s" % digest)
+
+
+def _place(temp_path, digest, size, ext):
+    """登记引用并把临时文件移到摘要对应的位置。"""
+    path = _add_reference(digest, size, ext)
+    target = absolute_path(path)
+    directory = os.path.dirname(target)
+    if not os.path.isdir(directory):
+        os.makedirs(directory, exist_ok=True)
+    if os.path.exists(target):
+        os.remove(temp_path)
+        # 刷新修改时间，清理程序不会把刚被重新引用的文件当作没有引用
+        os.utime(target, None)
+    else:
+        os.replace(temp_path, target)
+    return path
+
+
+def store(stream, filename):
+    """
+    保存上传的文件流，引用数加一（随调用方的事务提交）。
+    :param stream: 可读的二进制流，如 FileStorage.stream。
+    :param filename: 原始文件名，只用来取扩展名。
+    :return: 相对 UP_DIR 的路径，写入 Movie.url 等字段。
+    """
+    directory = upload_dir()
+    if not os.path.isdir(directory):
+        os.makedirs(directory, exist_ok=True)
+    # 临时文件与目标在同一文件系统，移动时只需改名
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            digest, size = _copy_hashing(stream, f)
+        return _place(temp_path, digest, size, extension(filename))
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def store_file(source_path, filename, digest=None):
+    """
+    保存服务器上已有的文件（如分块上传完成的文件），source_path 会被移走或删除。
+    :param digest: 已经算好的内容摘要（分块上传时边写边算），没有时读一遍文件计算。
+    """
+    if digest is None:
+        digest = _hash_file(source_path)
+    return _place(source_path, digest, os.path.getsize(source_path), extension(filename))
+
+
+def release(path):
+    """引用数减一（随调用方的事务提交），提交后再调用 collect() 删除不再使用的文件。"""
+    if not is_media_path(path):
+        return
+    table = Mediafile.__table__
+    db.session.execute(
+        table.update().where(table.c.path == path).where(table.c.refcount > 0).values(
+            refcount=table.c.refcount - 1
+        )
+    )
+
+
+def _remove_with_derived(path):
+    """删除文件以及由它生成的缩略图等派生文件（同一目录下以“<摘要>.”开头）。"""
+    try:
+        os.remove(absolute_path(path))
+    except OSError:
+        pass
+    directory, name = os.path.split(absolute_path(path))
+    # 没有扩展名的文件名本身就是摘要
+    prefix = name.split(".", 1)[0] + "."
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return
+    for other in names:
+        if other.startswith(prefix):
+            try:
+                os.remove(os.path.join(directory, other))
+            except OSError:
+                pass
+
+
+def collect(paths):
+    """删除 paths 中已经没有引用的文件及其派生文件。:return: 删除的文件数。"""
+    table = Mediafile.__table__
+    removed = 0
+    for path in set(p for p in paths if is_media_path(p)):
+        result = db.session.execute(table.delete().where(table.c.path == path).where(table.c.refcount <= 0))
+        if result.rowcount:
+            # 在提交前删除文件：同时上传同样内容的请求会等待这一行的锁，提交后重新插入并放回文件
+            _remove_with_derived(path)
+            removed += 1
+        db.session.commit()
+    return removed
+
+
+@app.cli.command("migrate-media")
+def migrate_media_command():
+    """把旧的时间戳文件名的电影文件和封面改为按内容寻址存放，相同内容只保留一份。"""
+    from app.models import Movie
+    moved = 0
+    for movie in Movie.query.all():
+        for column in ("url", "cover"):
+            old = getattr(movie, column)
+            if not old or is_media_path(old) or not os.path.isfile(absolute_path(old)):
+                continue
+            setattr(movie, column, store_file(absolute_path(old), old))
+            db.session.commit()
+            moved += 1
+            click.echo("%s\t%s" % (old, getattr(movie, column)))
+    click.echo("共迁移 %d 个文件" % moved)
@@ -0,0 +1,234 @@
+# coding:utf8
+"""
+视频文件的流式传输。
+
+支持 HTTP Range 请求（206 Partial Content、多段 Range、If-Range）以及
+If-None-Match / If-Modified-Since 等条件请求头，使播放器拖动进度条时只下载
+所需的字节区间，而不必重新下载整个文件。
+"""
+import calendar
+import os
+import uuid
+from flask import request, current_app, Response
+from werkzeug.http import http_date, parse_date, quote_etag, unquote_etag, parse_etags
+from werkzeug.wsgi import wrap_file
+
+# 单次读取的块大小
+CHUNK_SIZE = 64 * 1024
+# 一个请求中允许的最大 Range 段数，超出时忽略 Range 头返回完整文件，防止区间放大攻击
+MAX_RANGES = 16
+VIDEO_MIMETYPES = {
+    ".mp4": "video/mp4",
+    ".m4v": "video/mp4",
+    ".webm": "video/webm",
+    ".ogv": "video/ogg",
+    ".flv": "video/x-flv",
+    ".mov": "video/quicktime",
+    ".mkv": "video/x-matroska",
+    ".avi": "video/x-msvideo",
+}
+
+
+def file_etag(stat):
+    """
+    根据文件的修改时间和大小生成强 ETag。
+    :param stat: os.stat 的结果。
+    :return: 未加引号的 ETag 字符串。
+    """
+    return "%x-%x" % (int(stat.st_mtime * 1000000), stat.st_size)
+
+
+def parse_ranges(header, size):
+    """
+    解析 Range 请求头。
+    :param header: Range 请求头的原始值，如“bytes=0-499,1000-”。
+    :param size: 文件大小。
+    :return: 排序并合并后的 [(start, end)] 列表（end 不包含在内）；
+             请求头格式不正确或段数过多时返回 None（按完整文件处理）；
+             所有区间都无法满足时返回空列表（应返回 416）。
+    """
+    if not header or "=" not in header:
+        return None
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes":
+        return None
+    parts = [part.strip() for part in spec.split(",") if part.strip()]
+    if not parts or len(parts) > MAX_RANGES:
+        return None
+    ranges = []
+    for part in parts:
+        if "-" not in part:
+            return None
+        first, _, last = part.partition("-")
+        first, last = first.strip(), last.strip()
+        try:
+            if first == "":
+                # 后缀区间“-500”表示最后 500 个字节
+                if last == "":
+                    return None
+                suffix = int(last)
+                if suffix <= 0:
+                    continue
+                start, end = max(size - suffix, 0), size
+            else:
+                start = int(first)
+                end = int(last) + 1 if last != "" else size
+                if start < 0 or (last != "" and end <= start):
+                    return None
+                end = min(end, size)
+        except ValueError:
+            return None
+        if start < size:
+            ranges.append((start, end))
+    ranges.sort()
+    # 合并重叠或相邻的区间
+    merged = []
+    for start, end in ranges:
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def _timestamp(date):
+    """parse_date 可能返回不带时区的 UTC 时间，统一按 UTC 转换为时间戳。"""
+    return calendar.timegm(date.utctimetuple())
+
+
+def _if_range_matches(etag, mtime):
+    """If-Range 只在验证器与当前文件完全一致时才允许返回部分内容。"""
+    if_range = request.headers.get("If-Range")
+    if not if_range:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith('"') or if_range.startswith("W/"):
+        value, weak = unquote_etag(if_range)
+        return not weak and value == etag
+    date = parse_date(if_range)
+    return date is not None and int(mtime) == _timestamp(date)
+
+
+def _not_modified(etag, mtime):
+    """处理 If-None-Match 与 If-Modified-Since，前者存在时优先。"""
+    if_none_match = request.headers.get("If-None-Match")
+    if if_none_match:
+        return parse_etags(if_none_match).contains_weak(etag)
+    if_modified_since = parse_date(request.headers.get("If-Modified-Since"))
+    return if_modified_since is not None and int(mtime) <= _timestamp(if_modified_since)
+
+
+def _precondition_failed(etag, mtime):
+    """处理 If-Match 与 If-Unmodified-Since。"""
+    if_match = request.headers.get("If-Match")
+    if if_match:
+        return not parse_etags(if_match).contains(etag)
+    if_unmodified_since = parse_date(request.headers.get("If-Unmodified-Since"))
+    return if_unmodified_since is not None and int(mtime) > _timestamp(if_unmodified_since)
+
+
+def _read_range(f, start, end):
+    f.seek(start)
+    remaining = end - start
+    while remaining > 0:
+        chunk = f.read(min(CHUNK_SIZE, remaining))
+        if not chunk:
+            break
+        remaining -= len(chunk)
+        yield chunk
+
+
+def _single_range_body(path, start, end, size):
+    f = open(path, "rb")
+    if end == size:
+        # 区间一直到文件末尾时（播放器拖动进度条的常见情形）交给 wsgi.file_wrapper，
+        # gunicorn 等服务器会据此调用 sendfile 零拷贝发送。
+        f.seek(start)
+        return wrap_file(request.environ, f, CHUNK_SIZE)
+
+    def generate():
+        try:
+            for chunk in _read_range(f, start, end):
+                yield chunk
+        finally:
+            f.close()
+
+    return generate()
+
+
+def _multi_range_body(path, ranges, size, mimetype, boundary):
+    """生成 multipart/byteranges 响应体，并返回其总长度。"""
+    heads = []
+    length = 0
+    for start, end in ranges:
+        head = ("\r\n--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n"
+                % (boundary, mimetype, start, end - 1, size)).encode("latin-1")
+        heads.append(head)
+        length += len(head) + end - start
+    tail = ("\r\n--%s--\r\n" % boundary).encode("latin-1")
+    length += len(tail)
+
+    def generate():
+        with open(path, "rb") as f:
+            for head, (start, end) in zip(heads, ranges):
+                yield head
+                for chunk in _read_range(f, start, end):
+                    yield chunk
+            yield tail
+
+    return generate(), length
+
+
+def send_video(path):
+    """
+    以支持 Range 和条件请求的方式发送视频文件。
+    :param path: 视频文件的绝对路径，调用方需保证文件存在。
+    :return: 200、206、304、412 或 416 响应。
+    """
+    stat = os.stat(path)
+    size = stat.st_size
+    mtime = stat.st_mtime
+    etag = file_etag(stat)
+    mimetype = VIDEO_MIMETYPES.get(os.path.splitext(path)[1].lower(), "application/octet-stream")
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": quote_etag(etag),
+        "Last-Modified": http_date(mtime),
+        "Cache-Control": "public, max-age=%d" % current_app.get_send_file_max_age(path),
+    }
+
+    if _precondition_failed(etag, mtime):
+        return Response(status=412, headers=headers)
+    if _not_modified(etag, mtime):
+        return Response(status=304, headers=headers)
+
+    if current_app.use_x_sendfile:
+        # 由前端服务器（nginx/Apache）直接发送文件并处理 Range。
+        headers["X-Sendfile"] = path
+        headers["Content-Length"] = str(size)
+        return Response(mimetype=mimetype, headers=headers, direct_passthrough=True)
+
+    ranges = None
+    if "Range" in request.headers and _if_range_matches(etag, mtime):
+        ranges = parse_ranges(request.headers["Range"], size)
+    is_head = request.method == "HEAD"
+
+    if ranges is None:
+        headers["Content-Length"] = str(size)
+        body = [] if is_head else _single_range_body(path, 0, size, size)
+        return Response(body, status=200, mimetype=mimetype, headers=headers, direct_passthrough=True)
+    if not ranges:
+        headers["Content-Range"] = "bytes */%d" % size
+        return Response(status=416, headers=headers)
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        headers["Content-Range"] = "bytes %d-%d/%d" % (start, end - 1, size)
+        headers["Content-Length"] = str(end - start)
+        body = [] if is_head else _single_range_body(path, start, end, size)
+        return Response(body, status=206, mimetype=mimetype, headers=headers, direct_passthrough=True)
+
+    boundary = uuid.uuid4().hex
+    body, length = _multi_range_body(path, ranges, size, mimetype, boundary)
+    headers["Content-Length"] = str(length)
+    return Response([] if is_head else body, status=206, headers=headers, direct_passthrough=True,
+                    content_type="multipart/byteranges; boundary=%s" % boundary)
@@ -0,0 +1,259 @@
+# coding:utf8
+"""
+清理 UP_DIR 中没有被任何记录引用的文件。
+
+旧版本删除或修改电影时不删除原来的视频和封面，事务回滚、进程崩溃也会留下没人引用的
+文件。每个工作进程的后台线程每隔 MEDIA_SWEEP_CHECK 秒检查一次，距上次清理超过
+MEDIA_SWEEP_INTERVAL 秒时（用 UP_DIR/.sweep.stamp 的修改时间记录，.sweep.lock
+保证同一时间只有一个进程在清理）逐个遍历 UP_DIR 下的文件：
+    1. 每 MEDIA_SWEEP_BATCH 个文件查询一次 Movie.url、Movie.cover、Preview.cover、
+       User.avatar 和 mediafile 引用数，内存占用与文件总数无关；
+    2. 缩略图随原图保留或清理；最近 MEDIA_SWEEP_GRACE 秒内写入的文件（可能是还没
+       提交的上传）不处理；
+    3. 没有引用的文件先移到 UP_DIR/.quarantine/<日期>/ 下保留原来的相对路径，
+       误删时可以移回；隔离超过 MEDIA_QUARANTINE_DAYS 天后彻底删除。
+以点开头的目录（.uploads、.quarantine）不参与遍历，过期的分块上传顺带清理。
+"""
+import fcntl
+import itertools
+import logging
+import os
+import shutil
+import time
+from datetime import datetime, timedelta
+import click
+from sqlalchemy import or_
+from app import app, db
+from app.background import BackgroundFlusher
+from app.models import Movie, Preview, User, Mediafile
+from app.storage import is_media_path
+from app.thumbnails import VARIANTS
+from app.uploads import expire_uploads
+
+logger = logging.getLogger(__name__)
+
+# 引用 UP_DIR 中文件的列
+REFERENCES = (Movie.url, Movie.cover, Preview.cover, User.avatar)
+
+_DERIVED_SUFFIXES = tuple(".%s.jpg" % name for name in VARIANTS)
+_QUARANTINE_FORMAT = "%Y%m%d"
+
+
+def quarantine_dir():
+    return os.path.join(app.config["UP_DIR"], ".quarantine")
+
+
+def scan(root):
+    """
+    逐个产生 root 下的文件，不一次性列出全部文件。
+    :return: 生成器，元素为 (以“/”分隔的相对路径, 修改时间)。
+    """
+    stack = [""]
+    while stack:
+        directory = stack.pop()
+        try:
+            entries = os.scandir(os.path.join(root, directory))
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                if entry.name.startswith("."):
+                    continue
+                path = directory + "/" + entry.name if directory else entry.name
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(path)
+                    elif entry.is_file(follow_symlinks=False):
+                        yield path, entry.stat(follow_symlinks=False).st_mtime
+                except OSError:
+                    continue
+
+
+def source_stem(path):
+    """:return: 缩略图对应原图去掉扩展名的路径；path 不是缩略图时为 None。"""
+    for suffix in _DERIVED_SUFFIXES:
+        if path.endswith(suffix):
+            return path[:-len(suffix)]
+    return None
+
+
+def _escape_like(value):
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def referenced_paths(paths):
+    """:return: paths 中被某条记录引用的路径。"""
+    if not paths:
+        return set()
+    found = set()
+    for column in REFERENCES:
+        found.update(row[0] for row in db.session.query(column).filter(column.in_(paths)))
+    found.update(
+        row[0] for row in db.session.query(Mediafile.path).filter(Mediafile.path.in_(paths), Mediafile.refcount > 0)
+    )
+    return found
+
+
+def referenced_stems(stems):
+    """:return: stems 中原图（任意扩展名）被某条记录引用的那些。"""
+    if not stems:
+        return set()
+    found = set()
+    for column in REFERENCES + (Mediafile.path,):
+        query = db.session.query(column).filter(
+            or_(*[column.like(_escape_like(stem) + ".%", escape="\\") for stem in stems])
+        )
+        if column is Mediafile.path:
+            query = query.filter(Mediafile.refcount > 0)
+        found.update(os.path.splitext(row[0])[0] for row in query)
+    return found & set(stems)
+
+
+def orphans(batch):
+    """:param batch: [(相对路径, 修改时间)]，只包含已过宽限期的文件。:return: 没有被引用的路径。"""
+    originals, derived = [], {}
+    for path, _ in batch:
+        stem = source_stem(path)
+        if stem is None:
+            originals.append(path)
+        else:
+            derived[path] = stem
+    kept = referenced_paths(originals)
+    kept_stems = referenced_stems(sorted(set(derived.values())))
+    return [path for path in originals if path not in kept] + \
+           [path for path, stem in derived.items() if stem not in kept_stems]
+
+
+def quarantine(path, deadline, today):
+    """
+    把文件移到隔离目录。
+    :param deadline: 修改时间晚于它的文件不移动（期间被重新上传或引用）。
+    :return: 是否已移动。
+    """
+    source = os.path.join(app.config["UP_DIR"], path)
+    try:
+        if os.path.getmtime(source) >= deadline:
+            return False
+    except OSError:
+        return False
+    if is_media_path(path):
+        # 与 storage.collect 相同：持有 mediafile 行的锁时移走文件，同时上传同样内容的请求会等待后重新放回
+        table = Mediafile.__table__
+        db.session.execute(table.delete().where(table.c.path == path).where(table.c.refcount <= 0))
+    target = os.path.join(quarantine_dir(), today.strftime(_QUARANTINE_FORMAT), path)
+    try:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(source, target)
+    except OSError as e:
+        db.session.rollback()
+        logger.warning("隔离文件 %s 失败：%s", path, e)
+        return False
+    db.session.commit()
+    return True
+
+
+def purge_quarantine(today):
+    """删除隔离超过 MEDIA_QUARANTINE_DAYS 天的文件。:return: 删除的日期目录数。"""
+    directory = quarantine_dir()
+    if not os.path.isdir(directory):
+        return 0
+    oldest = today - timedelta(days=app.config.get("MEDIA_QUARANTINE_DAYS", 7))
+    purged = 0
+    for name in os.listdir(directory):
+        try:
+            day = datetime.strptime(name, _QUARANTINE_FORMAT)
+        except ValueError:
+            continue
+        if day < oldest:
+            shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+            purged += 1
+    return purged
+
+
+def sweep(dry_run=False, now=None):
+    """
+    清理一遍 UP_DIR。
+    :param dry_run: 为真时只找出没有引用的文件，不移动也不删除。
+    :return: (扫描的文件数, 没有引用的文件列表, 删除的隔离目录数)
+    """
+    now = now or time.time()
+    today = datetime.fromtimestamp(now)
+    deadline = now - app.config.get("MEDIA_SWEEP_GRACE", 3600)
+    batch_size = app.config.get("MEDIA_SWEEP_BATCH", 500)
+    scanned, found = 0, []
+    files = scan(app.config["UP_DIR"])
+    while True:
+        batch = list(itertools.islice(files, batch_size))
+        if not batch:
+            break
+        scanned += len(batch)
+        for path in orphans([item for item in batch if item[1] < deadline]):
+            if dry_run or quarantine(path, deadline, today):
+                found.append(path)
+        # 结束本批的事务，下一批查询看到最新提交的引用
+        db.session.commit()
+    if dry_run:
+        return scanned, found, 0
+    expire_uploads()
+    return scanned, found, purge_quarantine(today)
+
+
+class MediaSweeper(BackgroundFlusher):
+    """每个进程定期检查是否该清理了，实际清理在各进程间互斥且按间隔进行。"""
+    interval_key = "MEDIA_SWEEP_CHECK"
+    interval_default = 300
+
+    def _reset(self):
+        pass
+
+    def _flush_at_exit(self):
+        # 清理可能很久，不在进程退出时进行
+        pass
+
+    def ensure_started(self):
+        self._ensure_flusher()
+
+    def flush(self):
+        interval = app.config.get("MEDIA_SWEEP_INTERVAL", 24 * 3600)
+        root = app.config["UP_DIR"]
+        if not interval or not os.path.isdir(root):
+            return None
+        with self._flush_lock, open(os.path.join(root, ".sweep.lock"), "a") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (OSError, IOError):
+                return None
+            stamp = os.path.join(root, ".sweep.stamp")
+            if os.path.exists(stamp) and time.time() - os.path.getmtime(stamp) < interval:
+                return None
+            open(stamp, "a").close()
+            os.utime(stamp, None)
+            try:
+                with app.app_context():
+                    scanned, found, purged = sweep()
+            except Exception:
+                logger.exception("清理上传文件失败")
+                return None
+            logger.info("扫描上传文件 %d 个，隔离 %d 个，删除 %d 个过期的隔离目录", scanned, len(found), purged)
+            return found
+
+
+sweeper = MediaSweeper()
+
+
+@app.before_request
+def _start_sweeper():
+    if app.config.get("MEDIA_SWEEP_INTERVAL", 24 * 3600):
+        sweeper.ensure_started()
+
+
+@app.cli.command("sweep-media")
+@click.option("--dry-run", is_flag=True, help="只列出没有被引用的文件，不移动也不删除。")
+def sweep_media_command(dry_run):
+    """把 UP_DIR 中没有被引用的文件移到隔离目录，并删除隔离过期的文件。"""
+    scanned, found, purged = sweep(dry_run=dry_run)
+    for path in found:
+        click.echo(path)
+    click.echo("扫描 %d 个文件，%s %d 个，删除 %d 个过期的隔离目录" % (
+        scanned, "没有引用的" if dry_run else "隔离", len(found), purged
+    ))
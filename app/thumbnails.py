@@ -0,0 +1,146 @@
+# coding:utf8
+"""
+封面缩略图。
+
+封面按上传时的原图保存，列表中 131x83 的位置也要下载和解码几 MB 的原图。
+上传封面并提交后，schedule() 把生成缩略图的任务交给后台进程池（缩放和 JPEG 编码
+占用 CPU，放在线程里会和请求争抢 GIL），为每个尺寸生成重新压缩的 JPEG，
+与原图放在同一目录：
+    ab/cd/<摘要>.png  ->  ab/cd/<摘要>.grid.jpg、<摘要>.detail.jpg、<摘要>.admin.jpg
+模板用 thumbnail 过滤器取对应尺寸的路径，缩略图还没生成时退回原图：
+    url_for('static', filename='upload/' + v.cover|thumbnail('grid'))
+缩略图依赖 Pillow，没有安装时不生成，页面照常使用原图。
+"""
+import logging
+import multiprocessing
+import os
+import threading
+import click
+from app import app
+from app.storage import absolute_path
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = ImageOps = None
+
+logger = logging.getLogger(__name__)
+
+# 名称 -> (宽, 高, 是否裁剪为该比例)
+# grid 按首页网格 262x166 裁剪，搜索和收藏列表中以 131x83 显示时正好是两倍像素密度
+VARIANTS = {
+    "grid": (262, 166, True),
+    "detail": (720, 720, False),
+    "admin": (160, 100, False),
+}
+
+# 已确认生成的缩略图，避免每次渲染都检查文件是否存在
+_ready = set()
+_READY_LIMIT = 10000
+
+
+def variant_path(path, name):
+    """:return: 原图 path 的 name 尺寸缩略图的相对路径。"""
+    return "%s.%s.jpg" % (os.path.splitext(path)[0], name)
+
+
+def _targets(path, names=None):
+    return [
+        (absolute_path(variant_path(path, name)), VARIANTS[name])
+        for name in (names or sorted(VARIANTS))
+    ]
+
+
+def render(source, targets, quality):
+    """
+    生成缩略图，在后台进程中执行，只使用参数不依赖应用状态。
+    :param targets: [(缩略图的绝对路径, (宽, 高, 是否裁剪)), ...]
+    """
+    with Image.open(source) as image:
+        # JPEG 原图按需要的最大尺寸解码，大幅减少解码时间
+        image.draft("RGB", (max(size[0] for _, size in targets), max(size[1] for _, size in targets)))
+        image = image.convert("RGB")
+        for target, (width, height, crop) in targets:
+            if crop:
+                thumb = ImageOps.fit(image, (width, height), Image.LANCZOS)
+            else:
+                thumb = image.copy()
+                thumb.thumbnail((width, height), Image.LANCZOS)
+            temp = "%s.%d.tmp" % (target, os.getpid())
+            thumb.save(temp, "JPEG", quality=quality, optimize=True, progressive=True)
+            os.replace(temp, target)
+    return len(targets)
+
+
+class _RenderPool(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = None
+        self._pool = None
+
+    def submit(self, fn, *args, **kwargs):
+        # 进程池不能跨 fork 使用，每个进程各自创建；工作进程中已有计数器、连接池统计等后台线程，
+        # 从这里 fork 可能继承被其他线程持有的锁而死锁，所以用 spawn 启动全新的解释器。
+        # 子进程会以 __mp_main__ 重新导入主模块：manage.py 此时不调用 create_app()，
+        # app.server 和 flask 命令的入口都有 if __name__ == "__main__" 保护
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    context = multiprocessing.get_context("spawn")
+                    self._pool = context.Pool(processes=app.config.get("THUMBNAIL_WORKERS", 2))
+                    self._pid = pid
+        return self._pool.apply_async(fn, args, **kwargs)
+
+
+_pool = _RenderPool()
+
+
+def _log_failure(error):
+    logger.warning("生成缩略图失败：%s", error)
+
+
+def schedule(path):
+    """在后台为原图 path 生成全部尺寸的缩略图。:return: AsyncResult；无法生成时为 None。"""
+    if not path or Image is None:
+        return None
+    return _pool.submit(render, absolute_path(path), _targets(path), app.config.get("THUMBNAIL_QUALITY", 80),
+                        error_callback=_log_failure)
+
+
+@app.template_filter("thumbnail")
+def thumbnail_path(path, name):
+    """:return: 缩略图的相对路径，尚未生成时为原图路径。"""
+    if not path:
+        return path
+    thumb = variant_path(path, name)
+    if thumb in _ready:
+        return thumb
+    if not os.path.isfile(absolute_path(thumb)):
+        return path
+    if len(_ready) >= _READY_LIMIT:
+        _ready.clear()
+    _ready.add(thumb)
+    return thumb
+
+
+@app.cli.command("thumbnails")
+@click.option("--force", is_flag=True, help="重新生成已有的缩略图。")
+def thumbnails_command(force):
+    """为已有的电影封面和预告封面生成缩略图。"""
+    from app.models import Movie, Preview
+    if Image is None:
+        raise click.ClickException("没有安装 Pillow")
+    covers = set(row[0] for row in Movie.query.with_entities(Movie.cover) if row[0])
+    covers.update(row[0] for row in Preview.query.with_entities(Preview.cover) if row[0])
+    count = 0
+    for cover in sorted(covers):
+        if not os.path.isfile(absolute_path(cover)):
+            continue
+        targets = [t for t in _targets(cover) if force or not os.path.isfile(t[0])]
+        if targets:
+            try:
+                count += render(absolute_path(cover), targets, app.config.get("THUMBNAIL_QUALITY", 80))
+            except (IOError, OSError) as e:
+                click.echo("%s\t%s" % (cover, e))
+    click.echo("共生成 %d 张缩略图" % count)
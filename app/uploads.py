@@ -0,0 +1,317 @@
+# coding:utf8
+"""
+可续传的分块上传（参照 tus 1.0 协议的 creation、checksum、termination 扩展）。
+
+通过表单一次上传几个 GB 的视频，会占用一个工作进程直到传完，文件先被缓存到临时
+文件，网络一断就要从头再来。这里改为：
+    POST   创建上传，声明总长度（Upload-Length）和文件名（Upload-Metadata）；
+    HEAD   查询服务器已经收到的字节数（Upload-Offset）；
+    PATCH  从 Upload-Offset 处追加一块数据，请求体直接流式写入 UP_DIR 下的分块文件，
+           同时计算 Upload-Checksum 中指定算法的摘要，不一致时丢弃这一块；
+    DELETE 放弃上传。
+上传状态保存在 UP_DIR/.uploads/ 下的文件中，任何一个工作进程都能继续处理；
+已收到的字节数以分块文件的实际长度为准。传完后，电影表单用上传编号引用该文件。
+
+写入每一块时顺带计算整个文件的内容摘要（与 app.storage 的 HASH_ALGORITHM 相同），
+传完后记录在状态文件中，保存文件时不必再把几个 GB 的文件读一遍。hashlib 的中间
+状态无法保存到文件，所以只缓存在写入它的进程里；下一块落到别的工作进程时，由那个
+进程从分块文件补算一次。
+"""
+import base64
+import binascii
+import collections
+import fcntl
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from app import app
+
+TUS_VERSION = "1.0.0"
+CHECKSUM_ALGORITHMS = ("sha1", "md5", "sha256")
+# 流式读取请求体时每次读取的字节数
+READ_SIZE = 64 * 1024
+# 内容摘要的算法，即媒体文件按内容去重时使用的摘要
+HASH_ALGORITHM = "sha256"
+# 本进程最多缓存多少个上传的内容摘要进度
+CONTENT_HASH_CACHE = 256
+
+_ID_RE = re.compile(r"^[0-9a-f]{32}$")
+
+
+class UploadError(Exception):
+    """
+    上传请求不合法。
+    :param status: 返回的 HTTP 状态码。
+    """
+
+    def __init__(self, message, status=400):
+        super(UploadError, self).__init__(message)
+        self.status = status
+
+
+def upload_dir():
+    return os.path.join(app.config["UP_DIR"], ".uploads")
+
+
+def parse_metadata(header):
+    """解析 Upload-Metadata：以逗号分隔的“键 base64值”。"""
+    metadata = {}
+    for item in (header or "").split(","):
+        parts = item.strip().split(" ", 1)
+        if not parts[0]:
+            continue
+        try:
+            metadata[parts[0]] = base64.b64decode(parts[1]).decode("utf8") if len(parts) > 1 else ""
+        except (binascii.Error, UnicodeDecodeError):
+            raise UploadError("Upload-Metadata 格式不正确")
+    return metadata
+
+
+def parse_checksum(header):
+    """:return: (算法名, 摘要字节串)；未提供时为 None。"""
+    if not header:
+        return None
+    parts = header.strip().split(" ", 1)
+    if len(parts) != 2 or parts[0] not in CHECKSUM_ALGORITHMS:
+        raise UploadError("不支持的校验算法", 400)
+    try:
+        return parts[0], base64.b64decode(parts[1])
+    except binascii.Error:
+        raise UploadError("Upload-Checksum 格式不正确")
+
+
+# 上传编号 -> (已计算摘要的字节数, hashlib 对象)
+_content_hashes = collections.OrderedDict()
+_content_lock = threading.Lock()
+
+
+def _resume_content_hash(upload_id, f, offset):
+    """:return: 分块文件前 offset 个字节的内容摘要对象，之后 f 位于 offset 处。"""
+    with _content_lock:
+        cached = _content_hashes.pop(upload_id, None)
+    if cached is not None and cached[0] == offset:
+        return cached[1]
+    # 前面的块由别的进程写入，或者本进程的进度已被丢弃：从文件补算
+    content = hashlib.new(HASH_ALGORITHM)
+    f.seek(0)
+    remaining = offset
+    while remaining > 0:
+        data = f.read(min(READ_SIZE, remaining))
+        if not data:
+            break
+        content.update(data)
+        remaining -= len(data)
+    f.seek(offset)
+    return content
+
+
+def _save_content_hash(upload_id, offset, content):
+    with _content_lock:
+        _content_hashes[upload_id] = (offset, content)
+        while len(_content_hashes) > CONTENT_HASH_CACHE:
+            _content_hashes.popitem(last=False)
+
+
+def _forget_content_hash(upload_id):
+    with _content_lock:
+        _content_hashes.pop(upload_id, None)
+
+
+class Upload(object):
+    """一次上传，状态保存在 <编号>.json，数据保存在 <编号>.part。"""
+
+    def __init__(self, upload_id, length, filename, created, digest=None):
+        self.id = upload_id
+        self.length = length
+        self.filename = filename
+        self.created = created
+        # 传完后的内容摘要（十六进制），尚未传完或没有记录时为 None
+        self.digest = digest
+
+    @property
+    def part_path(self):
+        return os.path.join(upload_dir(), self.id + ".part")
+
+    @property
+    def info_path(self):
+        return os.path.join(upload_dir(), self.id + ".json")
+
+    @property
+    def offset(self):
+        try:
+            return os.path.getsize(self.part_path)
+        except OSError:
+            return 0
+
+    @property
+    def complete(self):
+        return self.offset == self.length
+
+    @classmethod
+    def create(cls, length, filename):
+        max_size = app.config.get("UPLOAD_MAX_SIZE", 20 * 1024 ** 3)
+        if length < 0:
+            raise UploadError("Upload-Length 不正确")
+        if length > max_size:
+            raise UploadError("文件超过 %d 字节的上限" % max_size, 413)
+        directory = upload_dir()
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        upload = cls(uuid.uuid4().hex, length, filename, time.time())
+        open(upload.part_path, "wb").close()
+        with open(upload.info_path, "w") as f:
+            json.dump({"length": length, "filename": filename, "created": upload.created}, f)
+        return upload
+
+    @classmethod
+    def get(cls, upload_id):
+        """:return: Upload；编号不存在时抛出 404 的 UploadError。"""
+        if not _ID_RE.match(upload_id or ""):
+            raise UploadError("上传不存在", 404)
+        info = _read_info(os.path.join(upload_dir(), upload_id + ".json"))
+        return cls(upload_id, info["length"], info["filename"], info["created"], info.get("digest"))
+
+    def _save_digest(self, digest):
+        """把内容摘要写入状态文件。"""
+        info = {"length": self.length, "filename": self.filename, "created": self.created, "digest": digest}
+        temp_path = self.info_path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(info, f)
+        os.rename(temp_path, self.info_path)
+        self.digest = digest
+
+    def write_chunk(self, stream, offset, content_length, checksum=None):
+        """
+        从 offset 处写入一块数据。
+        :param stream: 请求体的输入流。
+        :param content_length: 本块的字节数。
+        :param checksum: parse_checksum 的结果。
+        :return: 写入后的偏移量。
+        """
+        if content_length is None:
+            raise UploadError("缺少 Content-Length", 411)
+        if content_length > app.config.get("UPLOAD_MAX_CHUNK", 64 * 1024 ** 2):
+            raise UploadError("分块过大", 413)
+        digest = hashlib.new(checksum[0]) if checksum else None
+        with open(self.part_path, "r+b") as f:
+            try:
+                # 同一上传同时只允许一个 PATCH，客户端重试时旧连接可能还没断开
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (OSError, IOError):
+                raise UploadError("该上传正在被另一个请求写入", 409)
+            f.seek(0, os.SEEK_END)
+            if f.tell() != offset:
+                raise UploadError("Upload-Offset 与服务器上的偏移量 %d 不一致" % f.tell(), 409)
+            if offset + content_length > self.length:
+                raise UploadError("数据超过了声明的总长度", 400)
+            content = _resume_content_hash(self.id, f, offset)
+            received = 0
+            try:
+                while received < content_length:
+                    data = stream.read(min(READ_SIZE, content_length - received))
+                    if not data:
+                        break
+                    f.write(data)
+                    content.update(data)
+                    if digest is not None:
+                        digest.update(data)
+                    received += len(data)
+            except Exception:
+                # 连接中断：没有校验和时保留已经收到的部分，客户端用 HEAD 查询后续传；
+                # 内容摘要下次从文件补算
+                _forget_content_hash(self.id)
+                if digest is not None:
+                    f.truncate(offset)
+                raise
+            if digest is not None:
+                if received != content_length:
+                    f.truncate(offset)
+                    raise UploadError("数据不完整", 400)
+                if digest.digest() != checksum[1]:
+                    # 摘要不一致，丢弃这一块
+                    f.truncate(offset)
+                    raise UploadError("校验和不一致", 460)
+            f.flush()
+            end = f.tell()
+            if end == self.length:
+                _forget_content_hash(self.id)
+                self._save_digest(content.hexdigest())
+            else:
+                _save_content_hash(self.id, end, content)
+            return end
+
+    def delete(self):
+        for path in (self.part_path, self.info_path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def take(self):
+        """
+        取走已完成的上传，同时从状态文件读出内容摘要（self.digest）。
+        :return: 数据文件的路径，由调用方移走；上传的状态文件随之删除。
+                 调用方保存失败时留下的数据文件由 expire_uploads() 在过期后删除。
+        """
+        try:
+            f = open(self.part_path, "rb")
+        except (OSError, IOError):
+            raise UploadError("上传不存在", 404)
+        with f:
+            try:
+                # 等最后一块的 PATCH 写完摘要再取走
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (OSError, IOError):
+                raise UploadError("该上传正在被另一个请求写入", 409)
+            if not self.complete:
+                raise UploadError("上传尚未完成", 409)
+            self.digest = _read_info(self.info_path).get("digest")
+            # 从现在起算过期时间，调用方移走文件期间不会被 expire_uploads() 删除
+            os.utime(self.part_path)
+            try:
+                os.remove(self.info_path)
+            except OSError:
+                # 已被另一个请求取走
+                raise UploadError("上传不存在", 404)
+        return self.part_path
+
+
+def _read_info(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, IOError, ValueError):
+        raise UploadError("上传不存在", 404)
+
+
+def expire_uploads():
+    """
+    删除超过 UPLOAD_EXPIRE 秒没有写入、也没有被使用的上传，返回删除的个数。
+    被取走后没能移走的数据文件（只剩 .part、没有 .json）也一并删除。
+    """
+    directory = upload_dir()
+    if not os.path.isdir(directory):
+        return 0
+    deadline = time.time() - app.config.get("UPLOAD_EXPIRE", 24 * 3600)
+    upload_ids = set()
+    for name in os.listdir(directory):
+        upload_id, ext = os.path.splitext(name)
+        if ext in (".json", ".part") and _ID_RE.match(upload_id):
+            upload_ids.add(upload_id)
+    removed = 0
+    for upload_id in sorted(upload_ids):
+        upload = Upload(upload_id, 0, None, None)
+        last_write = 0
+        for path in (upload.info_path, upload.part_path):
+            try:
+                last_write = max(last_write, os.path.getmtime(path))
+            except OSError:
+                pass
+        if last_write < deadline:
+            upload.delete()
+            removed += 1
+    return removed
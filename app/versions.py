@@ -0,0 +1,54 @@
+# coding:utf8
+"""
+进程间共享的缓存版本号。
+
+各工作进程在内存中缓存的数据（如角色权限）被其他进程修改时无法直接通知到本进程。
+修改数据的事务同时把 cacheversion 表中对应名称的版本号加一，读取方定期比较版本号，
+发现变化就丢弃本进程的缓存。
+"""
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.exc import IntegrityError
+from app import db
+from app.models import Cacheversion
+
+
+def read_version(name):
+    """:return: 当前版本号，从未修改过时为 0。"""
+    return db.session.query(Cacheversion.version).filter_by(name=name).scalar() or 0
+
+
+def read_versions(names):
+    """:return: {名称: 版本号}，一次查询读出多个版本号。"""
+    names = list(names)
+    versions = dict.fromkeys(names, 0)
+    if names:
+        rows = db.session.query(Cacheversion.name, Cacheversion.version).filter(Cacheversion.name.in_(names))
+        versions.update((name, version or 0) for name, version in rows)
+    return versions
+
+
+def bump_version(connection, name):
+    """
+    在 connection 所在的事务中把版本号加一，随修改数据的事务一起提交。
+    名称对应的行不存在时插入，多个事务同时插入同一名称时不会因唯一约束失败。
+    :param connection: 数据库连接，如 session.connection()。
+    """
+    table = Cacheversion.__table__
+    next_version = db.func.coalesce(table.c.version, 0) + 1
+    if connection.dialect.name == "mysql":
+        connection.execute(
+            mysql_insert(table).values(name=name, version=1).on_duplicate_key_update(version=next_version)
+        )
+        return
+    update = table.update().where(table.c.name == name).values(version=next_version)
+    if connection.execute(update).rowcount:
+        return
+    # 其他事务可能同时插入了这一行：插入失败时只回滚到保存点，再加一次
+    savepoint = connection.begin_nested()
+    try:
+        connection.execute(table.insert().values(name=name, version=1))
+    except IntegrityError:
+        savepoint.rollback()
+        connection.execute(update)
+    else:
+        savepoint.commit()
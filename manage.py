@@ -1,5 +1,59 @@
 # coding:utf8
-from app import app
+"""
+开发服务器和命令行入口。配置档由环境变量 MOVIE_CONFIG 选择（见 app/config.py）。
+    python manage.py                    启动开发服务器
+    python -m app.server --workers 4    生产环境的多进程服务器（见 app/server.py）
+    FLASK_APP=manage.py flask <命令>    运行 flask purge-logs 等命令
+FLASK_APP 需要指向本文件：直接指向 app 包时得到的是还没有配置的应用。
+"""
+import json
+import os
+import subprocess
+import sys
+import click
+from app import app, create_app
+
+# 生成缩略图的子进程（spawn）会以 __mp_main__ 重新导入本文件，那里不需要完整的应用
+if __name__ != "__mp_main__":
+    create_app()
+
+# 在新的解释器中测量导入和 create_app() 的耗时，以及此时建立的数据库引擎数
+_BENCHMARK_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+application = app.create_app(sys.argv[1])
+created = time.perf_counter()
+from app.database import engines
+print(json.dumps({"import": imported - start, "create": created - imported, "engines": len(engines())}))
+"""
+
+
+def _summary(values):
+    values = sorted(values)
+    return "最小 %.1f  中位 %.1f  最大 %.1f ms" % (
+        values[0] * 1000, values[len(values) // 2] * 1000, values[-1] * 1000
+    )
+
+
+@app.cli.command("startup-benchmark")
+@click.option("--runs", default=10, show_default=True, help="启动次数。")
+@click.option("--config", "profile", default=lambda: os.environ.get("MOVIE_CONFIG", "development"),
+              help="配置档，默认为 MOVIE_CONFIG 或 development。")
+def startup_benchmark_command(runs, profile):
+    """测量工作进程的启动时间。"""
+    results = []
+    root = os.path.dirname(os.path.abspath(__file__))
+    for _ in range(runs):
+        output = subprocess.check_output([sys.executable, "-c", _BENCHMARK_SCRIPT, profile], cwd=root)
+        results.append(json.loads(output.decode("utf8").strip().splitlines()[-1]))
+    click.echo("导入 app：        %s" % _summary([r["import"] for r in results]))
+    click.echo("create_app()：    %s" % _summary([r["create"] for r in results]))
+    click.echo("合计：            %s" % _summary([r["import"] + r["create"] for r in results]))
+    engines = max(r["engines"] for r in results)
+    click.echo("启动后已建立的数据库引擎：%d%s" % (engines, "" if not engines else "（fork 前应调用 dispose_engine()）"))
+
 
 if __name__ == "__main__":
     # app.run()的默认参数为“host="127.0.0.1"”，此时外部不能访问，
@@ -0,0 +1,18 @@
+# coding:utf8
+"""测试使用 testing 配置档：SQLite 内存数据库，关闭 CSRF 校验，进程结束时数据库随之消失。"""
+import pytest
+from app import create_app, db
+
+
+@pytest.fixture(scope="session")
+def app():
+    app = create_app("testing")
+    with app.app_context():
+        db.create_all()
+        yield app
+        db.session.remove()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
@@ -0,0 +1,80 @@
+# coding:utf8
+"""
+后台列表页执行的 SQL 语句数不随列表行数增长。
+
+每个列表先插入足够多的行，模板对每一行访问关联对象时如果出现延迟加载（N+1），
+语句数会远远超过 QUERY_BUDGET。
+"""
+import pytest
+from sqlalchemy import event
+from app import db
+from app.models import Admin, Role, Tag, Movie, User, Comment, Collection, Userlog, Adminlog, Operationlog
+from app.passwords import hash_password
+
+ROWS = 12
+# 权限检查 + 总数 + 列表，与页面大小无关
+QUERY_BUDGET = 4
+
+LIST_PAGES = [
+    "/admin/tag/list/",
+    "/admin/movie/list/",
+    "/admin/preview/list/",
+    "/admin/user/list/",
+    "/admin/comments/list/",
+    "/admin/collection/list/",
+    "/admin/operations/log/list/",
+    "/admin/admin_login/log/list/",
+    "/admin/user_login/log/list/",
+    "/admin/role/list/",
+    "/admin/authority/list/",
+    "/admin/admin/list/",
+]
+
+
+@pytest.fixture(scope="module")
+def seeded(app):
+    db.session.add(Role(name="超级管理员", authorities=""))
+    db.session.add(Admin(name="admin", password=hash_password("secret"), is_super=0, role_id=1))
+    for i in range(3):
+        db.session.add(Tag(name="tag%d" % i))
+    for i in range(ROWS):
+        db.session.add(User(name="user%d" % i, password="x", email="u%d@example.com" % i, phone="1380000%04d" % i))
+    db.session.commit()
+    for i in range(ROWS):
+        db.session.add(Movie(title="movie%d" % i, url="movie%d.mp4" % i, cover="movie%d.jpg" % i,
+                             info="info", tag_id=i % 3 + 1, views=0, review_num=0))
+    db.session.commit()
+    for i in range(ROWS):
+        db.session.add(Comment(content="comment%d" % i, movie_id=i % 4 + 1, user_id=i + 1))
+        db.session.add(Collection(movie_id=i + 1, user_id=i + 1))
+        db.session.add(Userlog(user_id=i + 1, ip="127.0.0.1"))
+        db.session.add(Adminlog(admin_id=1, ip="127.0.0.1"))
+        db.session.add(Operationlog(admin_id=1, ip="127.0.0.1", reason="reason%d" % i))
+    db.session.commit()
+
+
+@pytest.fixture
+def admin_client(client, seeded):
+    response = client.post("/admin/login/", data={"account": "admin", "password": "secret"})
+    assert response.status_code == 302
+    assert response.headers["Location"].endswith("/admin/")
+    return client
+
+
+@pytest.fixture
+def statements(app):
+    executed = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        executed.append(statement)
+
+    event.listen(db.engine, "before_cursor_execute", record)
+    yield executed
+    event.remove(db.engine, "before_cursor_execute", record)
+
+
+@pytest.mark.parametrize("url", LIST_PAGES)
+def test_list_page_query_count(admin_client, statements, url):
+    response = admin_client.get(url)
+    assert response.status_code == 200
+    assert len(statements) <= QUERY_BUDGET, "%s 执行了 %d 条 SQL：\n%s" % (url, len(statements), "\n".join(statements))